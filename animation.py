@@ -1,11 +1,14 @@
+import os                           # cpu count, for the animation thread
 from bisect import bisect_left      # search sorted keyframe lists
+from concurrent.futures import ThreadPoolExecutor  # animation worker thread
 
 # External, non built-in modules
-import glfw                         # lean window system wrapper for OpenGL
 import numpy as np                  # all matrix manipulations & OpenGL args
 
-from transform import (lerp, quaternion_slerp, quaternion_matrix)
-from core import Node
+from transform import (lerp, quaternion_slerp, quaternion_matrix,
+                       quaternion_slerp_array, quaternion_matrix_array)
+from core import Node, clock, render_queue
+from profiler import profiler
 from numbers import Number
 from math import fmod
 
@@ -61,24 +64,250 @@ class TransformKeyFrames:
                       [0, 0, 0, 1]])
         return M
 
+    def duration(self):
+        """ Time of the last key, value is constant afterwards """
+        return max(self.trans.times[-1], self.rot.times[-1], self.scale.times[-1])
+
+    def bake(self, rate, duration=None, interpolate=True):
+        """ Resample into a BakedKeyFrames table, default over all keys """
+        duration = self.duration() if duration is None else duration
+        return BakedKeyFrames(self, duration, rate, interpolate)
+
+
+class BakedKeyFrames:
+    """ Values of any keyframes object sampled at a fixed rate in a dense
+        table, so that value lookup is an index whatever the number of keys.
+        Table size and worst error are kept for the loaders' summary """
+    def __init__(self, keyframes, duration, rate=30., interpolate=True):
+        self.duration, self.rate = duration, rate
+        self.interpolate = interpolate
+        times = np.arange(int(np.ceil(duration * rate)) + 1) / rate
+        self.table = np.array([keyframes.value(t) for t in times], 'f')
+
+        # worst error is halfway between samples, compare with exact values
+        halves = (times[:-1] + times[1:]) / 2
+        self.error = max((np.abs(self.value(t) - keyframes.value(t)).max()
+                          for t in halves), default=0.)
+
+    @property
+    def nbytes(self):
+        """ size of the table """
+        return self.table.nbytes
+
+    def summary(self):
+        """ one line description, printed by loaders """
+        return '%d samples at %g Hz, %d bytes, max error %.2e' % (
+            len(self.table), self.rate, self.nbytes, self.error)
+
+    def value(self, time):
+        """ Table lookup, optionally interpolated between the two samples """
+        position = min(max(time, 0.), self.duration) * self.rate
+        index = min(int(position), len(self.table) - 1)
+        if not self.interpolate or index == len(self.table) - 1:
+            return self.table[min(int(position + 0.5), len(self.table) - 1)]
+        return lerp(self.table[index], self.table[index + 1], position - index)
+
+
+class PackedKeyFrames:
+    """ Many KeyFrames channels packed in flat arrays, for batch lookups """
+    FIELDS = ('start', 'end', 'times', 'values', 'keys', 'shift')  # see arrays
+
+    def __init__(self, keyframes, size):
+        """ keyframes: list of KeyFrames, values of each key broadcast to size """
+        counts = [len(keys.times) for keys in keyframes]
+        self.start = np.cumsum([0] + counts[:-1])    # first key of channels
+        self.end = self.start + counts - np.int64(1)  # last key of channels
+        self.times = np.concatenate([keys.times for keys in keyframes])
+        self.values = np.array([np.broadcast_to(value, size) for keys in
+                                keyframes for value in keys.values], 'f')
+
+        # shift each channel's times in its own disjoint range, so that a
+        # single sorted array serves all channels for np.searchsorted
+        channel = np.repeat(np.arange(len(counts)), counts)
+        self.origin = self.times.min()
+        self.span = self.times.max() - self.origin + 1
+        self.keys = self.times - self.origin + channel * self.span
+        self.shift = np.arange(len(counts)) * self.span - self.origin
+
+    def arrays(self):
+        """ the arrays lookups need, e.g. to copy in shared memory """
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """ PackedKeyFrames reading existing arrays, see arrays """
+        packed = cls.__new__(cls)
+        for field in cls.FIELDS:
+            setattr(packed, field, arrays[field])
+        return packed
+
+    def lookup(self, time):
+        """ Indices of the keys surrounding time and interpolation fraction,
+            per channel, with the same boundary rules as KeyFrames.value.
+            Times of shape (..., 1) give results of shape (..., channels) """
+        time = np.clip(time, self.times[self.start], self.times[self.end])
+        high = np.searchsorted(self.keys, time + self.shift)
+        high = np.minimum(np.maximum(high, self.start + 1), self.end)
+        low = np.maximum(high - 1, self.start)   # single key channels
+        delta = self.times[high] - self.times[low]
+        fraction = (time - self.times[low]) / np.where(delta > 0, delta, 1)
+        return low, high, fraction
+
+
+class SkeletonKeyFrames:
+    """ TransformKeyFrames of a whole skeleton, evaluated in a single call """
+    def __init__(self, transform_keyframes):
+        """ packs translation, rotation, scale channels of all bones """
+        self.trans = PackedKeyFrames([k.trans for k in transform_keyframes], 3)
+        self.rot = PackedKeyFrames([k.rot for k in transform_keyframes], 4)
+        self.scale = PackedKeyFrames([k.scale for k in transform_keyframes], 3)
+        self.pose = None  # last evaluated local bone matrices, see update
+        self.baked = None  # optional BakedKeyFrames table, see bake
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """ SkeletonKeyFrames reading existing arrays, see arrays """
+        skeleton = cls.__new__(cls)
+        for name in ('trans', 'rot', 'scale'):
+            setattr(skeleton, name, PackedKeyFrames.from_arrays(
+                {field: arrays[name + '_' + field] for field in PackedKeyFrames.FIELDS}))
+        skeleton.pose, skeleton.baked = None, None
+        return skeleton
+
+    def arrays(self):
+        """ flat dict of the packed channel arrays, e.g. for shared memory """
+        return {name + '_' + field: array for name in ('trans', 'rot', 'scale')
+                for field, array in getattr(self, name).arrays().items()}
+
+    def value(self, time):
+        """ (channels, 4, 4) array of local TRS matrices for given time, or
+            (times, channels, 4, 4) for an array of times (e.g. a crowd) """
+        time = np.asarray(time, np.float64)[..., None]  # against channels
+        low, high, fraction = self.trans.lookup(time)
+        T = lerp(self.trans.values[low], self.trans.values[high],
+                 fraction[..., None])
+        low, high, fraction = self.scale.lookup(time)
+        S = lerp(self.scale.values[low], self.scale.values[high],
+                 fraction[..., None])
+        low, high, fraction = self.rot.lookup(time)
+        M = quaternion_matrix_array(quaternion_slerp_array(
+            self.rot.values[low].reshape(-1, 4), self.rot.values[high].reshape(-1, 4),
+            fraction.reshape(-1))).reshape(fraction.shape + (4, 4))
+
+        M[..., :3, :3] *= S[..., None, :]  # same as R @ diag(S), column scaling
+        M[..., :3, 3] = T
+        return M
+
+    def update(self, time):
+        """ Evaluate skeleton once per frame, bone nodes then read pose """
+        self.pose = self.evaluate(time)
+
+    def evaluate(self, time):
+        """ local bone matrices at time, from the baked table if any """
+        return (self.baked or self).value(time)
+
+    def duration(self):
+        """ Time of the last key of all channels """
+        return max(self.trans.times.max(), self.rot.times.max(),
+                   self.scale.times.max())
+
+    def bake(self, rate, duration=None, interpolate=True):
+        """ Resample all channels into one (samples, channels, 4, 4) table,
+            used by update from then on """
+        duration = self.duration() if duration is None else duration
+        self.baked = BakedKeyFrames(self, duration, rate, interpolate)
+        return self.baked
+
 
 class KeyFrameControlNode(Node):
     """ Place node with transform keys above a controlled subtree """
-    def __init__(self, trans_keys, rotat_keys, scale_keys, loop_duration=0.0):
+    dynamic = True
+
+    def __init__(self, trans_keys, rotat_keys, scale_keys, loop_duration=0.0,
+                 bake_rate=None):
         super().__init__()
         self.keyframes = TransformKeyFrames(trans_keys, rotat_keys, scale_keys)
         self.loop_duration = loop_duration
+        if bake_rate:  # dense table lookup instead of bisect & interpolate
+            self.keyframes = self.keyframes.bake(bake_rate, loop_duration or None)
 
-    def draw(self, projection, view, model):
-        """ When redraw requested, interpolate our node transform from keys """
-        glfw_time = glfw.get_time()
+    def animation_time(self, now):
+        """ Time in our animation at clock time now, looped if requested """
         if self.loop_duration == 0.0: # on n'a pas demandé à faire boucler l'animation
-            time = glfw_time
+            return now
             # rq : on a pas implémenté les reset_time pour KeyFrameControlNode
             # parce qu'on en a pas eu besoin,
             # mais on pourrait le faire exactement de la mm façon que pour
             # SkinningControlNode (cf mesh_skinning.py)
-        else:
-            time = fmod(glfw_time, self.loop_duration)
-        self.transform = self.keyframes.value(time)
+        return fmod(now, self.loop_duration)
+
+    def draw(self, projection, view, model):
+        """ When redraw requested, interpolate our node transform from keys """
+        self.transform = animation_updater.value(  # marks our subtree dirty
+            self, self.keyframes.value, self.animation_time(clock.time()),
+            self.animation_time(clock.next_time()))
         super().draw(projection, view, model)
+
+
+# -------------- Animation update thread ---------------------------------------
+class AnimationUpdater:
+    """ Pipelines keyframe evaluation with rendering. While the main thread,
+        owner of the OpenGL context, submits frame N, a worker thread
+        evaluates the keyframes requested for frame N+1 at clock.next_time().
+        Values are double buffered: nodes read the front values prepared
+        last frame, the worker fills the back ones, swapped when the next
+        frame starts collecting. A prepared value is only used if it was
+        evaluated at the time now asked for, which the clock guarantees on
+        both its fixed step and wall clock (see Clock.step): nodes without
+        one (first frame, animation resumed by AnimationLOD) or with a stale
+        one (clock set, animation reset) are evaluated at once. The worker
+        only overlaps with the main thread on more than one core: it is off
+        by default on a single core, where it only adds overhead. """
+    def __init__(self, enabled=None):
+        self.enabled = (os.cpu_count() or 1) > 1 if enabled is None else enabled
+        self.executor = None    # single worker, created with the first request
+        self.requests = []      # (owner, function, time) for next frame
+        self.future = None      # worker's {owner: value} of next frame
+        self.front = {}         # owner -> (time, value) prepared for this frame
+
+    def value(self, owner, function, time, next_time=None):
+        """ function(time) for owner this frame, prepared or evaluated now;
+            with next_time, function(next_time) is requested for next frame """
+        prepared, value = self.front.pop(owner, (None, None))
+        if value is not None and prepared == time:
+            render_queue.counters['animations prepared'] += 1
+        else:
+            render_queue.counters['animations inline'] += 1
+            value = function(time)
+        if self.enabled and next_time is not None:
+            self.requests.append((owner, function, next_time))
+        return value
+
+    def begin_frame(self):
+        """ wait for the values prepared during last frame, bring them front """
+        self.front = self.future.result() if self.future is not None else {}
+        self.future = None
+
+    def launch(self, _meshes=None):
+        """ evaluate this frame's requests in the worker, while the main
+            thread goes on submitting draws """
+        requests, self.requests = self.requests, []
+        if requests:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(1, 'animation')
+            self.future = self.executor.submit(evaluate_requests, requests)
+
+
+def evaluate_requests(requests):
+    """ worker side: {owner: (time, function(time))}, owners are distinct """
+    return {owner: (time, function(time)) for owner, function, time in requests}
+
+
+animation_updater = AnimationUpdater()
+render_queue.on_begin.append(animation_updater.begin_frame)
+render_queue.before_submit.append(animation_updater.launch)
+
+
+profiler.instrument(TransformKeyFrames, 'value', 'keyframes')
+profiler.instrument(BakedKeyFrames, 'value', 'keyframes')
+profiler.instrument(SkeletonKeyFrames, 'update', 'skeletons')
@@ -0,0 +1,526 @@
+#!/usr/bin/env python3
+"""
+Process-wide asset cache shared by all loaders.
+Imported scenes are kept as plain numpy data, one copy per (file, flags),
+GPU vertex arrays and textures are shared by all instances of an asset and
+freed by their own destructors when the last mesh using them goes away.
+Imported scenes are also stored on disk as memory-mapped .npy arrays, so
+warm starts skip assimp entirely.
+"""
+# Python built-in modules
+import os                           # os function, i.e. checking file status
+import shutil                       # remove stale cache directories
+import tempfile                     # atomic cache writes
+import hashlib                      # cache directory names from file paths
+import weakref                      # caches which do not keep objects alive
+import multiprocessing              # worker processes for scene imports
+import threading                    # prefetches from pool callbacks
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# External, non built-in modules
+import numpy as np                  # all matrix manipulations & OpenGL args
+
+from core import Node, VertexArray
+from mesh_texture import Texture, prefetch_image
+from mesh_skinning import MAX_BONES, MAX_VERTEX_BONES, pack_bone_weights
+from lod import lod_levels
+
+
+# -------------- CPU side copy of assimp scenes --------------------------------
+class MeshData:
+    """ Vertex attributes, faces and skinning data of one mesh, with its
+        coarser levels of detail as (kept vertex ids, faces), see lod.py """
+    def __init__(self, vertices, tex_coords, normals, faces, material,
+                 bone_ids, bone_weights, bone_names=(), bone_offsets=(), lods=None):
+        self.vertices, self.tex_coords, self.normals = vertices, tex_coords, normals
+        self.faces, self.material = faces, material
+        self.bone_ids, self.bone_weights = bone_ids, bone_weights
+        self.bone_names, self.bone_offsets = list(bone_names), bone_offsets
+        self.lods = lod_levels(vertices, faces) if lods is None else lods
+
+
+class NodeData:
+    """ One node of the scene hierarchy """
+    def __init__(self, name, transform, meshes=(), children=()):
+        self.name, self.transform = name, transform
+        self.meshes, self.children = list(meshes), list(children)
+
+
+class SceneData:
+    """ Everything loaders need from an assimp scene, as plain python data """
+    def __init__(self, key, meshes, materials, root, channels, nb_animations):
+        self.key = key                      # (absolute file path, flags)
+        self.meshes, self.materials = meshes, materials
+        self.root = root                    # NodeData hierarchy
+        self.channels = channels            # node name -> TRS {time: value}
+        self.nb_animations = nb_animations
+
+
+# post-process flags shared by all our loaders, values of assimp's
+# postprocess.h: Triangulate | FlipUVs | GenSmoothNormals. Spelled out so
+# that assimpcy is only imported on a disk cache miss, see load_scene
+LOADER_FLAGS = 0x8 | 0x800000 | 0x40
+
+MATERIAL_KEYS = ('TEXTURE_BASE', 'COLOR_DIFFUSE', 'COLOR_SPECULAR',
+                 'COLOR_AMBIENT', 'SHININESS')
+
+
+def mesh_bone_weights(mesh):
+    """ Per vertex (ids, weights) arrays of the MAX_VERTEX_BONES main bones """
+    if not mesh.mBones:  # no skinning: all weights 0, skinned by model matrix
+        zeros = np.zeros((mesh.mNumVertices, MAX_VERTEX_BONES), 'f')
+        return zeros, zeros
+
+    # -- skinned mesh: weights given per bone => flat (vertex, bone, weight)
+    # triples gathered in one pass, then packed per vertex for GPU
+    if len(mesh.mBones) > MAX_BONES:  # ids would not fit in vertex attributes
+        print('WARNING: mesh of %d bones, only the first %d skin its vertices'
+              % (len(mesh.mBones), MAX_BONES))
+    bones = mesh.mBones[:MAX_BONES]
+    counts = [len(bone.mWeights) for bone in bones]
+    total = sum(counts)
+    vertex_ids = np.fromiter((entry.mVertexId for bone in bones
+                              for entry in bone.mWeights), np.int64, total)
+    weights = np.fromiter((entry.mWeight for bone in bones
+                           for entry in bone.mWeights), 'f4', total)
+    bone_ids = np.repeat(np.arange(len(bones)), counts)
+    return pack_bone_weights(vertex_ids, bone_ids, weights, mesh.mNumVertices)
+
+
+def _convert_scene(key, scene):
+    """ Copy the parts of an assimp scene used by our loaders """
+    def conv(assimp_keys, ticks_per_second):
+        """ Conversion from assimp key struct to our dict representation """
+        return {key.mTime / ticks_per_second: key.mValue for key in assimp_keys}
+
+    # load first animation in scene file (could be a loop over all animations)
+    channels = {}
+    if scene.mAnimations:
+        anim = scene.mAnimations[0]
+        for channel in anim.mChannels:
+            # for each animation bone, store TRS dict with {times: transforms}
+            channels[channel.mNodeName] = (
+                conv(channel.mPositionKeys, anim.mTicksPerSecond),
+                conv(channel.mRotationKeys, anim.mTicksPerSecond),
+                conv(channel.mScalingKeys, anim.mTicksPerSecond)
+            )
+
+    def make_node(node):
+        """ Recursively copies the node hierarchy """
+        return NodeData(node.mName, np.array(node.mTransformation, 'f'),
+                        node.mMeshes, (make_node(c) for c in node.mChildren))
+
+    meshes = []
+    for mesh in scene.mMeshes:
+        bone_ids, bone_weights = mesh_bone_weights(mesh)
+        meshes.append(MeshData(
+            np.asarray(mesh.mVertices, 'f'), np.asarray(mesh.mTextureCoords[0], 'f'),
+            np.asarray(mesh.mNormals, 'f'), np.asarray(mesh.mFaces, np.int32),
+            mesh.mMaterialIndex, bone_ids, bone_weights,
+            (bone.mName for bone in mesh.mBones),
+            np.array([bone.mOffsetMatrix for bone in mesh.mBones], 'f')))
+
+    materials = [{k: mat.properties[k] for k in MATERIAL_KEYS
+                  if k in mat.properties} for mat in scene.mMaterials]
+
+    return SceneData(key, meshes, materials, make_node(scene.mRootNode),
+                     channels, scene.mNumAnimations)
+
+
+# -------------- on-disk cache of imported scenes --------------------------------
+CACHE_DIR = '.asset_cache'  # set to None to always import with assimp
+CACHE_VERSION = 3           # bump when the stored layout changes
+MESH_ARRAYS = ('vertices', 'tex_coords', 'normals', 'faces', 'bone_ids',
+               'bone_weights', 'bone_offsets', 'bone_names')
+
+
+def _cache_path(key):
+    """ One directory of .npy files per (source file, post-process flags) """
+    name = hashlib.sha1(repr(key).encode()).hexdigest()
+    return os.path.join(CACHE_DIR, name)
+
+
+def _source_stamp(key):
+    """ Values which must match for a cache entry to be valid """
+    stat = os.stat(key[0])
+    return np.array((CACHE_VERSION, stat.st_mtime_ns, stat.st_size, key[1]),
+                    np.int64)
+
+
+def _scene_arrays(scene):
+    """ Flatten SceneData into a dict of named numpy arrays """
+    arrays = {'nb_animations': np.array(scene.nb_animations),
+              'mesh_materials': np.array([m.material for m in scene.meshes],
+                                         np.int64).reshape(-1)}
+    for i, mesh in enumerate(scene.meshes):
+        for name in MESH_ARRAYS:
+            arrays['mesh%d_%s' % (i, name)] = np.asarray(getattr(mesh, name))
+        kept, faces = zip(*mesh.lods) if mesh.lods else ((), ())
+        arrays['mesh%d_lod_counts' % i] = np.array(
+            [(len(k), len(f)) for k, f in mesh.lods], np.int64).reshape(-1, 2)
+        arrays['mesh%d_lod_kept' % i] = np.concatenate(kept or [[]]).astype(np.int64)
+        arrays['mesh%d_lod_faces' % i] = np.concatenate(
+            faces or [np.zeros((0, 3))]).astype(np.int32)
+    for i, material in enumerate(scene.materials):
+        for name, value in material.items():
+            arrays['material%d_%s' % (i, name)] = np.asarray(value)
+    arrays['nb_materials'] = np.array(len(scene.materials))
+
+    # node hierarchy in depth first order, with parent index of each node
+    names, parents, transforms, meshes, counts = [], [], [], [], []
+
+    def flatten(node, parent):
+        index = len(names)
+        names.append(node.name)
+        parents.append(parent)
+        transforms.append(node.transform)
+        meshes.extend(node.meshes)
+        counts.append(len(node.meshes))
+        for child in node.children:
+            flatten(child, index)
+    flatten(scene.root, -1)
+    arrays.update(node_names=np.array(names), node_parents=np.array(parents),
+                  node_transforms=np.array(transforms, 'f'),
+                  node_meshes=np.array(meshes, np.int64),
+                  node_mesh_counts=np.array(counts, np.int64))
+
+    # animation channels, keys of all channels concatenated
+    arrays['channel_names'] = np.array(list(scene.channels))
+    for j, kind in enumerate(('position', 'rotation', 'scaling')):
+        keys = [channel[j] for channel in scene.channels.values()]
+        arrays['channel_%s_counts' % kind] = np.array([len(k) for k in keys],
+                                                      np.int64)
+        arrays['channel_%s_times' % kind] = np.array(
+            [t for k in keys for t in k], np.float64)
+        arrays['channel_%s_values' % kind] = np.array(
+            [v for k in keys for v in k.values()], 'f')
+    return arrays
+
+
+def _scene_from_arrays(key, arrays):
+    """ Rebuild SceneData from named arrays (memory-mapped or not) """
+    meshes = [MeshData(*(arrays['mesh%d_%s' % (i, name)] for name in
+                         ('vertices', 'tex_coords', 'normals', 'faces')),
+                       material,
+                       *(arrays['mesh%d_%s' % (i, name)] for name in
+                         ('bone_ids', 'bone_weights')),
+                       arrays['mesh%d_bone_names' % i].tolist(),
+                       arrays['mesh%d_bone_offsets' % i], _lods_from_arrays(arrays, i))
+              for i, material in enumerate(arrays['mesh_materials'].tolist())]
+
+    materials = []
+    for i in range(int(arrays['nb_materials'])):
+        prefix = 'material%d_' % i
+        materials.append({name[len(prefix):]: value.item() if value.ndim == 0
+                          else value for name, value in arrays.items()
+                          if name.startswith(prefix)})
+
+    nodes, mesh_start = [], 0
+    for name, parent, transform, count in zip(
+            arrays['node_names'].tolist(), arrays['node_parents'].tolist(),
+            arrays['node_transforms'], arrays['node_mesh_counts'].tolist()):
+        mesh_ids = arrays['node_meshes'][mesh_start:mesh_start + count]
+        mesh_start += count
+        nodes.append(NodeData(name, transform, mesh_ids.tolist()))
+        if parent >= 0:
+            nodes[parent].children.append(nodes[-1])
+
+    split = {}
+    for kind in ('position', 'rotation', 'scaling'):
+        bounds = np.cumsum(arrays['channel_%s_counts' % kind])[:-1]
+        times = np.split(arrays['channel_%s_times' % kind], bounds)
+        values = np.split(arrays['channel_%s_values' % kind], bounds)
+        split[kind] = [dict(zip(t.tolist(), v)) for t, v in zip(times, values)]
+    channels = {name: (split['position'][i], split['rotation'][i],
+                       split['scaling'][i])
+                for i, name in enumerate(arrays['channel_names'].tolist())}
+
+    return SceneData(key, meshes, materials, nodes[0], channels,
+                     int(arrays['nb_animations']))
+
+
+def _lods_from_arrays(arrays, i):
+    """ levels of detail of mesh i, split from their concatenated arrays """
+    counts = arrays['mesh%d_lod_counts' % i]
+    kept = np.split(arrays['mesh%d_lod_kept' % i], np.cumsum(counts[:, 0])[:-1])
+    faces = np.split(arrays['mesh%d_lod_faces' % i], np.cumsum(counts[:, 1])[:-1])
+    return list(zip(kept, faces)) if len(counts) else []
+
+
+def _load_cached(key):
+    """ SceneData from disk cache if present and up to date, else None """
+    path = _cache_path(key)
+    try:
+        if not np.array_equal(np.load(os.path.join(path, 'stamp.npy')),
+                              _source_stamp(key)):
+            return None
+        arrays = {name[:-4]: np.load(os.path.join(path, name), mmap_mode='r')
+                  for name in os.listdir(path) if name.endswith('.npy')}
+        return _scene_from_arrays(key, arrays)
+    except (OSError, ValueError, KeyError):  # missing or unreadable entry
+        return None
+
+
+def _save_cached(key, scene):
+    """ Write scene to disk cache, atomically replacing a stale entry """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    arrays = _scene_arrays(scene)
+    arrays['stamp'] = _source_stamp(key)
+    work = tempfile.mkdtemp(dir=CACHE_DIR)
+    for name, array in arrays.items():
+        np.save(os.path.join(work, name + '.npy'), array, allow_pickle=False)
+    path = _cache_path(key)
+    shutil.rmtree(path, ignore_errors=True)
+    try:
+        os.rename(work, path)
+    except OSError:  # written concurrently by someone else, theirs is as good
+        shutil.rmtree(work, ignore_errors=True)
+
+
+# -------------- caches ----------------------------------------------------------
+_scenes = {}                                   # (path, flags) -> SceneData
+_vertex_arrays = weakref.WeakValueDictionary()  # (scene key, mesh, layout) -> VAO
+_textures = weakref.WeakValueDictionary()       # path -> Texture
+
+
+def load_scene(file, flags):
+    """ SceneData of file from disk cache, or assimp import, which is then
+        cached. Returns None if file cannot be loaded. """
+    key = (os.path.abspath(file), flags)
+    scene = _load_cached(key) if CACHE_DIR and os.path.exists(file) else None
+    if scene is None:
+        import assimpcy             # 3D resource loader, only when importing
+        try:
+            imported = assimpcy.aiImportFile(file, flags)
+        except assimpcy.all.AssimpError as exception:
+            print('ERROR loading', file + ': ', exception.args[0].decode())
+            return None
+        scene = _convert_scene(key, imported)
+        if CACHE_DIR:
+            _save_cached(key, scene)
+    return scene
+
+
+def import_scene(file, flags):
+    """ SceneData of file imported with assimp post-process flags, loaded
+        only once per process. Returns None if file cannot be loaded. """
+    key = (os.path.abspath(file), flags)
+    if key not in _scenes:
+        scene = load_scene(file, flags)
+        if scene is None:
+            return None
+        _scenes[key] = scene
+    return _scenes[key]
+
+
+def forget_scenes():
+    """ Drop CPU side scene copies once the scene is built, GPU resources
+        stay shared while used. Later loads read the disk cache again """
+    _scenes.clear()
+
+
+def shared_vertex_array(scene, mesh_id, layout, attributes, index=None,
+                        formats=None):
+    """ VertexArray for mesh_id of scene with given attribute layout name
+        and vertex formats, uploaded once then shared while a mesh uses it """
+    key = (scene.key, mesh_id, layout)
+    vertex_array = _vertex_arrays.get(key)
+    if vertex_array is None:
+        vertex_array = VertexArray(attributes, index, formats=formats)
+        vertex_array.source = (attributes, index)  # see release_sources
+        _vertex_arrays[key] = vertex_array
+    return vertex_array
+
+
+def release_sources():
+    """ Drop the CPU arrays kept with shared VertexArrays for batching, once
+        static meshes are merged (see batching.batch_static): only the GPU
+        copies stay alive """
+    for vertex_array in list(_vertex_arrays.values()):
+        vertex_array.source = None
+
+
+def shared_lod_vertex_arrays(scene, mesh_id, layout, attributes, formats=None):
+    """ Shared VertexArrays of the coarser levels of detail of mesh_id, their
+        attributes being the kept rows of full detail per vertex attributes """
+    nb_vertices = len(attributes[0])
+    vertex_arrays = []
+    for level, (kept, faces) in enumerate(scene.meshes[mesh_id].lods, 1):
+        level_attributes = [np.asarray(data)[kept] if data is not None
+                            and len(data) == nb_vertices else data
+                            for data in attributes]  # constants kept as is
+        vertex_arrays.append(shared_vertex_array(
+            scene, mesh_id, (layout, level), level_attributes, faces, formats))
+    return vertex_arrays
+
+
+def memory_report():
+    """ print GPU bytes of the vertex arrays in use, per asset file, and
+        what one float32 buffer per attribute and int32 indices would take """
+    files = {}
+    for (scene_key, _, _), vertex_array in list(_vertex_arrays.items()):
+        total = files.setdefault(os.path.basename(scene_key[0]), [0, 0])
+        total[0] += vertex_array.nbytes
+        total[1] += vertex_array.float_nbytes
+    for name, (nbytes, float_nbytes) in sorted(files.items()):
+        print('Vertex memory %-32s %8.1f KB\t(float32: %8.1f KB, %4.1f%% saved)'
+              % (name, nbytes / 1024, float_nbytes / 1024,
+                 100 * (1 - nbytes / max(float_nbytes, 1))))
+    nbytes, float_nbytes = map(sum, zip(*files.values())) if files else (0, 0)
+    print('Vertex memory %-32s %8.1f KB\t(float32: %8.1f KB)'
+          % ('total', nbytes / 1024, float_nbytes / 1024))
+
+
+def shared_texture(tex_file):
+    """ Texture for image file, decoded and uploaded once while in use """
+    key = os.path.abspath(tex_file)
+    texture = _textures.get(key)
+    if texture is None:
+        texture = Texture(tex_file=tex_file)
+        _textures[key] = texture
+    return texture
+
+
+def material_texture_files(file, scene, tex_file=None):
+    """ One image file name (or None) per material of scene, tex_file being
+        used for all materials when given, else searched near file """
+    # Note: embedded textures not supported at the moment
+    path = os.path.dirname(file) if os.path.dirname(file) != '' else './'
+    tex_files = []
+    for mat in scene.materials:
+        if not tex_file and 'TEXTURE_BASE' in mat:  # texture token
+            name = os.path.basename(mat['TEXTURE_BASE'])
+            # search texture in file's whole subdir since path often screwed up
+            paths = os.walk(path, followlinks=True)
+            found = [os.path.join(d, f) for d, _, n in paths for f in n
+                     if name.startswith(f) or f.startswith(name)]
+            assert found, 'Cannot find texture %s in %s subtree' % (name, path)
+            tex_file = found[0]
+        tex_files.append(tex_file)
+    return tex_files
+
+
+def material_textures(file, scene, tex_file=None):
+    """ One shared Texture (or None) per material of scene """
+    return [shared_texture(tex_file) if tex_file else None
+            for tex_file in material_texture_files(file, scene, tex_file)]
+
+
+# -------------- parallel loading pipeline ---------------------------------------
+class AssetHandle(Node):
+    """ Placeholder node for a queued load, filled with the loaded drawables
+        once the AssetLoader uploads them on the main thread """
+    def __init__(self, function, args, kwargs):
+        super().__init__()
+        self.function, self.args, self.kwargs = function, args, kwargs
+        self.ready = False
+
+    def resolve(self):
+        """ Run the loader: its CPU work is done, only GL uploads remain """
+        result = self.function(*self.args, **self.kwargs)
+        self.add(*(result if isinstance(result, (list, tuple)) else [result]))
+        self.ready = True
+
+
+class AssetLoader:
+    """ Two stage loading pipeline, active inside a with block. Scene files
+        are imported (assimp, bone weight packing) in worker processes and
+        images decoded in threads while the scene graph is being built; all
+        GL uploads then happen in one batch on the main thread, at exit. """
+    def __init__(self, processes=None, threads=None):
+        context = multiprocessing.get_context('spawn')  # no forked GL state
+        self.processes = ProcessPoolExecutor(processes, mp_context=context)
+        self.threads = ThreadPoolExecutor(threads)
+        self.lock = threading.Lock()  # prefetch against shutdown of threads
+        self.closed = False           # threads shut down, no more prefetches
+        self.scenes = {}   # scene key -> Future of SceneData
+        self.handles = []  # in request order
+
+    def request(self, function, args, kwargs, scene=None, images=()):
+        """ Queue function(*args, **kwargs), prefetching the given scene file
+            and images, return handle node resolved when leaving the block """
+        self._prefetch(images)
+        if scene is not None:
+            file, flags, tex_file = scene
+            key = (os.path.abspath(file), flags)
+            if key not in _scenes and key not in self.scenes:
+                cached = _load_cached(key) if CACHE_DIR and os.path.exists(file) else None
+                if cached is not None:  # memory-mapping beats a worker copy
+                    _scenes[key] = cached
+                    self._prefetch_textures(file, cached, tex_file)
+                else:
+                    future = self.processes.submit(load_scene, file, flags)
+                    future.add_done_callback(lambda done: self._prefetch_textures(
+                        file, None if done.exception() else done.result(), tex_file))
+                    self.scenes[key] = future
+        handle = AssetHandle(function, args, kwargs)
+        self.handles.append(handle)
+        return handle
+
+    def _prefetch_textures(self, file, scene, tex_file):
+        """ Scene imported: its material textures can now be decoded. May
+            run in a process pool thread, after the block has exited """
+        if scene is not None:
+            self._prefetch(image for image in
+                           material_texture_files(file, scene, tex_file) if image)
+
+    def _prefetch(self, images):
+        """ decode images in threads, unless they are shut down: loaders
+            then decode the images they need themselves """
+        with self.lock:
+            if not self.closed:
+                for image in images:
+                    prefetch_image(image, self.threads)
+
+    def _close_threads(self, cancel=False):
+        with self.lock:
+            self.closed = True
+        self.threads.shutdown(cancel_futures=cancel)
+
+    def finish(self):
+        """ Wait for workers then upload everything, resolving all handles """
+        for key, future in self.scenes.items():
+            scene = future.result()
+            if scene is not None:  # else loader prints error when resolved
+                _scenes[key] = scene
+        self.processes.shutdown()
+        for handle in self.handles:
+            handle.resolve()
+        self._close_threads()
+
+    def __enter__(self):
+        global _pipeline
+        _pipeline = self
+        return self
+
+    def __exit__(self, *exc_info):
+        global _pipeline
+        _pipeline = None
+        if exc_info[0] is None:
+            self.finish()
+        else:  # do not wait for uploads on error
+            self.processes.shutdown(cancel_futures=True)
+            self._close_threads(cancel=True)
+
+
+_pipeline = None  # active AssetLoader, if any
+
+
+def deferred(load, file, shader, tex_file=None, **kwargs):
+    """ Result of loader load(file, shader, tex_file, **kwargs), as a list.
+        Inside an AssetLoader block, file and textures are prefetched and the
+        list holds a single handle node, filled when the block exits. """
+    if _pipeline is None:
+        return load(file, shader, tex_file, **kwargs)
+    args = (file, shader, tex_file)
+    scene = (file, LOADER_FLAGS, tex_file)
+    images = (tex_file,) if tex_file else ()
+    return [_pipeline.request(load, args, kwargs, scene, images)]
+
+
+def deferred_call(function, *args, images=(), **kwargs):
+    """ Same as deferred for any function creating drawables from images """
+    if _pipeline is None:
+        result = function(*args, **kwargs)
+        return result if isinstance(result, (list, tuple)) else [result]
+    return [_pipeline.request(function, args, kwargs, images=images)]
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Load-time batching of static geometry.
+Meshes of a StaticBatch subtree that are drawn with the same state (mesh
+class, shader, texture and material) are pre-transformed into the batch's
+coordinates and merged into a single vertex array: one draw call per group
+instead of one per imported mesh. Levels of detail are merged level by
+level, the group then being drawn by a LODNode.
+"""
+# Python built-in modules
+import copy                         # merged meshes copy their draw state
+
+# External, non built-in modules
+import numpy as np                  # all matrix manipulations & OpenGL args
+
+from core import Node, Mesh, VertexArray, FLOAT, POSITION, NORMAL
+from lod import LODNode
+from transform import identity
+
+
+class StaticBatch(Node):
+    """ Node whose static meshes are merged by batch_static, once loaded """
+    def compile(self):
+        """ Replace our subtree by merged meshes, kept drawables stay live """
+        groups, kept = {}, []
+
+        def flatten(cur, model):
+            """ Collect (levels of detail, matrix relative to this batch)
+                records of mergeable meshes, (drawable, matrix) of others """
+            for child in cur.children:
+                chain = lod_chain(child)
+                if chain:
+                    groups.setdefault(batch_key(chain[0]), []).append(
+                        (chain, model @ getattr(child, 'transform', identity())))
+                elif isinstance(child, Node) and not child.dynamic and child.flattened:
+                    flatten(child, model @ child.transform)
+                else:
+                    kept.append((child, model))
+
+        flatten(self, identity())
+        merged = [merge_levels(group) for group in groups.values()]
+        kept = [Node([child], matrix) for child, matrix in kept]
+        size = sum(len(group) for group in groups.values())
+        print('Batched %d static meshes\t(%d draws)' % (size, len(merged)))
+        self.children = merged + kept
+
+
+def mergeable(drawable):
+    """ Meshes with CPU side arrays (see assets) and no bones can be merged """
+    return (isinstance(drawable, Mesh) and not getattr(drawable, 'bone_nodes', ())
+            and getattr(drawable.vertex_array, 'source', None) is not None)
+
+
+def lod_chain(drawable):
+    """ [mesh] if mergeable, meshes of a LODNode with one mergeable mesh per
+        level from full to coarse detail, else None """
+    if isinstance(drawable, LODNode):
+        chain = [level[0] for level in drawable.levels if len(level) == 1]
+        if len(chain) == len(drawable.levels) and all(map(mergeable, chain)):
+            return chain
+    elif mergeable(drawable):
+        return [drawable]
+    return None
+
+
+def batch_key(mesh):
+    """ Meshes drawn with equal state can share one draw call """
+    texture = mesh.texture.glid if mesh.texture else 0
+    return (type(mesh), mesh.shader.glid, texture, mesh.material())
+
+
+def transformed(loc, data, matrix):
+    """ attribute data at location loc, moved by matrix if a point or normal """
+    if loc == POSITION:
+        return data @ matrix[:3, :3].T + matrix[:3, 3]
+    if loc == NORMAL:  # inverse transpose, as the vertex shader does
+        normals = data @ np.linalg.inv(matrix[:3, :3])
+        lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+        return normals / np.maximum(lengths, 1e-12)
+    return data
+
+
+def merge_meshes(group):
+    """ One mesh drawing all (mesh, matrix) of group, vertices transformed.
+        Meshes of a group share their class, hence their attribute layout """
+    layout = group[0][0].vertex_array.source[0]
+    formats = group[0][0].vertex_array.formats or [FLOAT] * len(layout)
+    attributes = [[] if data is not None and stored is not None else None
+                  for data, stored in zip(layout, formats)]  # left out: None
+    indices, offset = [], 0
+    for mesh, matrix in group:
+        source, index = mesh.vertex_array.source
+        nb_vertices = len(source[POSITION])
+        for loc, data in enumerate(source):
+            if attributes[loc] is None:
+                continue
+            data = np.asarray(data, np.float32)
+            if len(data) != nb_vertices:  # constant placeholder attribute
+                data = np.zeros((nb_vertices, data.shape[1]), np.float32)
+            attributes[loc].append(transformed(loc, data, matrix))
+        index = np.arange(nb_vertices) if index is None else np.asarray(index)
+        indices.append(index.reshape(-1) + offset)
+        offset += nb_vertices
+
+    batched = copy.copy(group[0][0])  # same shader, texture and material
+    batched.vertex_array = VertexArray(
+        [np.concatenate(data) if data is not None else None
+         for data in attributes], np.concatenate(indices).astype(np.int32),
+        formats=group[0][0].vertex_array.formats)
+    return batched
+
+
+def merge_levels(group):
+    """ Merged mesh of (levels, matrix) group, LODNode of merged levels if
+        any has coarser levels, records with less levels reusing their last """
+    nb_levels = max(len(chain) for chain, _ in group)
+    levels = [merge_meshes([(chain[min(level, len(chain) - 1)], matrix)
+                            for chain, matrix in group])
+              for level in range(nb_levels)]
+    return levels[0] if nb_levels == 1 else LODNode([[mesh] for mesh in levels])
+
+
+def batch_static(node):
+    """ Compile every StaticBatch below node, call once assets are loaded """
+    if isinstance(node, StaticBatch):
+        node.compile()
+    for child in getattr(node, 'children', ()):
+        batch_static(child)
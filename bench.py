@@ -0,0 +1,439 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the viewer: micro benchmarks of its CPU heavy parts, and
+headless (EGL, no window) renders of the scene with a virtual clock.
+Usage: python3 bench.py <benchmark> [options], see python3 bench.py -h
+"""
+# Python built-in modules
+import os                           # headless OpenGL platform selection
+import sys                          # exit status of comparisons
+import argparse                     # command line parsing
+import timeit                       # repeatable timings
+import hashlib                      # rendered image fingerprints
+from time import perf_counter       # frame timings
+from collections import Counter     # CPU time per frame phase
+
+# PyOpenGL picks its platform on first import: EGL renders without a window
+# system, surfaceless where there is no X server (e.g. CI machines)
+os.environ.setdefault('PYOPENGL_PLATFORM', 'egl')
+os.environ.setdefault('EGL_PLATFORM', 'surfaceless')
+
+# External, non built-in modules
+import numpy as np                  # all matrix manipulations & OpenGL args
+
+from mesh_skinning import MAX_BONES, MAX_VERTEX_BONES, pack_bone_weights
+
+
+# -------------- bone weight packing ------------------------------------------
+def dense_pack_bone_weights(vertex_ids, bone_ids, weights, nb_vertices):
+    """ Previous loader path: MAX_BONES wide table per vertex, full sort """
+    v_bone = np.array([[(0, 0)]*MAX_BONES] * nb_vertices,
+                      dtype=[('weight', 'f4'), ('id', 'u4')])
+    for vertex_id, bone_id, weight in zip(vertex_ids, bone_ids, weights):
+        v_bone[vertex_id][bone_id] = (weight, bone_id)
+
+    v_bone.sort(order='weight')             # sort rows, high weights last
+    v_bone = v_bone[:, -MAX_VERTEX_BONES:]  # limit bone size, keep highest
+    return v_bone['id'], v_bone['weight']
+
+
+def random_skin(nb_vertices, nb_bones, influences, seed=0):
+    """ Flat (vertex, bone, weight) triples, like an elf mesh would give """
+    rng = np.random.default_rng(seed)
+    per_vertex = rng.integers(1, influences + 1, nb_vertices)
+    vertex_ids = np.repeat(np.arange(nb_vertices), per_vertex)
+    bone_ids = np.concatenate([rng.choice(nb_bones, n, replace=False)
+                               for n in per_vertex])
+    weights = rng.uniform(size=len(vertex_ids)).astype('f4')
+    order = np.argsort(bone_ids, kind='stable')  # assimp gives them per bone
+    return vertex_ids[order], bone_ids[order], weights[order]
+
+
+def bench_bones(args):
+    """ Compare vectorized and dense bone weight packing """
+    skin = random_skin(args.vertices, args.bones, args.influences)
+    nb_vertices = args.vertices
+
+    new = pack_bone_weights(*skin, nb_vertices)
+    old = dense_pack_bone_weights(*skin, nb_vertices)
+    same = all(np.array_equal(a, b) for a, b in zip(new, old))
+
+    def timing(function):
+        runs = timeit.repeat(lambda: function(*skin, nb_vertices),
+                             number=1, repeat=args.repeat)
+        return min(runs)
+
+    dense, packed = timing(dense_pack_bone_weights), timing(pack_bone_weights)
+    dense_bytes = nb_vertices * MAX_BONES * 8
+    packed_bytes = nb_vertices * max(args.influences, MAX_VERTEX_BONES) * 8
+    print('bone weights: %d vertices, %d bones, up to %d per vertex'
+          % (nb_vertices, args.bones, args.influences))
+    print('  dense     %8.2f ms\t(%d bytes table)' % (dense * 1e3, dense_bytes))
+    print('  packed    %8.2f ms\t(%d bytes table)' % (packed * 1e3, packed_bytes))
+    print('  speedup   %8.1fx, identical results: %s' % (dense / packed, same))
+
+
+# -------------- normal matrix: pixels against per-vertex inverse --------------
+# shader.vert before normal matrices were computed on the CPU, static meshes
+REFERENCE_VERT = """#version 330 core
+uniform mat4 model;
+layout(std140) uniform Frame {
+    mat4 view, projection, view_projection;
+    vec4 w_camera_position, light_dir;
+};
+layout(location = 0) in vec3 position;
+layout(location = 1) in vec2 texture_coord;
+layout(location = 4) in vec3 normal;
+out vec2 frag_tex_coords;
+out vec3 w_position, w_normal;
+
+void main() {
+    vec4 w_position4 = model * vec4(position, 1.0);
+    gl_Position = view_projection * w_position4;
+    frag_tex_coords = texture_coord;
+    w_position = w_position4.xyz / w_position4.w;
+    mat3 nit_matrix = transpose(inverse(mat3(model)));
+    w_normal = normalize(nit_matrix * normal);
+}"""
+
+
+def uv_sphere(rows=48, columns=96):
+    """ (positions, texture coordinates, normals, faces) of a unit sphere """
+    theta, phi = np.meshgrid(np.linspace(0, np.pi, rows),
+                             np.linspace(0, 2 * np.pi, columns), indexing='ij')
+    normals = np.stack((np.sin(theta) * np.cos(phi), np.cos(theta),
+                        np.sin(theta) * np.sin(phi)), -1).reshape(-1, 3)
+    tex_coords = np.stack((phi / (2 * np.pi), theta / np.pi), -1).reshape(-1, 2)
+    ids = np.arange(rows * columns).reshape(rows, columns)
+    a, b = ids[:-1, :-1].ravel(), ids[1:, :-1].ravel()
+    c, d = ids[1:, 1:].ravel(), ids[:-1, 1:].ravel()
+    faces = np.concatenate((np.stack((a, b, c), 1), np.stack((a, c, d), 1)))
+    return normals, tex_coords, normals, faces
+
+
+def bench_normals(args):
+    """ Render lit spheres, rotated and non uniformly scaled, with shader.vert
+        (normal matrix from Mesh.draw, then from instance attributes) and with
+        the per-vertex inverse it replaced; fail if pixels differ """
+    import OpenGL.GL as GL
+    from core import (Shader, FrameUniforms, VertexArray, InstanceMatrices,
+                      RIGID_FORMATS, BONE_IDS, BONE_WEIGHTS, gl_state)
+    from headless import Framebuffer, egl_context
+    from mesh_texture_illumination import IlluminationAndTexture
+    from transform import perspective, lookat, translate, rotate, scale, vec
+
+    width, height = args.size
+    egl_context(width, height)
+    target = Framebuffer(width, height)
+    GL.glEnable(GL.GL_DEPTH_TEST)
+    gl_state.reset()
+    GL.glVertexAttribI4ui(BONE_IDS, 0, 0, 0, 0)  # rigid meshes, as in Viewer
+    GL.glVertexAttrib4f(BONE_WEIGHTS, 0, 0, 0, 0)
+
+    class White:  # 1x1 texture: lighting alone is compared
+        glid = GL.glGenTextures(1)
+    gl_state.bind_texture(GL.GL_TEXTURE_2D, White.glid)
+    GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_RGBA, 1, 1, 0, GL.GL_RGBA,
+                    GL.GL_UNSIGNED_BYTE, np.full(4, 255, np.uint8))
+    GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER, GL.GL_NEAREST)
+
+    positions, tex_coords, normals, faces = uv_sphere()
+    vertex_array = VertexArray([positions, tex_coords, None, None, normals],
+                               faces, formats=RIGID_FORMATS)
+    models = [translate(-2.5, 0, 0) @ rotate((1, 1, 0), 40) @ scale(0.6, 1.4, 1),
+              translate(0, 0, 0) @ scale(1, 1, 1),
+              translate(2.5, 0, 0) @ rotate((0, 0, 1), -30) @ scale(1.5, 0.5, 0.8)]
+
+    frame = FrameUniforms()
+    view = lookat(vec(0, 1, 7), vec(0, 0, 0), vec(0, 1, 0))
+    projection = perspective(45, width / height, 0.1, 100)
+    frame.update(view, projection, (-0.3, -1, -0.5))
+
+    def render(shader, instanced=False):
+        mesh = IlluminationAndTexture(shader, White, vertex_array,
+                                      k_a=(0.05, 0.05, 0.05), k_d=(0.7, 0.6, 0.5),
+                                      k_s=(0.6, 0.6, 0.6), s=24)
+        GL.glClear(GL.GL_COLOR_BUFFER_BIT | GL.GL_DEPTH_BUFFER_BIT)
+        if instanced:
+            mesh.draw(projection, view, InstanceMatrices(models))
+        else:
+            for model in models:
+                mesh.draw(projection, view, model)
+        return target.read().astype(int)
+
+    reference = render(Shader(REFERENCE_VERT, 'shader.frag'))
+    shader = Shader('shader.vert', 'shader.frag')
+    worst = 0
+    print('normal matrix: %d spheres, %dx%d pixels, compared to per vertex inverse'
+          % (len(models), width, height))
+    for name, image in (('uniform', render(shader)),
+                        ('instanced', render(shader, instanced=True))):
+        difference = np.abs(image - reference).max(axis=2)
+        worst = max(worst, difference.max())
+        print('  %-10s max difference %3d/255, %d pixels above %d'
+              % (name, difference.max(), np.count_nonzero(difference > args.tolerance),
+                 args.tolerance))
+    lit = np.count_nonzero(reference[..., :3].sum(axis=2))
+    print('  %d lit pixels, identical within tolerance: %s'
+          % (lit, worst <= args.tolerance))
+    return int(worst > args.tolerance)
+
+
+def bench_normal_matrix(args):
+    """ Compare normal matrices as the vertex shader receives them to
+        inv(M).T of random models, without OpenGL context: the uniform one
+        of Mesh.draw and the instance attribute one of InstanceMatrices for
+        any affine model, mat3(M) of skinned vertices for rotations and
+        uniform scales (bones); fail if any direction differs """
+    from core import normal_matrix, instance_columns
+    from transform import translate, rotate, scale
+    rng = np.random.default_rng(args.seed)
+
+    def random_models(uniform):
+        models = []
+        for _ in range(args.models):
+            scales = rng.uniform(0.2, 3, 1 if uniform else 3)
+            models.append(translate(*rng.uniform(-10, 10, 3))
+                          @ rotate(rng.normal(size=3), rng.uniform(-180, 180))
+                          @ scale(*np.broadcast_to(scales, 3)))
+        return np.array(models, np.float32)
+
+    def directions(matrices, reference):
+        """ max distance of normals moved by matrices to reference ones """
+        normals = rng.normal(size=(len(matrices), 3, 1))
+        moved, expected = matrices @ normals, reference @ normals
+        return np.abs(moved / np.linalg.norm(moved, axis=1, keepdims=True)
+                      - expected / np.linalg.norm(expected, axis=1, keepdims=True)).max()
+
+    models = random_models(uniform=False)
+    reference = np.linalg.inv(models).transpose(0, 2, 1)[:, :3, :3]
+    columns = instance_columns(models)
+    bones = random_models(uniform=True)
+    errors = {
+        'uniform': directions(np.array([normal_matrix(m) for m in models]), reference),
+        # attribute floats are matrix columns, see shader.vert
+        'instanced': directions(columns[:, 16:].reshape(-1, 3, 3).transpose(0, 2, 1),
+                                reference),
+        'instance model': np.abs(columns[:, :16].reshape(-1, 4, 4).transpose(0, 2, 1)
+                                 - models).max(),
+        'skinned': directions(bones[:, :3, :3],
+                              np.linalg.inv(bones).transpose(0, 2, 1)[:, :3, :3]),
+    }
+    print('normal matrix: %d random models, compared to inv(M).T' % args.models)
+    for name, error in errors.items():
+        print('  %-15s max error %.2e' % (name, error))
+    worst = max(errors.values())
+    print('  identical within %g: %s' % (args.tolerance, worst <= args.tolerance))
+    return int(worst > args.tolerance)
+
+
+# -------------- headless scene replay -----------------------------------------
+def camera_path(trackball, t):
+    """ scripted camera at t in [0, 1]: one orbit around the island, zooming
+        from the castle out to the whole scene and back, gently bobbing """
+    from transform import quaternion_from_euler
+    trackball.rotation = quaternion_from_euler(
+        yaw=360 * t, pitch=25 + 10 * np.sin(4 * np.pi * t))
+    trackball.distance = 150 + 650 * (1 - np.cos(2 * np.pi * t)) / 2
+
+
+def bench_scene(args):
+    """ Render viewer.py's scene offscreen along camera_path, with a fixed
+        time step so that every run draws the same frames; report frame time
+        percentiles, CPU time per phase and hashes of some rendered images.
+        The first frames are then replayed from time 0: fail if any image
+        differs, the benchmark would not be deterministic """
+    if args.software:  # Mesa's llvmpipe, same pixels on every machine
+        os.environ['LIBGL_ALWAYS_SOFTWARE'] = '1'
+    import OpenGL.GL as GL
+    from core import Viewer, clock, render_queue
+    from profiler import profiler
+    from animation import animation_updater
+    from viewer import build_scene
+
+    clock.fixed(args.step)
+    animation_updater.enabled = args.animation == 'thread'
+    viewer = Viewer(*args.size, headless=True)
+    build_scene(viewer, crowd=args.crowd)
+    print('GL renderer:', GL.glGetString(GL.GL_RENDERER).decode())
+    if args.profile:  # no overlay: images stay comparable
+        profiler.enable(args.profile)
+
+    def digest():
+        return hashlib.sha1(viewer.target.read().tobytes()).hexdigest()
+
+    times, phases, counters, hashes, first = [], Counter(), Counter(), [], []
+    nb_frames = args.warmup + args.frames
+    for index in range(nb_frames):
+        camera_path(viewer.trackball, index / nb_frames)
+        start = perf_counter()
+        viewer.render(args.size)
+        finish = perf_counter()
+        GL.glFinish()  # wait for the GPU: frame time includes its work
+        end = perf_counter()
+        if index >= args.warmup:  # first frames compile shaders, fill caches
+            times.append(end - start)
+            phases.update(viewer.phase_times)
+            phases['gpu wait'] += end - finish
+            counters.update(render_queue.stats.get('counters', {}))
+        if args.hash_every and (index + 1) % args.hash_every == 0:
+            hashes.append((index, digest()))
+        if index < args.check:  # compared to their replay below
+            first.append(digest())
+
+    times = np.array(times) * 1e3
+    print('scene: %d frames (+%d warmup) at %dx%d, %.4f s per frame, %s animation'
+          % (args.frames, args.warmup, *args.size, args.step, args.animation))
+    print('  frame time  p50 %7.2f ms  p90 %7.2f ms  p99 %7.2f ms  max %7.2f ms'
+          % (*np.percentile(times, (50, 90, 99)), times.max()))
+    print('  mean %.2f ms, %.1f frames per second' % (times.mean(), 1e3 / times.mean()))
+    total = sum(phases.values())
+    for phase, duration in phases.items():
+        print('  %-12s %7.2f ms per frame  %5.1f%%'
+              % (phase, duration * 1e3 / args.frames, 100 * duration / total))
+    for name, count in sorted(counters.items()):
+        print('  %-24s %8.1f per frame' % (name, count / args.frames))
+    for index, digest in hashes:
+        print('  frame %5d  sha1 %s' % (index, digest))
+    if args.profile:
+        print('profiler, last frames:')
+        print('\n'.join('  ' + line for line in profiler.lines()))
+        profiler.disable()
+
+    # same clock and camera from the start: same images, or state leaks
+    # from frame to frame (e.g. a pose predicted for another time)
+    clock.fixed(args.step)
+    differing = []
+    for index, expected in enumerate(first):
+        camera_path(viewer.trackball, index / nb_frames)
+        viewer.render(args.size)
+        if digest() != expected:
+            differing.append(index)
+    if first:
+        print('  replay of frames 0 to %d: %s' % (len(first) - 1, 'identical'
+              if not differing else 'frames %s differ' % differing))
+    return int(bool(differing))
+
+
+# -------------- crowd animation: in process against worker processes ---------
+def random_rig(nb_bones, nb_clips, nb_keys=8, seed=0):
+    """ (clips, parents, rest, skins) of a synthetic rig for CrowdAnimation:
+        random hierarchy, every bone animated by random TransformKeyFrames """
+    from animation import TransformKeyFrames, SkeletonKeyFrames
+    from transform import quaternion_from_euler
+    rng = np.random.default_rng(seed)
+    parents = [-1] + [int(rng.integers(node)) for node in range(1, nb_bones)]
+    clips = []
+    for _ in range(nb_clips):
+        times = np.sort(rng.uniform(0, 2, nb_keys))
+        keyframes = [TransformKeyFrames(
+            {t: rng.uniform(-1, 1, 3) for t in times},
+            {t: quaternion_from_euler(*rng.uniform(-60, 60, 3)) for t in times},
+            {t: rng.uniform(0.8, 1.2) for t in times}) for _ in range(nb_bones)]
+        clips.append((SkeletonKeyFrames(keyframes), np.arange(nb_bones), times[-1]))
+    rest = np.repeat(np.identity(4, np.float32)[None], nb_bones, axis=0)
+    offsets = rest.copy()
+    offsets[:, :3, 3] = rng.uniform(-1, 1, (nb_bones, 3))
+    return clips, parents, rest, [(np.arange(nb_bones), offsets)]
+
+
+def bench_crowd(args):
+    """ Evaluate crowd poses in process then with pools of worker processes,
+        report time per frame and speedup; fail if any pose differs """
+    from crowd import CrowdAnimation
+    from transform import translate
+    rig = random_rig(args.bones, args.clips)
+    placements = [translate(i % 32, 0, i // 32) for i in range(args.characters)]
+    times = np.arange(args.frames) * args.step
+
+    def run(workers):
+        """ (seconds per frame, poses of the last frame) """
+        animation = CrowdAnimation(*rig, placements, workers=workers)
+        animation.launch(0.)  # workers started, caches filled
+        animation.wait()
+        start = perf_counter()
+        for time in times:
+            animation.launch(time)
+            animation.wait()
+        duration = (perf_counter() - start) / args.frames
+        poses = animation.skinning(0, slice(None)).copy()
+        animation.close()
+        return duration, poses
+
+    print('crowd: %d characters, %d bones, %d clips, %d frames, %d cores'
+          % (args.characters, args.bones, args.clips, args.frames, os.cpu_count()))
+    baseline, reference = run(0)
+    print('  in process %8.2f ms per frame' % (baseline * 1e3))
+    worst = 0.
+    for workers in args.workers:
+        duration, poses = run(workers)
+        worst = max(worst, np.abs(poses - reference).max())
+        print('  %2d workers %8.2f ms per frame, speedup %5.2fx'
+              % (workers, duration * 1e3, baseline / duration))
+    print('  max pose difference %g, identical results: %s' % (worst, worst == 0))
+    return int(worst != 0)
+
+
+# -------------- command line -------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    commands = parser.add_subparsers(dest='benchmark', required=True)
+
+    bones = commands.add_parser('bones', help='bone weight packing')
+    bones.add_argument('--vertices', type=int, default=20000)
+    bones.add_argument('--bones', type=int, default=60)
+    bones.add_argument('--influences', type=int, default=4)
+    bones.add_argument('--repeat', type=int, default=3)
+    bones.set_defaults(run=bench_bones)
+
+    normals = commands.add_parser('normals', help='normal matrix pixel comparison')
+    normals.add_argument('--size', type=int, nargs=2, default=(320, 240))
+    normals.add_argument('--tolerance', type=int, default=2)
+    normals.set_defaults(run=bench_normals)
+
+    normal_matrix = commands.add_parser('normal-matrix',
+                                        help='CPU normal matrices, no OpenGL context')
+    normal_matrix.add_argument('--models', type=int, default=1000)
+    normal_matrix.add_argument('--seed', type=int, default=0)
+    normal_matrix.add_argument('--tolerance', type=float, default=1e-4)
+    normal_matrix.set_defaults(run=bench_normal_matrix)
+
+    scene = commands.add_parser('scene', help='headless replay of viewer.py')
+    scene.add_argument('--frames', type=int, default=600)
+    scene.add_argument('--warmup', type=int, default=30)
+    scene.add_argument('--size', type=int, nargs=2, default=(1280, 720))
+    scene.add_argument('--step', type=float, default=1 / 60,
+                       help='virtual seconds per frame')
+    scene.add_argument('--hash-every', type=int, default=100,
+                       help='image hash period in frames, 0 for none')
+    scene.add_argument('--check', type=int, default=10,
+                       help='first frames replayed and compared, 0 for none')
+    scene.add_argument('--software', action='store_true',
+                       help='force Mesa software rendering')
+    scene.add_argument('--profile', metavar='CSV', nargs='?', const='profile.csv',
+                       help='enable the profiler, logging frames to CSV')
+    scene.add_argument('--animation', choices=('thread', 'inline'), default='thread',
+                       help='keyframes prepared by the animation updater thread'
+                            ' or evaluated while drawing')
+    scene.add_argument('--crowd', type=int, default=0,
+                       help='number of elves in an extra crowd')
+    scene.set_defaults(run=bench_scene)
+
+    crowd = commands.add_parser('crowd', help='crowd animation scaling with cores')
+    crowd.add_argument('--characters', type=int, default=500)
+    crowd.add_argument('--bones', type=int, default=60)
+    crowd.add_argument('--clips', type=int, default=3)
+    crowd.add_argument('--frames', type=int, default=100)
+    crowd.add_argument('--step', type=float, default=1 / 60,
+                       help='animation seconds per frame')
+    crowd.add_argument('--workers', type=int, nargs='+',
+                       default=sorted({1, 2, 4, os.cpu_count()}),
+                       help='pool sizes to compare to in process evaluation')
+    crowd.set_defaults(run=bench_crowd)
+
+    args = parser.parse_args()
+    sys.exit(args.run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,10 @@
 # Python built-in modules
 import os                           # os function, i.e. checking file status
 import sys                          # for sys.exit
+import ctypes                       # byte offsets in vertex buffers
+import weakref                      # caches which do not keep objects alive
+from time import perf_counter       # per phase frame timings
+from collections import Counter     # per frame statistics
 from itertools import cycle         # allows easy circular choice list
 
 # External, non built-in modules
@@ -9,10 +13,144 @@ import glfw                         # lean window system wrapper for OpenGL
 import numpy as np                  # all matrix manipulations & OpenGL args
 
 # our transform functions
-from transform import Trackball, identity, rotate
+from transform import (Trackball, identity, rotate, vec, bounding_sphere,
+                       transform_spheres, enclosing_sphere, frustum_planes,
+                       spheres_in_frustum)
+
+# frame profiler, pacing & quality, offscreen rendering, used by Viewer
+from profiler import profiler, GPUTimer
+from pacing import quality, FramePacer
+from headless import egl_context, Framebuffer
+
+
+# ------------ OpenGL state shadow, skips redundant state changes ------------
+class GLState:
+    """ Shadow of the bound program, textures and vertex array, and of the
+        uniform values last uploaded to each program. Every PyOpenGL call is a
+        Python to C crossing, calls that would not change anything are skipped.
+        Uploaded matrices are compared by identity: pass a new array when the
+        value changes, never modify an uploaded array in place. """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """ Forget all shadowed state, e.g. for a new OpenGL context """
+        self.program = None
+        self.vertex_array = None
+        self.unit = None       # active texture unit
+        self.textures = {}     # (unit, target) -> bound texture glid
+        self.uniforms = {}     # (program, location) -> last uploaded value
+
+    def use_program(self, glid):
+        if glid != self.program:
+            GL.glUseProgram(glid)
+            self.program = glid
+
+    def bind_vertex_array(self, glid):
+        if glid != self.vertex_array:
+            GL.glBindVertexArray(glid)
+            self.vertex_array = glid
+
+    def bind_texture(self, target, glid, unit=0):
+        if self.textures.get((unit, target)) != glid:
+            if unit != self.unit:
+                GL.glActiveTexture(GL.GL_TEXTURE0 + unit)
+                self.unit = unit
+            GL.glBindTexture(target, glid)
+            self.textures[unit, target] = glid
+
+    def _changed(self, location, value):
+        """ True if value must be uploaded at location of the bound program """
+        if location < 0:   # not an active uniform of this program
+            return False
+        key = (self.program, location)
+        if key in self.uniforms and self.uniforms[key] == value:
+            return False
+        self.uniforms[key] = value
+        return True
+
+    def uniform_1i(self, location, value):
+        if self._changed(location, int(value)):
+            GL.glUniform1i(location, value)
+
+    def uniform_1f(self, location, value):
+        if self._changed(location, float(value)):
+            GL.glUniform1f(location, value)
+
+    def uniform_3fv(self, location, value):
+        if self._changed(location, tuple(float(v) for v in value[:3])):
+            GL.glUniform3fv(location, 1, value)
+
+    def uniform_matrix(self, location, matrix):
+        """ one 4x4 or 3x3 matrix, or an array of them, row major """
+        if location >= 0 and self.uniforms.get((self.program, location)) is not matrix:
+            self.uniforms[self.program, location] = matrix
+            count = 1 if np.ndim(matrix) == 2 else len(matrix)
+            if np.shape(matrix)[-1] == 3:
+                GL.glUniformMatrix3fv(location, count, True, matrix)
+            else:
+                GL.glUniformMatrix4fv(location, count, True, matrix)
+
+    # OpenGL object destruction: their glid can be reused by new objects
+    def forget_program(self, glid):
+        self.uniforms = {k: v for k, v in self.uniforms.items() if k[0] != glid}
+        self.use_program(0)
+
+    def forget_vertex_array(self, glid):
+        if self.vertex_array == glid:
+            self.vertex_array = None
+
+    def forget_texture(self, glid):
+        self.textures = {k: v for k, v in self.textures.items() if v != glid}
+
+
+gl_state = GLState()   # single OpenGL context, see Viewer
+
+
+# ------------ per frame constants, shared by all shaders ------------------
+FRAME_BINDING = 0   # uniform buffer binding point of the "Frame" block
+PALETTE_UNIT = 1    # texture unit of the bone_palette buffer, see mesh_skinning
+
+
+class FrameUniforms:
+    """ Uniform buffer with the std140 "Frame" block of our shaders:
+            mat4 view, projection, view_projection;
+            vec4 w_camera_position, light_dir;    (xyz used)
+        filled once per frame, instead of once per mesh """
+    dtype = np.dtype([('view', 'f4', (4, 4)), ('projection', 'f4', (4, 4)),
+                      ('view_projection', 'f4', (4, 4)),
+                      ('w_camera_position', 'f4', 4), ('light_dir', 'f4', 4)])
+
+    def __init__(self):
+        self.data = np.zeros(1, self.dtype)
+        self.glid = GL.glGenBuffers(1)
+        GL.glBindBuffer(GL.GL_UNIFORM_BUFFER, self.glid)
+        GL.glBufferData(GL.GL_UNIFORM_BUFFER, self.dtype.itemsize, None,
+                        GL.GL_DYNAMIC_DRAW)
+        GL.glBindBufferBase(GL.GL_UNIFORM_BUFFER, FRAME_BINDING, self.glid)
+
+    def update(self, view, projection, light_dir):
+        """ compute and upload this frame's constants, GLSL is column major """
+        frame = self.data[0]
+        frame['view'] = view.T
+        frame['projection'] = projection.T
+        frame['view_projection'] = (projection @ view).T
+        frame['w_camera_position'] = np.linalg.inv(view)[:, 3]
+        frame['light_dir'][:3] = light_dir
+        GL.glBindBuffer(GL.GL_UNIFORM_BUFFER, self.glid)
+        GL.glBufferSubData(GL.GL_UNIFORM_BUFFER, 0, self.dtype.itemsize,
+                           self.data.view(np.float32))
+
+    def __del__(self):
+        GL.glDeleteBuffers(1, [self.glid])
 
 
 # ------------ low level OpenGL object wrappers ----------------------------
+INSTANCE_LOCATION = 5  # first of the 4 attribute locations of instance_model
+INSTANCE_NORMAL_LOCATION = 9  # first of the 3 of instance_normal_matrix
+INSTANCE_STRIDE = 100  # bytes per instance: mat4 model, then mat3 normal matrix
+
+
 class Shader:
     """ Helper class to create and automatically destroy shader program """
     @staticmethod
@@ -35,6 +173,7 @@ class Shader:
     def __init__(self, vertex_source, fragment_source):
         """ Shader can be initialized with raw strings or source file names """
         self.glid = None
+        self.locations = {}  # uniform name -> location, see uniform_location
         vert = self._compile_shader(vertex_source, GL.GL_VERTEX_SHADER)
         frag = self._compile_shader(fragment_source, GL.GL_FRAGMENT_SHADER)
         if vert and frag:
@@ -49,92 +188,585 @@ class Shader:
                 print(GL.glGetProgramInfoLog(self.glid).decode('ascii'))
                 sys.exit(1)
 
+            # per frame constants come from the FrameUniforms buffer
+            block = GL.glGetUniformBlockIndex(self.glid, 'Frame')
+            if block != GL.GL_INVALID_INDEX:
+                GL.glUniformBlockBinding(self.glid, block, FRAME_BINDING)
+
+            # bone matrices of skinned meshes come from a texture buffer,
+            # its sampler never shares unit 0 with diffuse_map
+            palette = self.uniform_location('bone_palette')
+            if palette >= 0:
+                gl_state.use_program(self.glid)
+                gl_state.uniform_1i(palette, PALETTE_UNIT)
+
+    def uniform_location(self, name):
+        """ location of uniform name, queried from OpenGL only once """
+        if name not in self.locations:
+            self.locations[name] = GL.glGetUniformLocation(self.glid, name)
+        return self.locations[name]
+
     def __del__(self):
-        GL.glUseProgram(0)
+        gl_state.forget_program(self.glid)
         if self.glid:                      # if this is a valid shader object
             GL.glDeleteProgram(self.glid)  # object dies => destroy GL object
 
 
+# ------------  Vertex formats: how attributes are stored in vertex buffers --
+class VertexFormat:
+    """ Storage of one vertex attribute: numpy component type and matching
+        OpenGL type, read by shaders as float, normalized or integer values
+        (glVertexAttribIPointer). pack converts float rows to stored rows
+        of size OpenGL components, e.g. for packed 10-10-10-2 normals. """
+    def __init__(self, dtype, gl_type, normalized=False, integer=False,
+                 pack=None, size=None):
+        self.dtype, self.gl_type = np.dtype(dtype), gl_type
+        self.normalized, self.integer = normalized, integer
+        self.pack, self.size = pack, size
+
+    def store(self, data):
+        """ (stored rows, number of OpenGL components) of attribute data """
+        if self.pack:
+            return self.pack(np.asarray(data, np.float32)), self.size
+        data = np.asarray(data)
+        if self.normalized and self.dtype.kind == 'u':  # [0, 1] to [0, max]
+            data = np.round(np.clip(data, 0, 1) * np.iinfo(self.dtype).max)
+        return data.astype(self.dtype), data.shape[1]
+
+
+def pack_2_10_10_10(vectors):
+    """ xyz in [-1, 1] as signed 10 bit integers of one uint32, w = 0 """
+    q = np.round(np.clip(vectors[:, :3], -1, 1) * 511).astype(np.int32) & 0x3FF
+    return (q[:, 0] | q[:, 1] << 10 | q[:, 2] << 20).astype(np.uint32)[:, None]
+
+
+FLOAT = VertexFormat('f4', GL.GL_FLOAT)
+HALF = VertexFormat('f2', GL.GL_HALF_FLOAT)
+UNORM8 = VertexFormat('u1', GL.GL_UNSIGNED_BYTE, normalized=True)
+UINT8 = VertexFormat('u1', GL.GL_UNSIGNED_BYTE, integer=True)
+UINT16 = VertexFormat('u2', GL.GL_UNSIGNED_SHORT, integer=True)
+NORMAL_2_10_10_10 = VertexFormat('u4', GL.GL_INT_2_10_10_10_REV, normalized=True,
+                                 pack=pack_2_10_10_10, size=4)
+
+# per location formats of shader.vert attributes: position, texture coords,
+# bone ids, bone weights, normal. None: attribute left out of the buffer,
+# rigid meshes read zero bone weights (see Viewer) and use their model matrix
+POSITION, TEX_COORD, BONE_IDS, BONE_WEIGHTS, NORMAL = range(5)
+SKINNED_FORMATS = (FLOAT, HALF, UINT8, UNORM8, NORMAL_2_10_10_10)
+RIGID_FORMATS = (FLOAT, HALF, None, None, NORMAL_2_10_10_10)
+
+
+def skinned_formats(nb_bones):
+    """ SKINNED_FORMATS, with uint16 bone ids for meshes of more than 256
+        bones, as VertexArray picks its index width by content """
+    if nb_bones <= 256:
+        return SKINNED_FORMATS
+    return SKINNED_FORMATS[:BONE_IDS] + (UINT16,) + SKINNED_FORMATS[BONE_IDS + 1:]
+
+
 class VertexArray:
     """ helper class to create and self destroy OpenGL vertex array objects."""
-    def __init__(self, attributes, index=None, usage=GL.GL_STATIC_DRAW):
+    def __init__(self, attributes, index=None, usage=GL.GL_STATIC_DRAW,
+                 formats=None):
         """ Vertex array from attributes and optional index array. Vertex
-            Attributes should be list of arrays with one row per vertex. """
+            Attributes should be list of arrays with one row per vertex,
+            stored interleaved in one buffer with per location formats
+            (default float32, None to leave an attribute out). """
 
         # create vertex array object, bind it
         self.glid = GL.glGenVertexArrays(1)
-        GL.glBindVertexArray(self.glid)
+        gl_state.bind_vertex_array(self.glid)
         self.buffers = []  # we will store buffers in a list
-        nb_primitives, size = 0, 0
+        self.instance_buffer = None  # see bind_instances
+        self.formats = formats
 
-        # load buffer per vertex attribute (in list with index = shader layout)
-        for loc, data in enumerate(attributes):
+        # one record per vertex, fields 4 byte aligned (in list index = layout)
+        formats = formats or [FLOAT] * len(attributes)
+        fields, offset, self.float_nbytes = [], 0, 0
+        for loc, (data, vertex_format) in enumerate(zip(attributes, formats)):
             if data is not None:
-                # bind a new vbo, upload its data to GPU, declare size and type
-                self.buffers.append(GL.glGenBuffers(1))
-                data = np.array(data, np.float32, copy=False)  # ensure format
-                nb_primitives, size = data.shape
-                GL.glEnableVertexAttribArray(loc)
-                GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.buffers[-1])
-                GL.glBufferData(GL.GL_ARRAY_BUFFER, data, usage)
-                GL.glVertexAttribPointer(loc, size, GL.GL_FLOAT, False, 0, None)
+                self.float_nbytes += np.size(data) * 4  # float32 buffer size
+            if data is not None and vertex_format is not None:
+                values, size = vertex_format.store(data)
+                fields.append((loc, vertex_format, values, size, offset))
+                row = values.itemsize * int(np.prod(values.shape[1:]))
+                offset += -(-row // 4) * 4
+        nb_primitives = len(fields[0][2]) if fields else 0
+        vertices = np.zeros(nb_primitives, np.dtype(dict(
+            names=['a%d' % field[0] for field in fields],
+            formats=[(values.dtype, values.shape[1:]) for _, _, values, _, _ in fields],
+            offsets=[field[-1] for field in fields], itemsize=offset or 4)))
+        for loc, _, values, _, _ in fields:
+            vertices['a%d' % loc] = values
+
+        # bind one vbo, upload its data to GPU, declare each attribute in it
+        if fields:
+            self.buffers.append(GL.glGenBuffers(1))
+            GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.buffers[-1])
+            GL.glBufferData(GL.GL_ARRAY_BUFFER, vertices.view(np.uint8), usage)
+        for loc, vertex_format, _, size, start in fields:
+            GL.glEnableVertexAttribArray(loc)
+            pointer = ctypes.c_void_p(start)
+            if vertex_format.integer:
+                GL.glVertexAttribIPointer(loc, size, vertex_format.gl_type,
+                                          offset, pointer)
+            else:
+                GL.glVertexAttribPointer(loc, size, vertex_format.gl_type,
+                                         vertex_format.normalized, offset, pointer)
+        self.nbytes = vertices.nbytes
+
+        # bounding sphere of positions (location 0), for frustum culling
+        has_position = len(attributes) and attributes[0] is not None
+        self.bounds = bounding_sphere(attributes[0]) if has_position else None
 
-        # optionally create and upload an index buffer for this object
+        # optionally create and upload an index buffer for this object,
+        # 16 bit indices when they fit
         self.draw_command = GL.glDrawArrays
+        self.draw_instanced = GL.glDrawArraysInstanced
         self.arguments = (0, nb_primitives)
         if index is not None:
             self.buffers += [GL.glGenBuffers(1)]
-            index_buffer = np.array(index, np.int32, copy=False)  # good format
+            short = nb_primitives <= 1 << 16
+            index_buffer = np.asarray(index, np.uint16 if short else np.uint32)
             GL.glBindBuffer(GL.GL_ELEMENT_ARRAY_BUFFER, self.buffers[-1])
             GL.glBufferData(GL.GL_ELEMENT_ARRAY_BUFFER, index_buffer, usage)
             self.draw_command = GL.glDrawElements
-            self.arguments = (index_buffer.size, GL.GL_UNSIGNED_INT, None)
+            self.draw_instanced = GL.glDrawElementsInstanced
+            index_type = GL.GL_UNSIGNED_SHORT if short else GL.GL_UNSIGNED_INT
+            self.arguments = (index_buffer.size, index_type, None)
+            self.nbytes += index_buffer.nbytes
+            self.float_nbytes += index_buffer.size * 4
 
-    def execute(self, primitive):
-        """ draw a vertex array, either as direct array or indexed array """
-        GL.glBindVertexArray(self.glid)
-        self.draw_command(primitive, *self.arguments)
+    def execute(self, primitive, instances=None):
+        """ draw a vertex array, either as direct array or indexed array,
+            optionally as many instances, see bind_instances """
+        gl_state.bind_vertex_array(self.glid)
+        if instances is None:
+            self.draw_command(primitive, *self.arguments)
+        else:
+            self.draw_instanced(primitive, *self.arguments, instances)
+
+    def bind_instances(self, buffer):
+        """ Per instance mat4 model at INSTANCE_LOCATION and mat3 normal
+            matrix at INSTANCE_NORMAL_LOCATION (one location per column)
+            read from buffer; only redone if another buffer of instances was
+            attached to this (shared) vertex array last """
+        gl_state.bind_vertex_array(self.glid)
+        if buffer != self.instance_buffer:
+            GL.glBindBuffer(GL.GL_ARRAY_BUFFER, buffer)
+            columns = [(INSTANCE_LOCATION + column, 4, 16 * column)
+                       for column in range(4)]
+            columns += [(INSTANCE_NORMAL_LOCATION + column, 3, 64 + 12 * column)
+                        for column in range(3)]
+            for loc, size, offset in columns:
+                GL.glEnableVertexAttribArray(loc)
+                GL.glVertexAttribPointer(loc, size, GL.GL_FLOAT, False,
+                                         INSTANCE_STRIDE, ctypes.c_void_p(offset))
+                GL.glVertexAttribDivisor(loc, 1)
+            self.instance_buffer = buffer
 
     def __del__(self):  # object dies => kill GL array and buffers from GPU
+        gl_state.forget_vertex_array(self.glid)
         GL.glDeleteVertexArrays(1, [self.glid])
         GL.glDeleteBuffers(len(self.buffers), self.buffers)
 
 
+class InstanceMatrices:
+    """ Model matrices of every placement of one mesh, drawn with a single
+        instanced call: local placements are kept, world matrices are
+        recomputed on update and uploaded to the GPU once per change """
+    def __init__(self, local):
+        self.local = np.array(local, np.float32).reshape(-1, 4, 4)
+        self.world = self.local
+        self.glid = GL.glGenBuffers(1)
+        self.uploaded = None   # world array currently in our GPU buffer
+
+    def __len__(self):
+        return len(self.local)
+
+    def update(self, model):
+        """ placements below the new parent world matrix model """
+        self.world = model @ self.local
+
+    def bind(self, vertex_array):
+        """ upload if changed, attach to vertex_array, return instance count """
+        if self.uploaded is not self.world:
+            columns = instance_columns(self.world)
+            GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.glid)
+            GL.glBufferData(GL.GL_ARRAY_BUFFER, columns, GL.GL_DYNAMIC_DRAW)
+            self.uploaded = self.world
+        vertex_array.bind_instances(self.glid)
+        return len(self.world)
+
+    def __del__(self):
+        GL.glDeleteBuffers(1, [self.glid])
+
+
+def instance_columns(world):
+    """ (N, 25) float32 instance attributes of (N, 4, 4) world matrices, GLSL
+        column major: columns of model, then of its normal matrix inv(M).T,
+        whose columns are the rows of inv(M) """
+    count = len(world)
+    return np.ascontiguousarray(np.hstack((
+        world.transpose(0, 2, 1).reshape(count, 16),
+        np.linalg.inv(world[:, :3, :3]).reshape(count, 9))), np.float32)
+
+
 # ------------  Mesh is a core drawable, can be basis for most objects --------
 class Mesh:
     """ Basic mesh class with attributes passed as constructor arguments """
+    bucket = 0        # render queue bucket, 0: opaque, sorted by state_key
+    texture = None    # texture bound by draw, if any
+    cull_late = False  # True: bounds only known once the scene is traversed
+    skinned = False    # True: bone matrices in the bone palette, see mesh_skinning
+
     def __init__(self, shader, attributes, index=None):
+        """ attributes is a list of arrays, or an already uploaded VertexArray
+            which is then shared with other meshes (see assets.py). View and
+            projection come from the per frame "Frame" uniform block. """
         self.shader = shader
-        names = ['view', 'projection', 'model']
-        self.loc = {n: GL.glGetUniformLocation(shader.glid, n) for n in names}
-        self.vertex_array = VertexArray(attributes, index)
+        names = ['model', 'normal_matrix', 'instanced']
+        self.loc = {n: shader.uniform_location(n) for n in names}
+        self._normal = (None, None)  # (model, its normal matrix) last drawn
+        if isinstance(attributes, VertexArray):
+            self.vertex_array = attributes
+        else:
+            self.vertex_array = VertexArray(attributes, index)
 
     def draw(self, projection, view, model, primitives=GL.GL_TRIANGLES):
-        GL.glUseProgram(self.shader.glid)
-
-        GL.glUniformMatrix4fv(self.loc['view'], 1, True, view)
-        GL.glUniformMatrix4fv(self.loc['projection'], 1, True, projection)
-        GL.glUniformMatrix4fv(self.loc['model'], 1, True, model)
+        """ model is a matrix, or InstanceMatrices to draw many placements """
+        gl_state.use_program(self.shader.glid)
+        if isinstance(model, InstanceMatrices):
+            instances = model.bind(self.vertex_array)
+            gl_state.uniform_1i(self.loc['instanced'], 1)
+        else:
+            instances = None
+            gl_state.uniform_1i(self.loc['instanced'], 0)
+            gl_state.uniform_matrix(self.loc['model'], model)
+            if model is not self._normal[0]:  # once per model, not per vertex
+                self._normal = (model, normal_matrix(model))
+            gl_state.uniform_matrix(self.loc['normal_matrix'], self._normal[1])
 
         # draw triangle as GL_TRIANGLE vertex array, draw array call
-        self.vertex_array.execute(primitives)
+        self.vertex_array.execute(primitives, instances)
+
+    def material(self):
+        """ hashable uniform values set by draw besides model, if any """
+        return ()
+
+    def sphere(self):
+        """ bounding sphere (x, y, z, radius) in model coordinates or None """
+        return self.vertex_array.bounds
+
+    def world_sphere(self, model):
+        """ bounding sphere for this frame's model, or None if unknown """
+        sphere = self.sphere()
+        if sphere is None:
+            return None
+        if isinstance(model, InstanceMatrices):
+            return enclosing_sphere(transform_spheres(model.world, sphere))
+        return transform_spheres(model, sphere)
+
+    def state_key(self):
+        """ (program, texture, vertex array, material) bound by draw """
+        texture = self.texture.glid if self.texture else 0
+        return (self.shader.glid, texture, self.vertex_array.glid,
+                self.material())
+
+
+# ------------  Two phase rendering: collect draws, then sort and submit -----
+class RenderQueue:
+    """ Scene traversal queues meshes with their model matrix, submit then
+        issues them sorted by state key so that programs, textures, vertex
+        arrays and materials are bound once per group rather than following
+        scene graph order. Opaque meshes are sorted by state then front to
+        back depth, other buckets (e.g. skybox) are drawn after, in order.
+        While collecting, bounded subtrees and meshes outside of the view
+        frustum are culled, see visible and cull. """
+    def __init__(self):
+        self.collecting = False
+        self.culling = True
+        self.planes = None       # this frame's frustum planes, if culling
+        self.camera = None       # this frame's camera world position
+        self.frame = 0           # frame number, incremented by begin
+        self.culled = 0          # meshes culled this frame
+        self.counters = Counter()  # other per frame counts, e.g. animations
+        self.items = []          # (bucket, mesh, model) in traversal order
+        self.keys = weakref.WeakKeyDictionary()  # mesh -> interned state key
+        self.materials = {}      # material values -> small int id
+        self.stats = {}          # state changes of last frame, see count_changes
+        self.before_submit = []  # f(meshes) once late culled, e.g. bone palette
+        self.on_begin = []       # f() when collecting starts, e.g. animation
+
+    def state_key(self, mesh):
+        """ mesh state key, with materials interned as ints: cheap to sort """
+        if mesh not in self.keys:
+            *state, material = mesh.state_key()
+            material = self.materials.setdefault(material, len(self.materials))
+            self.keys[mesh] = (*state, material)
+        return self.keys[mesh]
+
+    def draw(self, drawable, projection, view, model):
+        """ Queue meshes while collecting, anything else is drawn now """
+        if self.collecting and isinstance(drawable, Mesh):
+            self.items.append((drawable.bucket, drawable, model))
+        else:
+            drawable.draw(projection, view, model)
+
+    def begin(self, projection=None, view=None):
+        """ Start collecting, culling against projection @ view if given """
+        self.collecting = True
+        self.items, self.culled, self.counters = [], 0, Counter()
+        self.frame += 1
+        for start in self.on_begin:
+            start()
+        if view is not None:
+            self.camera = np.linalg.inv(view)[:3, 3]
+        if self.culling and projection is not None:
+            self.planes = frustum_planes(projection @ view)
+        else:
+            self.planes = None
+
+    def cull(self, spheres, counts=None):
+        """ Visibility mask of (N,4) world spheres, culled ones are counted
+            with their number of meshes (default 1 each) """
+        if self.planes is None:
+            return np.ones(len(spheres), bool)
+        visible = spheres_in_frustum(self.planes, spheres)
+        hidden = ~visible
+        self.culled += int(hidden.sum() if counts is None else counts[hidden].sum())
+        return visible
+
+    def visible(self, node, world):
+        """ False if node content is known to be outside the view frustum """
+        sphere = node.bounds() if self.planes is not None else None
+        if sphere is None:
+            return True
+        sphere = transform_spheres(world, sphere)
+        return self.cull(sphere[None], np.array([node.nb_meshes()]))[0]
+
+    def submit(self, projection, view):
+        """ Sort queued meshes, draw them, record state change counts """
+        self.collecting = False
+        if self.planes is not None:  # e.g. skinned meshes: bones now updated
+            self.items = [item for item in self.items
+                          if not item[1].cull_late or self.late_visible(*item[1:])]
+        for prepare in self.before_submit:
+            prepare([mesh for _, mesh, _ in self.items])
+        depth_row = -view[2]   # distance along view direction of a point
+        states = [self.state_key(mesh) for _, mesh, _ in self.items]
+        keyed = [(bucket, state, depth_row @ position(model), index) if bucket == 0
+                 else (bucket, (), index, index)
+                 for index, ((bucket, _, model), state)
+                 in enumerate(zip(self.items, states))]
+        order = [key[-1] for key in sorted(keyed)]
+
+        self.stats = dict(items=len(states), culled=self.culled,
+                          counters=self.counters,
+                          drawn=sum(instance_count(m) for _, _, m in self.items),
+                          unsorted=count_changes(states),
+                          sorted=count_changes([states[i] for i in order]))
+
+        for index in order:
+            _, mesh, model = self.items[index]
+            mesh.draw(projection, view, model)
+        self.items = []
+
+    def late_visible(self, mesh, model):
+        sphere = mesh.world_sphere(model)
+        return sphere is None or self.cull(sphere[None])[0]
+
+    def report(self):
+        """ print last frame state change counts, traversal vs sorted order,
+            and culling counts """
+        print('Render queue culling %4d meshes drawn, %d culled'
+              % (self.stats.get('drawn', 0), self.stats.get('culled', 0)))
+        for name, count in sorted(self.stats.get('counters', {}).items()):
+            print('Render queue %-24s %4d' % (name, count))
+        names = ('program', 'texture', 'vertex array', 'material')
+        for name in ('unsorted', 'sorted'):
+            changes = self.stats.get(name, np.zeros(4, int))
+            detail = ', '.join('%s %d' % pair for pair in zip(names, changes))
+            print('Render queue %-8s %4d state changes\t(%d draws: %s)'
+                  % (name, changes.sum(), self.stats.get('items', 0), detail))
+
+
+def normal_matrix(model):
+    """ inverse transpose of the linear part of model, moves normals """
+    return np.linalg.inv(model[:3, :3]).T
+
+
+def position(model):
+    """ world position of a model matrix, or of a first instance """
+    if isinstance(model, InstanceMatrices):
+        model = model.world[0]
+    return model[:, 3]
+
+
+def instance_count(model):
+    return len(model) if isinstance(model, InstanceMatrices) else 1
+
+
+def count_changes(states):
+    """ per key field number of changes along a list of state keys """
+    if not states:
+        return np.zeros(4, int)
+    states = np.array(states)
+    return 1 + np.count_nonzero(states[1:] != states[:-1], axis=0)
+
+
+render_queue = RenderQueue()
+
+
+# ------------  Animation clock, wall clock or fixed step virtual time -------
+class Clock:
+    """ Time read by all animated nodes, constant during a frame and only
+        advanced by step(), once per rendered frame. With a fixed step it is
+        virtual, so that every run renders the same frames. Else it follows
+        glfw's wall clock: each frame is drawn at the time predicted for it
+        by next_time() during the previous frame, ahead by the duration of
+        the last measured frame, so values prepared for it are exact. """
+    def __init__(self):
+        self.step_size = None  # seconds per frame if virtual
+        self.virtual_time = 0.0
+        self.frame_time = None  # wall clock time of this frame, see step
+        self.last_step, self.frame_duration = None, 1 / 60  # wall clock
+        self.epoch = 0  # incremented when time jumps: poses from before are stale
+
+    def fixed(self, step_size):
+        """ switch to virtual time from 0, advancing step_size per frame """
+        self.step_size, self.virtual_time = step_size, 0.0
+        self.epoch += 1
+
+    def time(self):
+        if self.step_size is not None:
+            return self.virtual_time
+        if self.frame_time is None:  # first frame: sampled once
+            self.frame_time = glfw.get_time()
+        return self.frame_time
+
+    def set(self, time):
+        if self.step_size is None:
+            glfw.set_time(time)
+            self.frame_time, self.last_step = time, None
+        else:
+            self.virtual_time = time
+        self.epoch += 1
+
+    def step(self):
+        """ next frame: advance virtual time, or go to the predicted time
+            and measure the last frame for the next prediction. Prediction
+            errors do not add up: time stays within a frame of the wall clock """
+        if self.step_size is not None:
+            self.virtual_time += self.step_size
+        else:
+            self.frame_time = self.next_time()
+            now = glfw.get_time()
+            if self.last_step is not None and now > self.last_step:
+                self.frame_duration = now - self.last_step
+            self.last_step = now
+
+    def next_time(self):
+        """ time of next frame, at which step() puts it: fixed step if
+            virtual, else the duration of the last measured frame """
+        return self.time() + (self.step_size or self.frame_duration)
+
+
+clock = Clock()
+
+
+# ------------  Profiled functions, see profiler.py -----------------------------
+profiler.instrument(FrameUniforms, 'update', 'frame uniforms')
+profiler.instrument(GLState, 'uniform_1i', 'uniform uploads')
+profiler.instrument(GLState, 'uniform_1f', 'uniform uploads')
+profiler.instrument(GLState, 'uniform_3fv', 'uniform uploads')
+profiler.instrument(GLState, 'uniform_matrix', 'uniform uploads')
+profiler.count_draws(VertexArray, 'execute')
 
 
 # ------------  Node is the core drawable for hierarchical scene graphs -------
 class Node:
     """ Scene graph transform and parameter broadcast node """
+    dynamic = False  # True if transform or children change after creation
+    flattened = True  # False: static, but drawn by its own draw (e.g. LODNode)
+
     def __init__(self, children=(), transform=identity()):
+        self.world_transform = None  # cached model @ transform
+        self._parent_world = None    # model matrix the cache was built from
+        self._bounds = None          # cached (sphere, number of meshes)
         self.transform = transform
         self.children = list(iter(children))
 
+    @property
+    def children(self):
+        """ Drawables of this node """
+        return self._children
+
+    @children.setter
+    def children(self, children):
+        """ Replacing our children (e.g. Elf action change) invalidates our
+            cached bounds """
+        self._children = children
+        self._bounds = None
+
+    @property
+    def transform(self):
+        """ Local transform of this node, relative to its parent """
+        return self._transform
+
+    @transform.setter
+    def transform(self, transform):
+        """ Changing our transform invalidates our cached world transform """
+        self._transform = transform
+        self._dirty = True
+
     def add(self, *drawables):
         """ Add drawables to this node, simply updating children list """
         self.children.extend(drawables)
+        self._bounds = None
+
+    def bounds(self):
+        """ Sphere containing our drawables, in the coordinates they are drawn
+            in (after our transform), None if unknown or changing. Computed
+            once our children are there, again if add or assigning children
+            changes them; children must not be modified in place. """
+        if self._bounds is None:
+            spheres = [child_sphere(child) for child in self.children]
+            known = all(sphere is not None for sphere in spheres)
+            self._bounds = (enclosing_sphere(spheres) if known else None,
+                            sum(count_meshes(child) for child in self.children))
+        return self._bounds[0]
+
+    def nb_meshes(self):
+        """ number of meshes drawn by this subtree, for culling statistics """
+        self.bounds()
+        return self._bounds[1]
+
+    def invalidate(self):
+        """ Force world transform recomputation for this whole subtree """
+        self._dirty = True
+        for child in self.children:
+            if isinstance(child, Node):
+                child.invalidate()
+
+    def update_world(self, model):
+        """ Cached world transform, only recomputed if our transform or the
+            parent world matrix changed. Parents hand down their cached matrix
+            object, so a new object means an ancestor changed: children of a
+            moved node recompute, static subtrees cost no matrix product. """
+        if self._dirty or model is not self._parent_world:
+            self.world_transform = model @ self._transform
+            self._parent_world = model
+            self._dirty = False
+        return self.world_transform
 
     def draw(self, projection, view, model):
         """ Recursive draw, passing down updated model matrix. """
+        world = self.update_world(model)
+        if not render_queue.visible(self, world):  # whole subtree off screen
+            return
         for child in self.children:
-            child.draw(projection, view, model @ self.transform) # réponse Q1
+            render_queue.draw(child, projection, view, world) # réponse Q1
 
     def key_handler(self, key):
         """ Dispatch keyboard events to children """
@@ -143,46 +775,181 @@ class Node:
                 child.key_handler(key)
 
 
+UNBOUNDED = vec(0, 0, 0, np.inf)  # sphere of drawables which are never culled
+
+
+def child_sphere(child):
+    """ bounding sphere of a child in the coordinates of its parent's content,
+        None for dynamic nodes and drawables without known bounds """
+    if isinstance(child, Mesh):
+        return child.sphere()
+    if isinstance(child, Node) and not child.dynamic:
+        sphere = child.bounds()
+        return None if sphere is None else transform_spheres(child.transform, sphere)
+    return None
+
+
+def count_meshes(child):
+    """ number of meshes drawn by child """
+    if isinstance(child, Node):
+        return child.nb_meshes()
+    return int(isinstance(child, Mesh))
+
+
+class FrozenNode(Node):
+    """ Static subtree compiled into a flat render list: one record per mesh
+        or dynamic node, all record matrices stored in one (N,4,4) array.
+        Meshes placed several times become one record of InstanceMatrices,
+        drawn with a single instanced call. """
+    def __init__(self, node):
+        super().__init__()
+        placements = {}  # drawable -> its world matrices, in traversal order
+
+        def flatten(cur, model):
+            """ Collect (world matrix, drawable) records relative to node """
+            world = model @ cur.transform
+            for child in cur.children:
+                if isinstance(child, Node) and not child.dynamic and child.flattened:
+                    flatten(child, world)
+                else:  # meshes and dynamic subtrees stay live drawables
+                    placements.setdefault(child, []).append(world)
+
+        flatten(node, identity())
+        matrices, self.instances = [], []
+        for child, worlds in placements.items():
+            if isinstance(child, Mesh) and len(worlds) > 1:
+                self.instances.append((child, InstanceMatrices(worlds)))
+            else:  # dynamic nodes keep one record per placement
+                matrices += worlds
+                self.children += [child] * len(worlds)
+        self.matrices = np.array(matrices, np.float32).reshape(-1, 4, 4)
+        self.models = []  # per record world matrices, cached between frames
+        self._frozen_world = None
+
+        # bounding spheres of records, then of instance groups, frozen too
+        def sphere_array(spheres):
+            return np.array([UNBOUNDED if sphere is None else sphere
+                             for sphere in spheres], np.float32).reshape(-1, 4)
+
+        records = sphere_array(child_sphere(child) for child in self.children)
+        groups = sphere_array(
+            None if mesh.sphere() is None else
+            enclosing_sphere(transform_spheres(instances.local, mesh.sphere()))
+            for mesh, instances in self.instances)
+        self.spheres = np.concatenate(
+            (transform_spheres(self.matrices, records), groups))
+        self.counts = np.array([count_meshes(child) for child in self.children]
+                               + [len(instances) for _, instances in self.instances])
+        self.world_spheres = self.spheres
+
+    def draw(self, projection, view, model):
+        """ Iterate over the flat list instead of recursing """
+        world = self.update_world(model)
+        if world is not self._frozen_world:  # ancestor moved: one batched @
+            self.models = list(world @ self.matrices)
+            for _, instances in self.instances:
+                instances.update(world)
+            self.world_spheres = transform_spheres(world, self.spheres)
+            self._frozen_world = world
+        visible = render_queue.cull(self.world_spheres, self.counts)
+        for child, matrix, shown in zip(self.children, self.models, visible):
+            if shown:
+                render_queue.draw(child, projection, view, matrix)
+        for (mesh, instances), shown in zip(self.instances, visible[len(self.children):]):
+            if shown:
+                render_queue.draw(mesh, projection, view, instances)
+
+
+class Instances(Node):
+    """ Many placements of the same drawables: place() adds one. Once frozen,
+        each mesh is drawn once for all placements with hardware instancing """
+    def __init__(self, drawables, transform=identity()):
+        super().__init__(transform=transform)
+        self.drawables = list(drawables)
+
+    def place(self, transform):
+        """ add a placement of our drawables, relative to this node """
+        self.add(Node(self.drawables, transform))
+        return self
+
+
+def freeze(node):
+    """ Collapse static subtree of node in a FrozenNode, dynamic nodes such as
+        keyframe, skinning or rotation control nodes are kept live inside """
+    return node if node.dynamic or not node.flattened else FrozenNode(node)
+
+
 class RotationControlNode(Node):
+    dynamic = True
+
     def __init__(self, key_up, key_down, axis, angle=0):
         super().__init__(transform=rotate(axis, angle))
         self.angle, self.axis = angle, axis
         self.key_up, self.key_down = key_up, key_down
 
     def key_handler(self, key):
-        self.angle += 5 * int(key == self.key_up)
-        self.angle -= 5 * int(key == self.key_down)
-        self.transform = rotate(self.axis, self.angle)
+        if key in (self.key_up, self.key_down):  # only then is subtree dirty
+            self.angle += 5 * int(key == self.key_up)
+            self.angle -= 5 * int(key == self.key_down)
+            self.transform = rotate(self.axis, self.angle)
         super().key_handler(key)
 
 
 # ------------  Viewer class & window management ------------------------------
 class Viewer(Node):
-    """ GLFW viewer window, with classic initialization & graphics loop """
+    """ GLFW viewer window, with classic initialization & graphics loop.
+        Headless viewers have no window: they draw into an offscreen
+        Framebuffer (self.target) of an EGL context, frame by frame with
+        render(), e.g. for benchmarks (see bench.py scene). The run loop is
+        paced and adapts quality to the frame budget, see FramePacer. """
 
-    def __init__(self, width=640, height=480):
+    def __init__(self, width=640, height=480, headless=False, target_fps=60):
         super().__init__()
+        self.headless, self.win = headless, None
+        self.root_model = identity()  # same root matrix each frame keeps caches valid
+        self.phase_times = {}         # CPU seconds per phase of last frame
+        self.gpu_timer, self.gpu_time = GPUTimer(), None  # if profiled or paced
+        self.pacer = None if headless else FramePacer(1 / target_fps)
+        self.scaled = None            # Framebuffer below full resolution
+
+        if headless:
+            self.context = egl_context(width, height)
+            if clock.step_size is None:  # no glfw timer without window system
+                clock.fixed(1 / 60)
+        else:
+            # version hints: create GL window with >= OpenGL 3.3 and core profile
+            glfw.window_hint(glfw.CONTEXT_VERSION_MAJOR, 3)
+            glfw.window_hint(glfw.CONTEXT_VERSION_MINOR, 3)
+            glfw.window_hint(glfw.OPENGL_FORWARD_COMPAT, GL.GL_TRUE)
+            glfw.window_hint(glfw.OPENGL_PROFILE, glfw.OPENGL_CORE_PROFILE)
+            glfw.window_hint(glfw.RESIZABLE, True)
+            self.win = glfw.create_window(width, height, 'Viewer', None, None)
+
+            # make win's OpenGL context current; no OpenGL calls can happen before
+            glfw.make_context_current(self.win)
+            self.pacer.set_vsync(self.pacer.vsync)
+        gl_state.reset()
 
-        # version hints: create GL window with >= OpenGL 3.3 and core profile
-        glfw.window_hint(glfw.CONTEXT_VERSION_MAJOR, 3)
-        glfw.window_hint(glfw.CONTEXT_VERSION_MINOR, 3)
-        glfw.window_hint(glfw.OPENGL_FORWARD_COMPAT, GL.GL_TRUE)
-        glfw.window_hint(glfw.OPENGL_PROFILE, glfw.OPENGL_CORE_PROFILE)
-        glfw.window_hint(glfw.RESIZABLE, True)
-        self.win = glfw.create_window(width, height, 'Viewer', None, None)
+        # value of attributes left out of vertex arrays (see RIGID_FORMATS):
+        # no bone weights, vertices are only moved by the model matrix
+        GL.glVertexAttribI4ui(BONE_IDS, 0, 0, 0, 0)
+        GL.glVertexAttrib4f(BONE_WEIGHTS, 0, 0, 0, 0)
 
-        # make win's OpenGL context current; no OpenGL calls can happen before
-        glfw.make_context_current(self.win)
+        # per frame constants: camera and the directional light (world coords)
+        self.frame = FrameUniforms()
+        self.light_dir = (0, -1, 0)
 
         # initialize trackball
         self.trackball = Trackball()
         self.mouse = (0, 0)
 
-        # register event handlers
-        glfw.set_key_callback(self.win, self.on_key)
-        glfw.set_cursor_pos_callback(self.win, self.on_mouse_move)
-        glfw.set_scroll_callback(self.win, self.on_scroll)
-        glfw.set_window_size_callback(self.win, self.on_size)
+        if headless:  # same size as the pbuffer, which is never drawn to
+            self.target = Framebuffer(width, height)
+        else:  # register event handlers
+            glfw.set_key_callback(self.win, self.on_key)
+            glfw.set_cursor_pos_callback(self.win, self.on_mouse_move)
+            glfw.set_scroll_callback(self.win, self.on_scroll)
+            glfw.set_window_size_callback(self.win, self.on_size)
 
         # useful message to check OpenGL renderer characteristics
         print('OpenGL', GL.glGetString(GL.GL_VERSION).decode() + ', GLSL',
@@ -197,21 +964,78 @@ class Viewer(Node):
         # cyclic iterator to easily toggle polygon rendering modes
         self.fill_modes = cycle([GL.GL_LINE, GL.GL_POINT, GL.GL_FILL])
 
+    def render(self, size):
+        """ Draw one frame for a window of size (width, height), then
+            advance the clock if virtual. CPU time of each phase is kept in
+            phase_times; GPU work may still be running on return. """
+        timed = profiler.enabled or (self.pacer is not None and self.pacer.adaptive)
+        if profiler.enabled:
+            profiler.begin_frame()
+        if timed:
+            self.gpu_timer.begin()
+        start = perf_counter()
+        output = self.output_size()
+        scaled = self.scaled_size(output)
+        if scaled is not None:  # lower resolution, see quality
+            if self.scaled is None or self.scaled.size != scaled:
+                self.scaled = Framebuffer(*scaled)
+            self.scaled.bind()
+        # clear draw buffer and depth buffer (<-TP2)
+        GL.glClear(GL.GL_COLOR_BUFFER_BIT | GL.GL_DEPTH_BUFFER_BIT)
+
+        view = self.trackball.view_matrix()
+        projection = self.trackball.projection_matrix(size)
+        self.frame.update(view, projection, self.light_dir)
+        collect = perf_counter()
+
+        # draw our scene objects: collect meshes, then sorted submission
+        render_queue.begin(projection, view)
+        self.draw(projection, view, self.root_model)
+        submit = perf_counter()
+        render_queue.submit(projection, view)
+        if scaled is not None:  # stretch to the window, or target if headless
+            output_glid = self.target.glid if self.headless else 0
+            GL.glBindFramebuffer(GL.GL_DRAW_FRAMEBUFFER, output_glid)
+            GL.glBindFramebuffer(GL.GL_READ_FRAMEBUFFER, self.scaled.glid)
+            GL.glBlitFramebuffer(0, 0, *scaled, 0, 0, *output,
+                                 GL.GL_COLOR_BUFFER_BIT, GL.GL_LINEAR)
+            GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, output_glid)
+            GL.glViewport(0, 0, *output)
+        clock.step()
+        if timed:
+            self.gpu_time = self.gpu_timer.end()
+
+        self.phase_times = {'frame setup': collect - start,
+                            'traversal': submit - collect,
+                            'submission': perf_counter() - submit}
+        if profiler.enabled:
+            profiler.end_frame(self.phase_times, self.gpu_time, output,
+                               render_queue)
+
+    def output_size(self):
+        """ pixel size of what render draws to: window or headless target """
+        if self.headless:
+            return self.target.size
+        return glfw.get_framebuffer_size(self.win)
+
+    def scaled_size(self, output):
+        """ reduced size to render at, None for full resolution """
+        scale = quality.resolution_scale
+        if scale >= 1:
+            return None
+        return tuple(max(1, int(side * scale)) for side in output)
+
     def run(self):
         """ Main render loop for this OpenGL window """
         while not glfw.window_should_close(self.win):
-            # clear draw buffer and depth buffer (<-TP2)
-            GL.glClear(GL.GL_COLOR_BUFFER_BIT | GL.GL_DEPTH_BUFFER_BIT)
-
-            win_size = glfw.get_window_size(self.win)
-            view = self.trackball.view_matrix()
-            projection = self.trackball.projection_matrix(win_size)
-
-            # draw our scene objects
-            self.draw(projection, view, identity())
+            self.render(glfw.get_window_size(self.win))
+            self.pacer.measure(sum(self.phase_times.values()), self.gpu_time)
 
-            # flush render commands, and swap draw buffers
+            # flush render commands, wait if ahead of time, swap draw buffers
+            self.pacer.wait()
+            swap = perf_counter()
             glfw.swap_buffers(self.win)
+            self.phase_times['swap'] = perf_counter() - swap
 
             # Poll for and process events
             glfw.poll_events()
@@ -227,8 +1051,14 @@ class Viewer(Node):
                 self.trackball.distance -= 10
             if key == glfw.KEY_R:
                 self.trackball.distance += 10
+            if key == glfw.KEY_S:
+                render_queue.report()
+            if key == glfw.KEY_P:
+                profiler.toggle()
+            if key == glfw.KEY_V:
+                self.pacer.set_vsync(not self.pacer.vsync)
             if key == glfw.KEY_SPACE:
-                glfw.set_time(0.0)
+                clock.set(0.0)
                 ### PARTIE AJOUTEE, POUR RESET LES reset_time
                 def recursive_reset_reset_time(cur):
                     if hasattr(cur, "children") and len(cur.children) != 0:
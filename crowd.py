@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""
+Crowd animation in worker processes.
+Skeleton clips (packed TransformKeyFrames channels of a whole rig, see
+SkeletonKeyFrames) and the rig hierarchy are copied once in shared memory.
+Every frame, a pool of processes evaluates a slice of the characters each:
+local bone matrices of all characters playing a clip in one vectorized call,
+then the hierarchy, depth by depth, then bone offsets. Skinning matrices are
+written in shared (2, characters, bones, 4, 4) pose arrays, one buffer being
+filled for the next frame while the main process uploads the other one.
+"""
+# Python built-in modules
+import os                           # number of cores
+import copy                         # crowd members copy their mesh's draw state
+import multiprocessing              # worker processes
+from functools import partial       # per member bone matrix lookup
+from multiprocessing import shared_memory  # clips and poses, never pickled
+from concurrent.futures import ProcessPoolExecutor
+
+# External, non built-in modules
+import numpy as np                  # all matrix manipulations & OpenGL args
+
+from core import Node, clock
+from animation import SkeletonKeyFrames
+from mesh_skinning import SkinningControlNode, SkinnedBounds
+from lod import LODNode
+from transform import identity
+
+
+# -------------- numpy arrays in shared memory ---------------------------------
+class SharedArrays:
+    """ Named numpy arrays in one shared memory block. The creating process
+        owns the block, other processes attach to it from its picklable
+        description, without any copy """
+    ALIGNMENT = 64
+
+    def __init__(self, arrays=None, description=None):
+        if description is None:
+            layout, size = [], 0
+            for key, array in arrays.items():
+                array = np.asarray(array)
+                layout.append((key, array.dtype.str, array.shape, size))
+                size += -(-max(array.nbytes, 1) // self.ALIGNMENT) * self.ALIGNMENT
+            self.memory = shared_memory.SharedMemory(create=True, size=max(size, 1))
+            description = (self.memory.name, layout)
+        else:
+            self.memory = shared_memory.SharedMemory(description[0])
+        self.description = description
+        self.arrays = {key: np.ndarray(shape, dtype, self.memory.buf, offset)
+                       for key, dtype, shape, offset in description[1]}
+        for key, array in (arrays or {}).items():
+            self.arrays[key][...] = array
+
+    def __getitem__(self, key):
+        return self.arrays[key]
+
+    def close(self, unlink=False):
+        self.arrays = {}  # no view may outlive the mapping
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+
+
+# -------------- pose evaluation, in workers or in process ---------------------
+_worker = {}  # per worker process: attached arrays and derived rig data
+
+
+def attach(description):
+    """ worker initializer: map the crowd's shared arrays """
+    _worker['shared'] = SharedArrays(description=description)
+
+
+def evaluate_slice(start, stop, time, model, buffer):
+    """ worker task, see evaluate """
+    evaluate(_worker['shared'], start, stop, time, model, buffer, _worker)
+
+
+def evaluate(shared, start, stop, time, model, buffer, cache):
+    """ skinning matrices of characters start to stop at clock time, crowd
+        moved by model, written in pose buffer; cache keeps clips and hierarchy
+        levels rebuilt from shared arrays between calls """
+    if 'clips' not in cache:
+        nb_clips = len(shared['durations'])
+        cache['clips'] = [SkeletonKeyFrames.from_arrays(
+            {key[len(prefix):]: array for key, array in shared.arrays.items()
+             if key.startswith(prefix)})
+            for prefix in ('clip%d_' % clip for clip in range(nb_clips))]
+        cache['levels'] = hierarchy_levels(shared['parents'])
+        cache['skins'] = sum(key.endswith('_poses') for key in shared.arrays)
+
+    parents, rest, levels = shared['parents'], shared['rest'], cache['levels']
+    clips = shared['clip'][start:stop]
+    for clip, skeleton in enumerate(cache['clips']):
+        ids = start + np.flatnonzero(clips == clip)
+        if not len(ids):
+            continue
+        times = np.fmod(time * shared['speed'][ids] + shared['phase'][ids],
+                        shared['durations'][clip])
+        channels = shared['clip%d_channels' % clip]
+        animated = channels >= 0
+        local = np.repeat(rest[None], len(ids), axis=0)
+        local[:, animated] = skeleton.value(times)[:, channels[animated]]
+
+        world = np.empty_like(local)
+        placements = (model @ shared['placements'][ids])[:, None]
+        world[:, levels[0]] = placements @ local[:, levels[0]]
+        for level in levels[1:]:  # parents are final before their children
+            world[:, level] = world[:, parents[level]] @ local[:, level]
+        for skin in range(cache['skins']):
+            shared['skin%d_poses' % skin][buffer, ids] = (
+                world[:, shared['skin%d_bones' % skin]] @ shared['skin%d_offsets' % skin])
+
+
+def hierarchy_levels(parents):
+    """ node indices grouped by depth, roots (parent -1) first """
+    depths = np.zeros(len(parents), np.int64)
+    for node, parent in enumerate(parents):  # parents listed before children
+        depths[node] = 0 if parent < 0 else depths[parent] + 1
+    return [np.flatnonzero(depths == depth) for depth in range(depths.max() + 1)]
+
+
+class CrowdAnimation:
+    """ Poses of count characters of one rig, each playing one of the clips
+        at its own speed and phase, evaluated by a pool of workers processes
+        (in this process if workers is 0; default one per core but the
+        main process's, see bench.py crowd). Double buffered: launch evaluates
+        into the back buffer, wait makes it the front one, read by skinning.
+            clips: [(SkeletonKeyFrames, clip channel of each rig node or -1,
+                     duration)]
+            parents, rest: rig nodes' parent index and local matrix, parents
+                listed first (see rig_arrays)
+            skins: [(rig node of each bone, bone offsets)] of skinned meshes
+            placements: (count, 4, 4) matrices placing each character """
+    def __init__(self, clips, parents, rest, skins, placements, workers=None, seed=0):
+        count = len(placements)
+        rng = np.random.default_rng(seed)
+        durations = np.array([max(duration, 1e-3) for _, _, duration in clips])
+        arrays = dict(parents=np.asarray(parents, np.int64),
+                      rest=np.asarray(rest, np.float32),
+                      placements=np.asarray(placements, np.float32),
+                      durations=durations,
+                      clip=np.arange(count) % len(clips),
+                      speed=rng.uniform(0.85, 1.15, count),
+                      phase=rng.uniform(0, durations.max(), count))
+        for clip, (skeleton, channels, _) in enumerate(clips):
+            arrays.update(('clip%d_%s' % (clip, key), array)
+                          for key, array in skeleton.arrays().items())
+            arrays['clip%d_channels' % clip] = np.asarray(channels, np.int64)
+        for skin, (bones, offsets) in enumerate(skins):
+            arrays['skin%d_bones' % skin] = np.asarray(bones, np.int64)
+            arrays['skin%d_offsets' % skin] = np.asarray(offsets, np.float32)
+            arrays['skin%d_poses' % skin] = np.zeros((2, count, len(bones), 4, 4),
+                                                     np.float32)
+        self.shared = SharedArrays(arrays)
+        self.count, self.front, self.futures = count, 0, []
+        if workers is None:  # a single worker only adds transfers to one core
+            workers = (os.cpu_count() or 1) - 1
+        self.workers = workers
+        self.cache = {}  # in process evaluation, see evaluate
+
+        self.executor = None
+        if self.workers:
+            context = multiprocessing.get_context('spawn')  # no forked GL state
+            self.executor = ProcessPoolExecutor(
+                self.workers, mp_context=context, initializer=attach,
+                initargs=(self.shared.description,))
+        slices = np.array_split(np.arange(count), max(self.workers, 1))
+        self.slices = [(ids[0], ids[-1] + 1) for ids in slices if len(ids)]
+        nbytes = sum(array.nbytes for array in self.shared.arrays.values())
+        print('Crowd of %d characters\t(%d clips, %d rig nodes, %d workers, '
+              '%d shared bytes)' % (count, len(clips), len(parents),
+                                    self.workers, nbytes))
+
+    def launch(self, time, model=identity()):
+        """ start evaluating all characters at time into the back buffer """
+        back = 1 - self.front
+        if self.executor is None:
+            evaluate(self.shared, 0, self.count, time, model, back, self.cache)
+        else:
+            self.futures = [self.executor.submit(evaluate_slice, start, stop,
+                                                 time, model, back)
+                            for start, stop in self.slices]
+
+    def wait(self):
+        """ wait for launched evaluation, its buffer becomes the front one """
+        for future in self.futures:
+            future.result()
+        self.futures = []
+        self.front = 1 - self.front
+
+    def skinning(self, skin, character):
+        """ (bones, 4, 4) front skinning matrices of a character's skin """
+        return self.shared['skin%d_poses' % skin][self.front, character]
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        if self.shared is not None:
+            self.shared.close(unlink=True)
+            self.shared = None
+
+    def __del__(self):
+        self.close()
+
+
+# -------------- crowd of loaded characters in the scene graph -----------------
+def skeleton_root(node):
+    """ first skeleton driving node in node's subtree, e.g. below a handle,
+        None if there is none (e.g. file not found) """
+    stack = [node]
+    while stack:
+        cur = stack.pop(0)
+        if isinstance(cur, SkinningControlNode) and cur.drives_skeleton:
+            return cur
+        stack.extend(getattr(cur, 'children', ()))
+    return None
+
+
+def rig_arrays(root):
+    """ (nodes, parent indices, local matrices) of the SkinningControlNode
+        hierarchy of root, parents listed before their children """
+    nodes, parents, stack = [], [], [(root, -1)]
+    while stack:
+        node, parent = stack.pop()
+        nodes.append(node)
+        parents.append(parent)
+        stack.extend((child, len(nodes) - 1) for child in reversed(node.children)
+                     if isinstance(child, SkinningControlNode))
+    return nodes, parents, np.array([node.transform for node in nodes], np.float32)
+
+
+class Crowd(Node):
+    """ Characters placed by placements, sharing one rig: each plays one of
+        the actions (loaded skinned hierarchies, e.g. the elf's files) with
+        the skinned meshes of the first one, animated by a CrowdAnimation.
+        Built on first draw, once asset handles are resolved. """
+    dynamic = True
+
+    def __init__(self, actions, placements, workers=None, seed=0):
+        super().__init__()
+        self.actions, self.placements = actions, placements
+        self.workers, self.seed = workers, seed
+        self.animation, self.built = None, False
+        self.epoch = None  # clock timeline of the launched poses
+        self.bone_lists = {}  # (skin, character) -> bone list, own palette block
+
+    def build(self):
+        self.built = True
+        roots, rigs = [], []
+        for index, action in enumerate(self.actions):
+            root = skeleton_root(action)
+            rig = None if root is None else rig_arrays(root)
+            if rig is None:
+                print('Crowd: action %d has no animated skeleton, skipped' % index)
+            elif rigs and len(rig[0]) != len(rigs[0][0]):
+                print('Crowd: action %d has another rig, skipped' % index)
+            else:
+                roots.append(root)
+                rigs.append(rig)
+        if not roots:
+            print('Crowd: no animated action, nothing to draw')
+            return
+        nodes, parents, rest = rigs[0]
+        clips = [(root.skeleton,
+                  [node.channel if node.skeleton is root.skeleton and
+                   node.channel is not None else -1 for node in rig[0]],
+                  root.loop_duration or root.skeleton.duration())
+                 for root, rig in zip(roots, rigs)]
+
+        # skinned meshes (or levels of detail of them) below the first rig
+        index = {id(node): i for i, node in enumerate(nodes)}
+        drawables, skins, self.skin_ids = [], [], {}
+        for node in nodes:
+            for child in node.children:
+                meshes = ([mesh for level in child.levels for mesh in level]
+                          if isinstance(child, LODNode) else [child])
+                if isinstance(child, SkinningControlNode) or not all(
+                        isinstance(mesh, SkinnedBounds) and mesh.bone_nodes
+                        for mesh in meshes):
+                    continue
+                for mesh in meshes:
+                    if id(mesh.bone_nodes) not in self.skin_ids:
+                        self.skin_ids[id(mesh.bone_nodes)] = len(skins)
+                        skins.append(([index[id(bone)] for bone in mesh.bone_nodes],
+                                      mesh.bone_offsets))
+                drawables.append(child)
+
+        self.animation = CrowdAnimation(clips, parents, rest, skins,
+                                        self.placements, self.workers, self.seed)
+        self.children = [self.member(drawable, character)
+                         for character in range(len(self.placements))
+                         for drawable in drawables]
+
+    def member(self, drawable, character):
+        """ copy of a skinned mesh or LODNode, posed as character """
+        if isinstance(drawable, LODNode):
+            return LODNode([[self.member(mesh, character) for mesh in level]
+                            for level in drawable.levels], drawable.sizes)
+        skin = self.skin_ids[id(drawable.bone_nodes)]
+        mesh = copy.copy(drawable)
+        mesh.bone_nodes = self.bone_lists.setdefault(
+            (skin, character), list(drawable.bone_nodes))
+        mesh.bone_matrix = partial(self.animation.skinning, skin, character)
+        return mesh
+
+    def draw(self, projection, view, model):
+        """ draw this frame's poses, next frame's are evaluated meanwhile """
+        world = self.update_world(model)
+        if not self.built:
+            self.build()
+        if self.animation is None:
+            return
+        if self.epoch != clock.epoch:  # first frame, or clock set: pose now
+            self.animation.wait()
+            self.animation.launch(clock.time(), world)
+            self.epoch = clock.epoch
+        self.animation.wait()
+        self.animation.launch(clock.next_time(), world)
+        super().draw(projection, view, model)
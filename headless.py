@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Offscreen rendering, without window system: an OpenGL context on an EGL
+pbuffer and framebuffers read back as images, see Viewer(headless=True).
+"""
+# Python built-in modules
+import ctypes                       # EGL attribute lists and out parameters
+
+# External, non built-in modules
+import OpenGL.GL as GL              # standard Python OpenGL wrapper
+import numpy as np                  # all matrix manipulations & OpenGL args
+
+
+def egl_context(width, height):
+    """ Current OpenGL 3.3 core context on an EGL pbuffer, needing no display
+        (Mesa then renders with its llvmpipe software rasterizer if no GPU).
+        PyOpenGL must use EGL: set PYOPENGL_PLATFORM=egl before importing it,
+        and EGL_PLATFORM=surfaceless where there is no X server. """
+    from OpenGL import EGL
+
+    def attributes(*values):
+        return (EGL.EGLint * (len(values) + 1))(*values, EGL.EGL_NONE)
+
+    display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+    major, minor = EGL.EGLint(), EGL.EGLint()
+    if not EGL.eglInitialize(display, ctypes.pointer(major), ctypes.pointer(minor)):
+        raise RuntimeError('EGL: cannot initialize default display')
+    config, nb_configs = EGL.EGLConfig(), EGL.EGLint()
+    EGL.eglChooseConfig(display, attributes(
+        EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT,
+        EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT,
+        EGL.EGL_RED_SIZE, 8, EGL.EGL_GREEN_SIZE, 8, EGL.EGL_BLUE_SIZE, 8,
+        EGL.EGL_DEPTH_SIZE, 24), ctypes.pointer(config), 1,
+        ctypes.pointer(nb_configs))
+    if nb_configs.value < 1:
+        raise RuntimeError('EGL: no pbuffer configuration for OpenGL')
+    surface = EGL.eglCreatePbufferSurface(display, config, attributes(
+        EGL.EGL_WIDTH, width, EGL.EGL_HEIGHT, height))
+    EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+    context = EGL.eglCreateContext(display, config, EGL.EGL_NO_CONTEXT, attributes(
+        EGL.EGL_CONTEXT_MAJOR_VERSION, 3, EGL.EGL_CONTEXT_MINOR_VERSION, 3,
+        EGL.EGL_CONTEXT_OPENGL_PROFILE_MASK, EGL.EGL_CONTEXT_OPENGL_CORE_PROFILE_BIT))
+    if not EGL.eglMakeCurrent(display, surface, surface, context):
+        raise RuntimeError('EGL: cannot create an OpenGL 3.3 core context')
+    return display, surface, context
+
+
+class Framebuffer:
+    """ Offscreen color and depth render target, read back as an image """
+    def __init__(self, width, height):
+        self.size = (width, height)
+        self.glid = GL.glGenFramebuffers(1)
+        self.renderbuffers = GL.glGenRenderbuffers(2)
+        GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, self.glid)
+        for renderbuffer, attachment, storage in zip(
+                self.renderbuffers, (GL.GL_COLOR_ATTACHMENT0, GL.GL_DEPTH_ATTACHMENT),
+                (GL.GL_RGBA8, GL.GL_DEPTH_COMPONENT24)):
+            GL.glBindRenderbuffer(GL.GL_RENDERBUFFER, renderbuffer)
+            GL.glRenderbufferStorage(GL.GL_RENDERBUFFER, storage, width, height)
+            GL.glFramebufferRenderbuffer(GL.GL_FRAMEBUFFER, attachment,
+                                         GL.GL_RENDERBUFFER, renderbuffer)
+        GL.glViewport(0, 0, width, height)
+
+    def bind(self):
+        """ draw into this framebuffer, viewport covering it """
+        GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, self.glid)
+        GL.glViewport(0, 0, *self.size)
+
+    def read(self):
+        """ (height, width, 4) uint8 RGBA image, first row at the top """
+        width, height = self.size
+        GL.glBindFramebuffer(GL.GL_READ_FRAMEBUFFER, self.glid)
+        pixels = GL.glReadPixels(0, 0, width, height, GL.GL_RGBA, GL.GL_UNSIGNED_BYTE)
+        return np.frombuffer(pixels, np.uint8).reshape(height, width, 4)[::-1]
+
+    def __del__(self):
+        GL.glDeleteFramebuffers(1, [self.glid])
+        GL.glDeleteRenderbuffers(2, self.renderbuffers)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Mesh levels of detail.
+Coarser versions of imported meshes are generated once, at import, by
+quadric error vertex clustering of the loaders' numpy arrays: vertices are
+grouped in a grid and each cell keeps the one vertex whose position best
+fits the surface of the whole cell. Levels only keep a subset of the full
+detail vertices, so every attribute (texture coordinates, normals, bones)
+stays valid and all levels share textures and materials. A LODNode draws
+the level matching its projected size on screen.
+"""
+# Python built-in modules
+import copy                         # levels copy their mesh's draw state
+
+# External, non built-in modules
+import numpy as np                  # all matrix manipulations & OpenGL args
+
+from core import Node, Mesh, render_queue
+from pacing import quality
+from transform import identity, transform_spheres, enclosing_sphere
+
+LOD_RATIOS = (0.5, 0.25, 0.1)   # targeted face fractions of coarser levels
+LOD_MIN_FACES = 64              # meshes below this are not simplified
+LOD_SIZES = (0.4, 0.15, 0.05)   # screen height fractions to switch levels at
+
+
+# -------------- quadric error vertex clustering -------------------------------
+def vertex_quadrics(vertices, faces):
+    """ (V, 4, 4) sums of the area weighted plane quadrics of vertex faces """
+    triangles = vertices[faces]
+    normals = np.cross(triangles[:, 1] - triangles[:, 0],
+                       triangles[:, 2] - triangles[:, 0])
+    double_areas = np.linalg.norm(normals, axis=1)
+    normals = normals / np.maximum(double_areas, 1e-12)[:, None]
+    planes = np.hstack((normals, -np.sum(normals * triangles[:, 0], axis=1,
+                                         keepdims=True)))
+    quadrics = (0.5 * double_areas)[:, None, None] * planes[:, :, None] * planes[:, None, :]
+    return sum_per(faces.reshape(-1), np.repeat(quadrics, 3, axis=0),
+                   len(vertices))
+
+
+def sum_per(ids, quadrics, size):
+    """ (size, 4, 4) sums of quadrics grouped by ids """
+    flat = quadrics.reshape(-1, 16)
+    return np.stack([np.bincount(ids, flat[:, k], size) for k in range(16)],
+                    axis=1).reshape(size, 4, 4)
+
+
+def cluster(vertices, faces, quadrics, cell):
+    """ (kept vertex ids, faces using them) of one grid clustering. Each cell
+        keeps its vertex of least error for the sum of the cell's quadrics,
+        faces with two corners in the same cell disappear """
+    cells = np.floor((vertices - vertices.min(axis=0)) / cell).astype(np.int64)
+    _, ids = np.unique(cells, axis=0, return_inverse=True)
+    ids = ids.reshape(-1)
+    cell_quadrics = sum_per(ids, quadrics, ids.max() + 1)
+    points = np.hstack((vertices, np.ones((len(vertices), 1))))
+    errors = np.einsum('vi,vij,vj->v', points, cell_quadrics[ids], points)
+
+    order = np.lexsort((errors, ids))  # per cell, least error first
+    first = np.ones(len(order), bool)
+    first[1:] = ids[order][1:] != ids[order][:-1]
+    representative = order[first][ids]
+
+    faces = representative[faces]
+    faces = faces[(faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2])
+                  & (faces[:, 2] != faces[:, 0])]
+    _, unique = np.unique(np.sort(faces, axis=1), axis=0, return_index=True)
+    faces = faces[np.sort(unique)]
+    kept = np.unique(faces)
+    return kept, np.searchsorted(kept, faces).astype(np.int32)
+
+
+def lod_levels(vertices, faces, ratios=LOD_RATIOS, min_faces=LOD_MIN_FACES):
+    """ [(kept vertex ids, faces)] of coarser levels, each with about ratio
+        of the full detail faces, empty for small meshes. Grid resolutions
+        are bisected (geometrically) until a level is close to its target. """
+    vertices = np.asarray(vertices, np.float64).reshape(-1, 3)
+    faces = np.asarray(faces, np.int64).reshape(-1, 3)
+    if len(faces) < min_faces:
+        return []
+    quadrics = vertex_quadrics(vertices, faces)
+    extent = np.ptp(vertices, axis=0).max()
+
+    levels, previous, finest = [], len(faces), 1024.
+    for ratio in ratios:
+        target, coarsest = ratio * len(faces), 1.
+        for _ in range(12):
+            resolution = np.sqrt(coarsest * finest)
+            kept, coarse = cluster(vertices, faces, quadrics, extent / resolution)
+            if len(coarse) < 0.8 * target:
+                coarsest = resolution
+            elif len(coarse) > 1.25 * target:
+                finest = resolution
+            else:
+                break
+        finest = resolution  # next levels are coarser
+        if len(coarse) > 0.8 * previous or len(coarse) < min_faces // 4:
+            break  # too close to previous level, or nothing left to see
+        levels.append((kept, coarse))
+        previous = len(coarse)
+    return levels
+
+
+# -------------- level selection ------------------------------------------------
+class LODNode(Node):
+    """ Drawables in several levels of detail, levels[0] being full detail.
+        Draws the level matching our bounding sphere's projected size:
+        levels[i + 1] once it covers less than sizes[i] of the screen height,
+        projected sizes being scaled by quality.lod_bias (see FramePacer).
+        Static: bounds are those of full detail whatever the level drawn, so
+        parents keep culling us as part of their subtree """
+    flattened = False  # level picked by our draw, frame by frame
+
+    def __init__(self, levels, sizes=LOD_SIZES, transform=identity()):
+        self.levels = [list(level) for level in levels]
+        super().__init__(self.levels[0], transform)
+        self.sizes = sizes[:len(self.levels) - 1]
+
+    def world_sphere(self, world):
+        """ full detail sphere for this frame, e.g. from bones if skinned """
+        sphere = self.bounds()
+        if sphere is not None:
+            return transform_spheres(world, sphere)
+        spheres = [child.world_sphere(world) if isinstance(child, Mesh) else None
+                   for child in self.children]
+        if any(sphere is None for sphere in spheres):
+            return None
+        return enclosing_sphere(spheres)
+
+    def level(self, projection, world):
+        """ index of the level to draw for this frame """
+        sphere, camera = self.world_sphere(world), render_queue.camera
+        if sphere is None or camera is None:
+            return 0
+        distance = np.linalg.norm(sphere[:3] - camera)
+        if distance <= sphere[3]:
+            return 0
+        size = sphere[3] * projection[1, 1] / distance * quality.lod_bias
+        return sum(size < threshold for threshold in self.sizes)
+
+    def draw(self, projection, view, model):
+        world = self.update_world(model)
+        if not render_queue.visible(self, world):
+            return
+        level = self.level(projection, world)
+        render_queue.counters['lod level %d' % level] += 1
+        for child in self.levels[level]:
+            render_queue.draw(child, projection, view, world)
+
+
+def with_lods(mesh, vertex_arrays):
+    """ mesh alone, or LODNode of it and copies drawing coarser vertex arrays
+        with the same shader, texture, material (and bones) """
+    levels = [mesh]
+    for vertex_array in vertex_arrays:
+        level = copy.copy(mesh)
+        level.vertex_array = vertex_array
+        levels.append(level)
+    return mesh if len(levels) == 1 else LODNode([[level] for level in levels])
@@ -1,18 +1,97 @@
 import OpenGL.GL as GL              # standard Python OpenGL wrapper
-import glfw                         # lean window system wrapper for OpenGL
 import numpy as np                  # all matrix manipulations & OpenGL args
 from math import fmod
 
-from transform import identity
-from core import Node, Mesh
-from animation import TransformKeyFrames
+from transform import identity, transform_spheres, enclosing_sphere
+from core import Node, Mesh, gl_state, render_queue, clock, PALETTE_UNIT
+from profiler import profiler
+from pacing import quality
+from animation import TransformKeyFrames, SkeletonKeyFrames, animation_updater
 
 
 MAX_VERTEX_BONES = 4
-MAX_BONES = 128
+MAX_BONES = 65536  # per mesh, bone ids are uint16 at most, see skinned_formats
 
 
-class SkinnedMesh(Mesh):
+def pack_bone_weights(vertex_ids, bone_ids, weights, nb_vertices):
+    """ Per vertex (ids, weights) arrays of shape (nb_vertices, 4), keeping
+        the MAX_VERTEX_BONES highest weights of each vertex, sorted with high
+        weights last and (0, 0) padding first. Input is flat (vertex id,
+        bone id, weight) triples; the only table built is as wide as the
+        largest number of bones influencing one vertex, not MAX_BONES. """
+    vertex_ids = np.asarray(vertex_ids, np.int64)
+    bone_ids, weights = np.asarray(bone_ids, 'u4'), np.asarray(weights, 'f4')
+
+    # group triples per vertex, rank of each triple inside its vertex group
+    order = np.argsort(vertex_ids, kind='stable')
+    vertex_ids, bone_ids, weights = (vertex_ids[order], bone_ids[order],
+                                     weights[order])
+    counts = np.bincount(vertex_ids, minlength=nb_vertices)
+    starts = np.cumsum(counts) - counts
+    rank = np.arange(len(vertex_ids)) - starts[vertex_ids]
+
+    # small dense table, then top weights per row with argpartition
+    width = max(int(counts.max(initial=0)), MAX_VERTEX_BONES)
+    table_w = np.zeros((nb_vertices, width), 'f4')
+    table_id = np.zeros((nb_vertices, width), 'u4')
+    table_w[vertex_ids, rank], table_id[vertex_ids, rank] = weights, bone_ids
+    if width > MAX_VERTEX_BONES:
+        top = np.argpartition(table_w, -MAX_VERTEX_BONES, axis=1)
+        top = top[:, -MAX_VERTEX_BONES:]
+        table_w = np.take_along_axis(table_w, top, axis=1)
+        table_id = np.take_along_axis(table_id, top, axis=1)
+
+    # sort the kept entries by weight then id, as a weight ordered sort would
+    by_id = np.argsort(table_id, axis=1, kind='stable')
+    table_w = np.take_along_axis(table_w, by_id, axis=1)
+    table_id = np.take_along_axis(table_id, by_id, axis=1)
+    by_weight = np.argsort(table_w, axis=1, kind='stable')
+    return (np.take_along_axis(table_id, by_weight, axis=1),
+            np.take_along_axis(table_w, by_weight, axis=1))
+
+
+class SkinnedBounds:
+    """ Bounds of a mesh deformed by its bone_nodes: the bind pose sphere
+        moved by each bone matrix. Skinned vertices are convex blends of
+        these moved positions, hence stay inside the enclosing sphere. """
+    @property
+    def skinned(self):
+        """ deformed by bones, its matrices go in the bone palette """
+        return bool(self.bone_nodes)
+
+    @property
+    def cull_late(self):
+        """ bone world transforms are final only once the scene traversed """
+        return self.skinned
+
+    def bone_matrix(self):
+        """ (bones, 4, 4) matrices from bind pose to current world pose, same
+            array as long as no bone moved (e.g. pose reused, see AnimationLOD)
+            so neither the product nor the upload are redone """
+        world_transforms = [node.world_transform for node in self.bone_nodes]
+        cached = getattr(self, '_bone_cache', None)
+        if cached is None or any(a is not b for a, b in zip(world_transforms, cached[0])):
+            cached = self._bone_cache = (world_transforms,
+                                         world_transforms @ self.bone_offsets)
+        return cached[1]
+
+    def sphere(self):
+        return None if self.bone_nodes else super().sphere()
+
+    def bind_bones(self):
+        """ point the shader to our matrices in this frame's bone palette """
+        gl_state.bind_texture(GL.GL_TEXTURE_BUFFER, bone_palette.texture,
+                              PALETTE_UNIT)
+        gl_state.uniform_1i(self.loc['bone_offset'], bone_palette.offset(self))
+
+    def world_sphere(self, model):
+        bind_sphere = self.vertex_array.bounds
+        if not self.bone_nodes or bind_sphere is None:
+            return super().world_sphere(model)
+        return enclosing_sphere(transform_spheres(self.bone_matrix(), bind_sphere))
+
+
+class SkinnedMesh(SkinnedBounds, Mesh):
     """class of skinned mesh nodes in scene graph """
     def __init__(self, shader, attribs, bone_nodes, bone_offsets, index=None):
         super().__init__(shader, attribs, index)
@@ -20,20 +99,96 @@ class SkinnedMesh(Mesh):
         # store skinning data
         self.bone_nodes = bone_nodes
         self.bone_offsets = np.array(bone_offsets, np.float32)
+        self.loc['bone_offset'] = shader.uniform_location('bone_offset')
 
     def draw(self, projection, view, model):
         """ skinning object draw method """
-        GL.glUseProgram(self.shader.glid)
+        gl_state.use_program(self.shader.glid)
 
         # bone world transform matrices need to be passed for skinning
-        world_transforms = [node.world_transform for node in self.bone_nodes]
-        bone_matrix = world_transforms @ self.bone_offsets
-        loc = GL.glGetUniformLocation(self.shader.glid, 'bone_matrix')
-        GL.glUniformMatrix4fv(loc, len(self.bone_nodes), True, bone_matrix)
+        if self.bone_nodes:
+            self.bind_bones()
 
         super().draw(projection, view, model)
 
 
+# -------------- Bone matrices of all skinned meshes, in one GPU buffer ------
+class BonePalette:
+    """ Bone matrices of every skinned mesh drawn this frame, packed in one
+        persistent texture buffer (4 RGBA32F texels per matrix, one per
+        column) read by shader.vert at bone_offset + bone id. Filled once per
+        frame before the queued draws; meshes sharing bones and offsets (e.g.
+        levels of detail) share their block, and nothing is uploaded when no
+        bone moved since last frame. """
+    def __init__(self):
+        self.glid, self.texture = None, None  # created with the first upload
+        self.capacity = 0   # bytes allocated in our buffer
+        self.blocks = []    # (bones, 4, 4) arrays currently uploaded
+        self.starts = {}    # (bone nodes, offsets) ids -> index of their block
+        self.offsets = {}   # mesh -> index of its first matrix in palette
+        self.size = 0       # matrices in palette
+
+    def update(self, meshes):
+        """ gather bone matrices of skinned meshes among meshes, upload """
+        previous = self.blocks
+        self.offsets, self.starts, self.blocks, self.size = {}, {}, [], 0
+        for mesh in meshes:
+            if mesh.skinned:
+                self.place(mesh)
+
+        changed = (len(self.blocks) != len(previous) or
+                   any(a is not b for a, b in zip(self.blocks, previous)))
+        if self.blocks and changed:
+            self.upload(np.concatenate(self.blocks))
+
+    def place(self, mesh):
+        """ offset of mesh, its block appended at the end if not yet there,
+            True if a block was added """
+        key = (id(mesh.bone_nodes), id(mesh.bone_offsets))
+        added = key not in self.starts
+        if added:
+            self.starts[key] = self.size
+            self.blocks.append(mesh.bone_matrix())
+            self.size += len(self.blocks[-1])
+        self.offsets[mesh] = self.starts[key]
+        return added
+
+    def upload(self, matrices, first=0):
+        """ write matrices in palette from matrix index first on """
+        columns = np.ascontiguousarray(matrices.transpose(0, 2, 1), np.float32)
+        start = first * columns[0].nbytes if len(columns) else 0
+        if self.glid is None:
+            self.glid, self.texture = GL.glGenBuffers(1), GL.glGenTextures(1)
+        GL.glBindBuffer(GL.GL_TEXTURE_BUFFER, self.glid)
+        if start + columns.nbytes > self.capacity:  # grow, keeping room for more
+            if first:  # new storage is empty: upload the whole palette
+                return self.upload(np.concatenate(self.blocks))
+            self.capacity = 2 * columns.nbytes
+            GL.glBufferData(GL.GL_TEXTURE_BUFFER, self.capacity, None,
+                            GL.GL_DYNAMIC_DRAW)
+            gl_state.bind_texture(GL.GL_TEXTURE_BUFFER, self.texture, PALETTE_UNIT)
+            GL.glTexBuffer(GL.GL_TEXTURE_BUFFER, GL.GL_RGBA32F, self.glid)
+        GL.glBufferSubData(GL.GL_TEXTURE_BUFFER, start, columns.nbytes, columns)
+
+    def offset(self, mesh):
+        """ first matrix of mesh. Drawn outside the queue, its block is
+            appended to this frame's palette, others keep their offsets """
+        if mesh not in self.offsets and self.place(mesh):
+            self.upload(self.blocks[-1], self.offsets[mesh])
+        return self.offsets[mesh]
+
+    def __del__(self):
+        if self.glid is not None:
+            GL.glDeleteBuffers(1, [self.glid])
+            GL.glDeleteTextures(self.texture)
+
+
+bone_palette = BonePalette()
+render_queue.before_submit.append(bone_palette.update)
+profiler.instrument(SkinnedBounds, 'bone_matrix', 'bone matrices')
+profiler.instrument(BonePalette, 'upload', 'bone upload')
+
+
 class SkinningControlNode(Node):
     """ Place node with transform keys above a controlled subtree """
     def __init__(self, *keys, transform=identity(), loop_duration=0.0):
@@ -43,21 +198,160 @@ class SkinningControlNode(Node):
         self.last_reset_time = 0.0
         self.loop_duration = loop_duration
 
+        # shared skeleton evaluator, see bind_skeleton
+        self.skeleton, self.channel, self.drives_skeleton = None, None, False
+        self.animate = True   # False: driver keeps last pose, see AnimationLOD
+        self.animate_next = True  # next frame's pose is prepared in advance
+        self._read_pose = None  # skeleton pose our transform comes from
+        self.is_bone = False  # world transform read by skinned meshes
+
+    @property
+    def dynamic(self):
+        """ animated and bone nodes stay live, others can be frozen, e.g.
+            static models such as the catapult parts, then instanced """
+        return bool(self.keyframes or self.skeleton or self.is_bone)
+
+    def animation_time(self, now=None):
+        """ Time in our animation at clock time now (default current),
+            looped or since last reset """
+        now = clock.time() if now is None else now
+        if self.loop_duration == 0.0: # on n'a pas demandé à faire boucler l'animation
+            return now - self.last_reset_time
+        return fmod(now, self.loop_duration)
+
+    def next_animation_time(self):
+        """ animation time of next frame, None if not animated then """
+        return self.animation_time(clock.next_time()) if self.animate_next else None
+
     def draw(self, projection, view, model):
         """ When redraw requested, interpolate our node transform from keys """
-        if self.keyframes:  # no keyframe update should happens if no keyframes
-            glfw_time = glfw.get_time()
-            if self.loop_duration == 0.0: # on n'a pas demandé à faire boucler l'animation
-                time = glfw_time - self.last_reset_time
-            else:
-                time = fmod(glfw_time, self.loop_duration)
-            self.transform = self.keyframes.value(time) # CHANGé pour pouvoir reset les animations individuellement
-
-        # store world transform for skinned meshes using this node as bone
-        self.world_transform = model @ self.transform
-
-        # default node behaviour (call children's draw method)
+        # keyframes are evaluated ahead by the animation updater's thread
+        if self.skeleton:  # whole skeleton evaluated once, by its root node
+            if self.drives_skeleton and self.animate:
+                self.skeleton.pose = animation_updater.value(
+                    self.skeleton, self.skeleton.evaluate, self.animation_time(),
+                    self.next_animation_time())
+            pose = self.skeleton.pose
+            if self.channel is not None and pose is not self._read_pose:
+                self.transform = pose[self.channel]  # only if re-evaluated
+                self._read_pose = pose
+        elif self.keyframes:  # no keyframe update should happens if no keyframes
+            self.transform = animation_updater.value(  # CHANGé pour pouvoir reset les animations individuellement
+                self, self.keyframes.value, self.animation_time(),
+                self.next_animation_time())
+
+        # default node behaviour (call children's draw method), also stores
+        # world transform for skinned meshes using this node as bone
         super().draw(projection, view, model)
 
-    def reset_time(self):
-        self.last_reset_time = float(glfw.get_time())
+    def reset_time(self, time=None):
+        """ Restart animation, time shared by all nodes of a same skeleton """
+        self.last_reset_time = float(clock.time() if time is None else time)
+
+
+def bind_skeleton(root_node, nodes, bake_rate=None):
+    """ Pack keyframes of all animated nodes below root_node in a single
+        SkeletonKeyFrames: root_node evaluates all local bone matrices in one
+        vectorized call per frame, each animated node reads its own channel.
+        Optional bake_rate resamples the whole skeleton in a lookup table.
+        Returns the skeleton, None if no node is animated """
+    animated = [node for node in nodes if node.keyframes]
+    if not animated:
+        return None
+    skeleton = SkeletonKeyFrames([node.keyframes for node in animated])
+    if bake_rate:
+        skeleton.bake(bake_rate, root_node.loop_duration or None)
+    for channel, node in enumerate(animated):
+        node.skeleton, node.channel = skeleton, channel
+    root_node.skeleton, root_node.drives_skeleton = skeleton, True
+    return skeleton
+
+
+# -------------- Animation level of detail for skinned characters -------------
+class AnimationLOD:
+    """ How often a character's skeleton is evaluated: every frame up to the
+        near distance from the camera, then every few frames up to every
+        max_interval frames at far distance, last pose reused in between.
+        With cull, characters outside the view frustum are not evaluated.
+        Distances are scaled by quality.animation_range, see FramePacer. """
+    def __init__(self, near=40., far=160., max_interval=8, cull=True):
+        self.near, self.far = near, far
+        self.max_interval, self.cull = max_interval, cull
+
+    def interval(self, distance):
+        """ number of frames between two evaluations at distance """
+        distance = distance / quality.animation_range
+        if distance <= self.near:
+            return 1
+        fraction = min((distance - self.near) / (self.far - self.near), 1.)
+        return 1 + round(fraction * (self.max_interval - 1))
+
+
+class AnimatedCharacter(Node):
+    """ Node above skinned hierarchies (see skinned loaders), evaluated
+        according to its AnimationLOD policy. Visibility is tested with the
+        bounds of the last evaluated pose, moved with this node since. """
+    dynamic = True
+
+    def __init__(self, children=(), transform=identity(), lod=None):
+        super().__init__(children, transform)
+        self.lod = lod or AnimationLOD()
+        self._skinned = None     # (children, skeleton drivers, skinned meshes)
+        self._pose_frame = None  # frame number of last evaluation
+        self._pose_epoch = clock.epoch  # clock timeline of that evaluation
+        self._pose_world = None  # our world matrix when bones were last drawn
+
+    def skinned(self):
+        """ skeleton driving nodes and skinned meshes below us, cached until
+            our children list is replaced (e.g. action change), looked up
+            again while none found (asset handles not filled yet) """
+        if (self._skinned is None or self._skinned[0] is not self.children
+                or not self._skinned[1]):
+            drivers, meshes, stack = [], [], list(self.children)
+            while stack:
+                cur = stack.pop()
+                if isinstance(cur, SkinningControlNode) and cur.drives_skeleton:
+                    drivers.append(cur)
+                if isinstance(cur, SkinnedBounds) and cur.bone_nodes:
+                    meshes.append(cur)
+                stack.extend(getattr(cur, 'children', ()))
+            self._skinned = (self.children, drivers, meshes)
+            self._pose_frame = None  # new skeletons: evaluate them now
+        return self._skinned[1:]
+
+    def pose_sphere(self, world, meshes):
+        """ world sphere of the bones as last drawn, moved as we moved since """
+        spheres = [mesh.world_sphere(None) for mesh in meshes]
+        if self._pose_frame is None or not spheres or any(s is None for s in spheres):
+            return None
+        sphere = enclosing_sphere(spheres)
+        if world is not self._pose_world:
+            sphere = transform_spheres(world @ np.linalg.inv(self._pose_world), sphere)
+        return sphere
+
+    def draw(self, projection, view, model):
+        world = self.update_world(model)
+        drivers, meshes = self.skinned()
+        if self._pose_epoch != clock.epoch:  # clock set: last pose is stale
+            self._pose_frame, self._pose_epoch = None, clock.epoch
+        sphere = self.pose_sphere(world, meshes)
+        if sphere is not None and self.lod.cull and render_queue.planes is not None:
+            if not render_queue.cull(sphere[None], np.array([len(meshes)]))[0]:
+                render_queue.counters['animations culled'] += 1
+                return
+
+        center = world[:3, 3] if sphere is None else sphere[:3]
+        camera = render_queue.camera
+        distance = 0. if camera is None else np.linalg.norm(center - camera)
+        frame, interval = render_queue.frame, self.lod.interval(distance)
+        animate = self._pose_frame is None or frame - self._pose_frame >= interval
+        if animate:
+            self._pose_frame = frame
+            render_queue.counters['animations evaluated'] += 1
+        else:
+            render_queue.counters['animations reused'] += 1
+        for node in drivers:  # next pose only prepared ahead if to be drawn
+            node.animate = animate
+            node.animate_next = frame + 1 - self._pose_frame >= interval
+        self._pose_world = world  # bone world matrices follow us while drawn
+        super().draw(projection, view, model)
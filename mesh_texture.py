@@ -8,13 +8,34 @@ import os                           # os function, i.e. checking file status
 # External, non built-in modules
 import OpenGL.GL as GL              # standard Python OpenGL wrapper
 import numpy as np                  # all matrix manipulations & OpenGL args
-import assimpcy                     # 3D resource loader
 
-from core import Mesh
+from core import Mesh, gl_state
 
 from PIL import Image               # load images for textures
 
 
+# -------------- Image decoding, possibly ahead of time in threads ------------
+_decoded = {}  # absolute path -> Future of decoded image, see prefetch_image
+
+
+def decode_image(tex_file):
+    """ imports image as a numpy array in exactly right format """
+    return np.asarray(Image.open(tex_file).convert('RGBA'))
+
+
+def prefetch_image(tex_file, executor):
+    """ Start decoding tex_file in executor, load_image will wait for it """
+    key = os.path.abspath(tex_file)
+    if key not in _decoded:
+        _decoded[key] = executor.submit(decode_image, tex_file)
+
+
+def load_image(tex_file):
+    """ Decoded image, from a prefetch if one was started, else decoded now """
+    future = _decoded.pop(os.path.abspath(tex_file), None)
+    return future.result() if future else decode_image(tex_file)
+
+
 # -------------- OpenGL Texture Wrapper ---------------------------------------
 class Texture:
     """ Helper class to create and automatically destroy textures """
@@ -23,8 +44,8 @@ class Texture:
         self.glid = GL.glGenTextures(1)
         try:
             # imports image as a numpy array in exactly right format
-            tex = np.asarray(Image.open(tex_file).convert('RGBA'))
-            GL.glBindTexture(GL.GL_TEXTURE_2D, self.glid)
+            tex = load_image(tex_file)
+            gl_state.bind_texture(GL.GL_TEXTURE_2D, self.glid)
             GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_RGBA, tex.shape[1],
                             tex.shape[0], 0, GL.GL_RGBA, GL.GL_UNSIGNED_BYTE, tex)
             GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_S, wrap_mode)
@@ -38,6 +59,7 @@ class Texture:
             print("ERROR: unable to load texture file %s" % tex_file)
 
     def __del__(self):  # delete GL texture from GPU when object dies
+        gl_state.forget_texture(self.glid)
         GL.glDeleteTextures(self.glid)
 
 
@@ -47,14 +69,12 @@ class TexturedMesh(Mesh):
     def __init__(self, shader, texture, attributes, index=None):
         super().__init__(shader, attributes, index)
         self.texture = texture
-        loc = GL.glGetUniformLocation(shader.glid, 'diffuse_map')
-        self.loc['diffuse_map'] = loc
+        self.loc['diffuse_map'] = shader.uniform_location('diffuse_map')
 
     def draw(self, projection, view, model, primitives=GL.GL_TRIANGLES):
-        GL.glUseProgram(self.shader.glid)
+        gl_state.use_program(self.shader.glid)
 
         # texture access setups
-        GL.glActiveTexture(GL.GL_TEXTURE0)
-        GL.glBindTexture(GL.GL_TEXTURE_2D, self.texture.glid)
-        GL.glUniform1i(self.loc['diffuse_map'], 0)
+        gl_state.bind_texture(GL.GL_TEXTURE_2D, self.texture.glid)
+        gl_state.uniform_1i(self.loc['diffuse_map'], 0)
         super().draw(projection, view, model, primitives)
@@ -8,99 +8,78 @@ import os                           # os function, i.e. checking file status
 # External, non built-in modules
 import OpenGL.GL as GL              # standard Python OpenGL wrapper
 import numpy as np                  # all matrix manipulations & OpenGL args
-import assimpcy                     # 3D resource loader
 
-from core import Mesh
-from mesh_texture import Texture
+import assets
+from core import Mesh, gl_state, RIGID_FORMATS
+from lod import with_lods
 
 
 # -------------- TexturedMesh ---------------------------------------
 class IlluminationAndTexture(Mesh):
 
     def __init__(self, shader, texture, attributes, index=None,
-                light_dir=(0, -1, 0),   # directional light (in world coords)
                 k_a=(0, 0, 0), k_d=(1, 1, 0), k_s=(1, 1, 1), s=16.):
         super().__init__(shader, attributes, index)
 
         #Illumination
-        self.light_dir = light_dir
         self.k_a, self.k_d, self.k_s, self.s = k_a, k_d, k_s, s
         # retrieve OpenGL locations of shader variables at initialization
-        names = ['light_dir', 'k_a', 's', 'k_s', 'k_d', 'w_camera_position']
-        loc = {n: GL.glGetUniformLocation(shader.glid, n) for n in names}
+        names = ['k_a', 's', 'k_s', 'k_d']
+        loc = {n: shader.uniform_location(n) for n in names}
         self.loc.update(loc)
 
         #Texture
         self.texture = texture
-        loc = GL.glGetUniformLocation(shader.glid, 'diffuse_map')
-        self.loc['diffuse_map'] = loc
+        self.loc['diffuse_map'] = shader.uniform_location('diffuse_map')
 
     def draw(self, projection, view, model, primitives=GL.GL_TRIANGLES):
-        GL.glUseProgram(self.shader.glid)
+        gl_state.use_program(self.shader.glid)
 
         # texture access setups
-        GL.glActiveTexture(GL.GL_TEXTURE0)
-        GL.glBindTexture(GL.GL_TEXTURE_2D, self.texture.glid)
-        GL.glUniform1i(self.loc['diffuse_map'], 0)
+        gl_state.bind_texture(GL.GL_TEXTURE_2D, self.texture.glid)
+        gl_state.uniform_1i(self.loc['diffuse_map'], 0)
 
-
-        # setup light parameters
-        GL.glUniform3fv(self.loc['light_dir'], 1, self.light_dir)
-
-        # setup material parameters
-        GL.glUniform3fv(self.loc['k_a'], 1, self.k_a)
-        GL.glUniform3fv(self.loc['k_d'], 1, self.k_d)
-        GL.glUniform3fv(self.loc['k_s'], 1, self.k_s)
-        GL.glUniform1f(self.loc['s'], max(self.s, 0.001))
-
-        # world camera position for Phong illumination specular component
-        w_camera_position = np.linalg.inv(view)[:,3]
-        GL.glUniform3fv(self.loc['w_camera_position'], 1, w_camera_position)
+        # setup material parameters, light and camera are per frame constants
+        gl_state.uniform_3fv(self.loc['k_a'], self.k_a)
+        gl_state.uniform_3fv(self.loc['k_d'], self.k_d)
+        gl_state.uniform_3fv(self.loc['k_s'], self.k_s)
+        gl_state.uniform_1f(self.loc['s'], max(self.s, 0.001))
 
         super().draw(projection, view, model, primitives)
 
+    def material(self):
+        """ material uniforms, meshes sharing them are drawn together """
+        return tuple(np.hstack((self.k_a, self.k_d, self.k_s, self.s)).tolist())
+
 
 # -------------- Loader ---------------------------------------
-def load_textured_illuminated(file, shader, tex_file=None, light_dir= (0, -1, 0)):
-    """ load resources from file using assimp, return list of TexturedMesh """
-    try:
-        pp = assimpcy.aiPostProcessSteps
-        flags = pp.aiProcess_Triangulate | pp.aiProcess_FlipUVs | pp.aiProcess_GenSmoothNormals
-        scene = assimpcy.aiImportFile(file, flags)
-    except assimpcy.all.AssimpError as exception:
-        print('ERROR loading', file + ': ', exception.args[0].decode())
+def load_textured_illuminated(file, shader, tex_file=None, lod=True):
+    """ load resources from file using assimp, return list of TexturedMesh,
+        or of LODNode for meshes with coarser levels of detail if lod """
+    # Triangulate | FlipUVs | GenSmoothNormals, imported once, then shared
+    scene = assets.import_scene(file, assets.LOADER_FLAGS)
+    if scene is None:
         return []
-
-    # Note: embedded textures not supported at the moment
-    path = os.path.dirname(file) if os.path.dirname(file) != '' else './'
-    for mat in scene.mMaterials:
-        if not tex_file and 'TEXTURE_BASE' in mat.properties:  # texture token
-            name = os.path.basename(mat.properties['TEXTURE_BASE'])
-            # search texture in file's whole subdir since path often screwed up
-            paths = os.walk(path, followlinks=True)
-            found = [os.path.join(d, f) for d, _, n in paths for f in n
-                     if name.startswith(f) or f.startswith(name)]
-            assert found, 'Cannot find texture %s in %s subtree' % (name, path)
-            tex_file = found[0]
-        if tex_file:
-            mat.properties['diffuse_map'] = Texture(tex_file=tex_file)
+    textures = assets.material_textures(file, scene, tex_file)
 
     # prepare textured mesh
     meshes = []
-    for mesh in scene.mMeshes:
-        mat = scene.mMaterials[mesh.mMaterialIndex].properties
-        assert mat['diffuse_map'], "Trying to map using a textureless material"
-        vec4 = np.array(((0, 0, 0, 0), (0, 0, 0, 0), (0, 0, 0, 0), (0, 0, 0, 0))) # CHANGé pour être en accord avec le .vert
-        attributes = [mesh.mVertices, mesh.mTextureCoords[0], vec4, vec4, mesh.mNormals] # CHANGé pour être en accord avec le .vert
-
-        mesh = IlluminationAndTexture(shader, mat['diffuse_map'], attributes, mesh.mFaces,
+    for mesh_id, mesh in enumerate(scene.meshes):
+        mat = scene.materials[mesh.material]
+        texture = textures[mesh.material]
+        assert texture, "Trying to map using a textureless material"
+        # pas d'os : bone_ids et bone_weights absents du buffer (voir RIGID_FORMATS)
+        attributes = [mesh.vertices, mesh.tex_coords, None, None, mesh.normals] # CHANGé pour être en accord avec le .vert
+        vertex_array = assets.shared_vertex_array(scene, mesh_id, 'static', attributes, mesh.faces, RIGID_FORMATS)
+        lods = assets.shared_lod_vertex_arrays(scene, mesh_id, 'static', attributes, RIGID_FORMATS) if lod else []
+
+        mesh = IlluminationAndTexture(shader, texture, vertex_array,
                                       k_d=mat.get('COLOR_DIFFUSE', (1, 1, 1)),
                                       k_s=mat.get('COLOR_SPECULAR', (1, 1, 1)),
                                       k_a=mat.get('COLOR_AMBIENT', (0, 0, 0)),
-                                      s=mat.get('SHININESS', 16.),
-                                      light_dir=light_dir)
-        meshes.append(mesh)
+                                      s=mat.get('SHININESS', 16.))
+        meshes.append(with_lods(mesh, lods))
 
-    size = sum((mesh.mNumFaces for mesh in scene.mMeshes))
+    size = sum((len(mesh.faces) for mesh in scene.meshes))
     print('Loaded %s\t(%d meshes, %d faces)' % (file, len(meshes), size))
     return meshes
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Text drawn over the rendered frame, e.g. the profiler's statistics.
+Lines are rasterized by PIL into a texture only when they change, a few
+times per second at most, then drawn as one screen aligned quad.
+"""
+# Python built-in modules
+from time import perf_counter       # text refresh period
+
+# External, non built-in modules
+import OpenGL.GL as GL              # standard Python OpenGL wrapper
+import numpy as np                  # all matrix manipulations & OpenGL args
+from PIL import Image, ImageDraw, ImageFont  # text rasterization
+
+from core import Shader, gl_state
+
+OVERLAY_PERIOD = 0.25   # seconds between text refreshes
+OVERLAY_MARGIN = 8      # pixels from the window's top left corner
+
+# quad corners from gl_VertexID, no vertex buffer needed
+OVERLAY_VERT = """#version 330 core
+uniform vec4 rectangle;  // left, bottom, width, height, normalized coordinates
+out vec2 frag_tex_coords;
+
+void main() {
+    vec2 corner = vec2(gl_VertexID & 1, gl_VertexID >> 1);
+    frag_tex_coords = vec2(corner.x, 1.0 - corner.y);  // first image row on top
+    gl_Position = vec4(rectangle.xy + corner * rectangle.zw, 0.0, 1.0);
+}"""
+
+OVERLAY_FRAG = """#version 330 core
+uniform sampler2D diffuse_map;
+in vec2 frag_tex_coords;
+out vec4 out_color;
+
+void main() {
+    out_color = texture(diffuse_map, frag_tex_coords);
+}"""
+
+
+class TextOverlay:
+    """ Lines of text in the top left corner, over a translucent background """
+    def __init__(self):
+        self.shader = Shader(OVERLAY_VERT, OVERLAY_FRAG)
+        self.rectangle = self.shader.uniform_location('rectangle')
+        self.vertex_array = GL.glGenVertexArrays(1)  # empty, see OVERLAY_VERT
+        self.glid = GL.glGenTextures(1)
+        gl_state.bind_texture(GL.GL_TEXTURE_2D, self.glid)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER, GL.GL_NEAREST)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER, GL.GL_NEAREST)
+        self.font = ImageFont.load_default()
+        self.lines, self.image_size, self.refreshed = None, None, -OVERLAY_PERIOD
+
+    def rasterize(self, lines):
+        """ upload lines as an RGBA texture, white on translucent black """
+        text = '\n'.join(lines)
+        _, _, right, bottom = ImageDraw.Draw(Image.new('L', (1, 1))) \
+            .multiline_textbbox((0, 0), text, font=self.font)
+        image = Image.new('RGBA', (right + 8, bottom + 8), (0, 0, 0, 160))
+        ImageDraw.Draw(image).multiline_text((4, 4), text, font=self.font,
+                                             fill=(255, 255, 255, 255))
+        pixels = np.asarray(image)
+        gl_state.bind_texture(GL.GL_TEXTURE_2D, self.glid)
+        GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_RGBA, image.width,
+                        image.height, 0, GL.GL_RGBA, GL.GL_UNSIGNED_BYTE, pixels)
+        self.lines, self.image_size = lines, image.size
+
+    def draw(self, lines, size):
+        """ draw lines over a framebuffer of size (width, height) """
+        now = perf_counter()
+        if now - self.refreshed >= OVERLAY_PERIOD and lines != self.lines:
+            self.rasterize(lines)
+            self.refreshed = now
+        (width, height), (text_width, text_height) = size, self.image_size
+
+        gl_state.use_program(self.shader.glid)
+        gl_state.bind_texture(GL.GL_TEXTURE_2D, self.glid)
+        gl_state.bind_vertex_array(self.vertex_array)
+        GL.glUniform4f(self.rectangle, -1 + 2 * OVERLAY_MARGIN / width,
+                       1 - 2 * (OVERLAY_MARGIN + text_height) / height,
+                       2 * text_width / width, 2 * text_height / height)
+        GL.glDisable(GL.GL_DEPTH_TEST)
+        GL.glEnable(GL.GL_BLEND)
+        GL.glBlendFunc(GL.GL_SRC_ALPHA, GL.GL_ONE_MINUS_SRC_ALPHA)
+        GL.glDrawArrays(GL.GL_TRIANGLE_STRIP, 0, 4)
+        GL.glDisable(GL.GL_BLEND)
+        GL.glEnable(GL.GL_DEPTH_TEST)
+
+    def __del__(self):
+        gl_state.forget_texture(self.glid)
+        gl_state.forget_vertex_array(self.vertex_array)
+        GL.glDeleteTextures(self.glid)
+        GL.glDeleteVertexArrays(1, [self.vertex_array])
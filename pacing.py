@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Frame pacing and adaptive quality: the viewer's run loop is capped at its
+target frame rate, and quality settings read while drawing (resolution,
+animation and mesh levels of detail) are lowered when frames run late.
+"""
+# Python built-in modules
+from time import perf_counter, sleep  # frame cap
+from collections import deque       # measures of the last frames
+
+# External, non built-in modules
+import glfw                         # lean window system wrapper for OpenGL
+import numpy as np                  # all matrix manipulations & OpenGL args
+
+# quality levels, best first: (render resolution scale, animation range scale,
+# level of detail bias), see Quality
+QUALITY_LEVELS = ((1.0, 1.0, 1.0),
+                  (1.0, 0.7, 0.8),
+                  (0.85, 0.5, 0.65),
+                  (0.7, 0.35, 0.5),
+                  (0.5, 0.25, 0.35))
+PACING_WINDOW = 60      # frames averaged before a decision
+PACING_COOLDOWN = 30    # frames ignored after a change, while caches settle
+PACING_HIGH = 0.95      # budget fraction above which quality is lowered
+PACING_LOW = 0.6        # budget fraction below which it is raised again
+
+
+class Quality:
+    """ Settings traded for speed, read while drawing:
+        resolution_scale: fraction of the window size the scene is drawn at
+        animation_range: scales AnimationLOD distances, lower is coarser
+        lod_bias: scales projected sizes choosing LODNode levels """
+    def __init__(self):
+        self.apply(QUALITY_LEVELS[0])
+
+    def apply(self, level):
+        self.resolution_scale, self.animation_range, self.lod_bias = level
+
+
+quality = Quality()
+
+
+class FramePacer:
+    """ Frame pacing of Viewer.run at target seconds per frame, by vsync or
+        by sleeping until the next frame is due. If adaptive, the CPU time
+        (frame phases but swap) and GPU time (timer queries) of the last
+        PACING_WINDOW frames are compared to the target: quality goes one
+        QUALITY_LEVELS step down when either exceeds PACING_HIGH of the
+        budget, one step up when both stay under PACING_LOW. Decisions are
+        printed with the measures they were taken on. """
+    def __init__(self, target=1 / 60, vsync=True, adaptive=True):
+        self.target, self.adaptive = target, adaptive
+        self.vsync = vsync
+        self.level = 0
+        self.window = deque(maxlen=PACING_WINDOW)  # (cpu, gpu) seconds
+        self.cooldown = 0
+        self.deadline = None  # when the next frame is due, without vsync
+        self.frame = 0        # frames measured, for messages
+
+    def set_vsync(self, vsync):
+        """ swap buffers on vertical blank, or as soon as rendered """
+        self.vsync, self.deadline = vsync, None
+        glfw.swap_interval(int(vsync))
+        print('Frame pacing vsync %s' % ('on' if vsync else 'off'))
+
+    def wait(self):
+        """ frame cap without vsync: sleep until next frame is due """
+        if self.vsync:
+            return
+        now = perf_counter()
+        if self.deadline is not None and now < self.deadline:
+            sleep(self.deadline - now)
+            now = self.deadline
+        self.deadline = now + self.target
+
+    def measure(self, cpu, gpu):
+        """ record a frame's CPU and GPU seconds, adapt quality if due """
+        self.frame += 1
+        if not self.adaptive:
+            return
+        if self.cooldown:
+            self.cooldown -= 1
+            return
+        self.window.append((cpu, cpu if gpu is None else gpu))
+        if len(self.window) < PACING_WINDOW:
+            return
+        cpu, gpu = np.mean(self.window, axis=0)
+        load = max(cpu, gpu) / self.target
+        if load > PACING_HIGH and self.level < len(QUALITY_LEVELS) - 1:
+            self.change(+1, cpu, gpu)
+        elif load < PACING_LOW and self.level > 0:
+            self.change(-1, cpu, gpu)
+
+    def change(self, step, cpu, gpu):
+        self.level += step
+        quality.apply(QUALITY_LEVELS[self.level])
+        print('Frame pacing frame %d: cpu %.2f ms, gpu %.2f ms for %.2f ms,'
+              ' quality %s to level %d %s'
+              % (self.frame, cpu * 1e3, gpu * 1e3, self.target * 1e3,
+                 'down' if step > 0 else 'up', self.level,
+                 QUALITY_LEVELS[self.level]))
+        self.window.clear()
+        self.cooldown = PACING_COOLDOWN
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+Frame profiler, switched at runtime: per phase CPU times, GPU time from
+timer queries and per frame counts, shown by the overlay and logged as CSV.
+Modules register the functions they want timed or counted, see instrument.
+"""
+# Python built-in modules
+import os                           # log rotation
+import ctypes                       # 64 bit query results
+import csv                          # profiler log
+import threading                    # per thread profiler nesting
+from time import perf_counter       # per phase frame timings
+from collections import Counter, deque  # per frame statistics
+
+# External, non built-in modules
+import OpenGL.GL as GL              # standard Python OpenGL wrapper
+import numpy as np                  # all matrix manipulations & OpenGL args
+
+PROFILE_WINDOW = 30         # frames averaged by profiler lines
+GPU_QUERIES = 4             # GPU timer queries in flight, results read late
+PROFILE_LOG_ROWS = 10000    # rows of the log before it rotates to <log>.1
+
+# counted OpenGL calls: name -> (counter, bytes uploaded from its arguments)
+GL_COUNTERS = {
+    'glUseProgram': ('state changes', None),
+    'glBindVertexArray': ('state changes', None),
+    'glBindTexture': ('state changes', None),
+    'glActiveTexture': ('state changes', None),
+    'glUniform1i': ('uniform bytes', lambda args: 4),
+    'glUniform1f': ('uniform bytes', lambda args: 4),
+    'glUniform3fv': ('uniform bytes', lambda args: 12 * args[1]),
+    'glUniformMatrix3fv': ('uniform bytes', lambda args: 36 * args[1]),
+    'glUniformMatrix4fv': ('uniform bytes', lambda args: 64 * args[1]),
+    'glBufferSubData': ('buffer bytes', lambda args: args[2]),
+}
+COUNTERS = ('draw calls', 'triangles', 'state changes', 'uniform bytes',
+            'buffer bytes')
+# render_queue.counters always logged: skinned characters animated, frozen on
+# their last pose, or skipped off screen (see AnimatedCharacter), and where
+# their keyframes were evaluated (see AnimationUpdater)
+QUEUE_COUNTERS = ('animations evaluated', 'animations reused',
+                  'animations culled', 'animations prepared', 'animations inline')
+FRAME_PHASES = ('frame setup', 'traversal', 'submission', 'swap')  # see Viewer
+
+
+class GPUTimer:
+    """ GPU time of frames from GL_TIME_ELAPSED queries, used round robin
+        and read GPU_QUERIES frames late: reading never waits for the GPU """
+    def __init__(self):
+        self.queries = None  # created with the first frame
+        self.frame = 0
+
+    def begin(self):
+        if self.queries is None:
+            self.queries = list(GL.glGenQueries(GPU_QUERIES))
+        GL.glBeginQuery(GL.GL_TIME_ELAPSED, self.queries[self.frame % GPU_QUERIES])
+
+    def end(self):
+        """ seconds of the oldest frame in flight, None if not yet known """
+        GL.glEndQuery(GL.GL_TIME_ELAPSED)
+        self.frame += 1
+        if self.frame < GPU_QUERIES:
+            return None
+        query = self.queries[self.frame % GPU_QUERIES]
+        available = np.zeros(1, np.int32)
+        GL.glGetQueryObjectiv(query, GL.GL_QUERY_RESULT_AVAILABLE, available)
+        if not available[0]:
+            return None
+        nanoseconds = GL.GLuint64(0)  # PyOpenGL has no numpy uint64 output
+        GL.glGetQueryObjectui64v(query, GL.GL_QUERY_RESULT, ctypes.byref(nanoseconds))
+        return nanoseconds.value * 1e-9
+
+
+class Profiler:
+    """ Per frame CPU time of each phase, GPU time from timer queries,
+        counts of draw calls, triangles, state changes and uploaded bytes, and
+        render_queue.counters (e.g. animations evaluated, reused, culled),
+        shown by an optional overlay and logged as CSV rows, one per frame.
+        Instrumented functions (see instrument) and counted OpenGL calls are
+        only replaced by timing wrappers while enabled: when off, the viewer
+        runs its own code, left with one test per frame. """
+    def __init__(self):
+        self.enabled = False
+        self.targets = []        # (owner, name, phase) of instrumented functions
+        self.draws = []          # (owner, name) of counted draw functions
+        self.installed = []      # (owner, name, original) while enabled
+        self.phases = []         # instrumented phases, within FRAME_PHASES
+        self.times = Counter()   # CPU seconds per phase, current frame
+        self.counts = Counter()  # COUNTERS of current frame
+        self.nesting = threading.local()  # depth: nested calls count once
+        self.history = deque(maxlen=PROFILE_WINDOW)  # (times, counts, gpu)
+        self.pending = None      # last frame, completed by its swap time
+        self.overlay = None      # e.g. overlay.TextOverlay, drawn if set
+        self.log_path = None     # CSV log file name, None for no log
+        self.log, self.log_rows = None, 0
+
+    def instrument(self, owner, name, phase):
+        """ time owner.name (class method or module function) as phase """
+        self.targets.append((owner, name, phase))
+        if phase not in self.phases:
+            self.phases.append(phase)
+
+    def count_draws(self, owner, name):
+        """ count calls of owner.name(vertex_array, primitive, instances)
+            as draw calls and triangles, e.g. VertexArray.execute """
+        self.draws.append((owner, name))
+
+    # -------- switching instrumentation on and off
+    def toggle(self):
+        if self.enabled:
+            self.disable()
+        else:
+            self.enable()
+
+    def enable(self, log_path='profile.csv'):
+        if self.enabled:
+            return
+        for owner, name, phase in self.targets:
+            self._install(owner, name, self._timed(getattr(owner, name), phase))
+        for name, (counter, size) in GL_COUNTERS.items():
+            self._install(GL, name, self._counted(getattr(GL, name), counter, size))
+        for owner, name in self.draws:
+            self._install(owner, name, self._drawn(getattr(owner, name)))
+        self.pending, self.log_path = None, log_path
+        self.history.clear()
+        self.enabled = True
+        print('Profiler on' + (', logging to %s' % log_path if log_path else ''))
+
+    def disable(self):
+        if not self.enabled:
+            return
+        for owner, name, original in reversed(self.installed):
+            setattr(owner, name, original)
+        self.installed, self.enabled = [], False
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+        print('Profiler off')
+
+    def _install(self, owner, name, wrapper):
+        self.installed.append((owner, name, vars(owner)[name]))
+        setattr(owner, name, wrapper)
+
+    def _timed(self, function, phase):
+        def timed(*args, **kwargs):
+            if getattr(self.nesting, 'depth', 0):  # timed by an enclosing phase
+                return function(*args, **kwargs)
+            self.nesting.depth = 1
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.times[phase] += perf_counter() - start
+                self.nesting.depth = 0
+        return timed
+
+    def _counted(self, function, counter, size):
+        def counted(*args):
+            self.counts[counter] += size(args) if size else 1
+            return function(*args)
+        return counted
+
+    def _drawn(self, execute):
+        def drawn(vertex_array, primitive, instances=None):
+            arguments = vertex_array.arguments
+            count = arguments[0] if len(arguments) == 3 else arguments[1]
+            self.counts['draw calls'] += 1
+            if primitive == GL.GL_TRIANGLES:
+                self.counts['triangles'] += count // 3 * (instances or 1)
+            return execute(vertex_array, primitive, instances)
+        return drawn
+
+    # -------- per frame recording, called by Viewer.render while enabled
+    def begin_frame(self):
+        if self.pending is not None:
+            self.record(*self.pending)
+        self.times, self.counts = Counter(), Counter()
+
+    def end_frame(self, phase_times, gpu, size, queue):
+        """ close this frame, draw overlay; phase_times (e.g. Viewer's) can
+            still receive the time of swapping buffers until next frame.
+            queue: the render queue, its frame number and counters logged """
+        self.counts.update(queue.counters)  # e.g. animation LOD
+        self.pending = (phase_times, self.times, self.counts, gpu, queue.frame)
+        self.times, self.counts = Counter(), Counter()  # overlay not counted
+        if self.overlay is not None:
+            self.overlay.draw(self.lines(), size)
+
+    def record(self, phase_times, times, counts, gpu, frame):
+        times.update(phase_times)
+        self.history.append((times, counts, gpu))
+        if self.log_path:
+            self.write(times, counts, gpu, frame)
+
+    def write(self, times, counts, gpu, frame):
+        """ one CSV row: frame number, milliseconds, counts """
+        if self.log is None or self.log_rows >= PROFILE_LOG_ROWS:
+            if self.log is not None:
+                self.log.close()
+                os.replace(self.log_path, self.log_path + '.1')
+            self.log = open(self.log_path, 'w', newline='')
+            self.columns = list(FRAME_PHASES) + self.phases
+            self.writer = csv.writer(self.log)
+            self.writer.writerow(['frame', 'gpu ms'] + ['%s ms' % phase for phase
+                                 in self.columns] + list(COUNTERS + QUEUE_COUNTERS))
+            self.log_rows = 0
+        self.writer.writerow(
+            [frame, '' if gpu is None else '%.3f' % (gpu * 1e3)]
+            + ['%.3f' % (times[phase] * 1e3) for phase in self.columns]
+            + [counts[counter] for counter in COUNTERS + QUEUE_COUNTERS])
+        self.log_rows += 1
+
+    def lines(self):
+        """ text summary of the last frames, averaged """
+        if not self.history:
+            return ['profiler: waiting for a frame']
+        nb_frames = len(self.history)
+        times, counts = Counter(), Counter()
+        for frame_times, frame_counts, _ in self.history:
+            times.update(frame_times)
+            counts.update(frame_counts)
+        gpus = [gpu for _, _, gpu in self.history if gpu is not None]
+        cpu = sum(times[phase] for phase in FRAME_PHASES) / nb_frames
+        gpu = 'gpu %6.2f ms' % (1e3 * sum(gpus) / len(gpus)) if gpus else 'gpu -'
+        lines = ['cpu %6.2f ms (%5.1f fps)  %s  (%d frames)'
+                 % (cpu * 1e3, 1 / max(cpu, 1e-6), gpu, nb_frames)]
+        lines += ['%s%-16s %6.2f ms' % (indent, phase, times[phase] * 1e3 / nb_frames)
+                  for indent, phases in (('  ', FRAME_PHASES), ('    ', self.phases))
+                  for phase in phases if phase in times]
+        lines += ['%-18s %8d' % (counter, counts[counter] // nb_frames)
+                  for counter in COUNTERS]
+        lines += ['%-22s %6.1f' % (counter, counts[counter] / nb_frames)
+                  for counter in sorted(set(counts) - set(COUNTERS))]
+        return lines
+
+
+profiler = Profiler()
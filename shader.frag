@@ -7,21 +7,21 @@ out vec4 out_color;
 // fragment position and normal of the fragment, in WORLD coordinates
 in vec3 w_position, w_normal;
 
-// light dir, in world coordinates
-uniform vec3 light_dir;
+// per frame constants, filled by core.FrameUniforms
+layout(std140) uniform Frame {
+    mat4 view, projection, view_projection;
+    vec4 w_camera_position, light_dir;  // xyz, in world coordinates
+};
 
 // material properties
 uniform vec3 k_d, k_a, k_s;
 uniform float s;
 
-// world camera position
-uniform vec3 w_camera_position;
-
 void main() {
     // Compute all vectors, oriented outwards from the fragment
     vec3 n = normalize(w_normal);
-    vec3 l = normalize(-light_dir);
-    vec3 v = normalize(w_camera_position - w_position);
+    vec3 l = normalize(-light_dir.xyz);
+    vec3 v = normalize(w_camera_position.xyz - w_position);
     vec3 r = reflect(-l, n);
 
     vec3 diffuse_color = k_d * max(dot(n, l), 0);
@@ -1,17 +1,33 @@
 #version 330 core
 
-uniform mat4 model, view, projection;
+uniform mat4 model;
+uniform mat3 normal_matrix;  // transpose(inverse(mat3(model))), from Mesh.draw
+uniform bool instanced;  // model and normal matrices from instance attributes
+layout(std140) uniform Frame {
+    mat4 view, projection, view_projection;
+    vec4 w_camera_position, light_dir;  // xyz, in world coordinates
+};
 layout(location = 0) in vec3 position;
 layout(location = 1) in vec2 texture_coord;
-layout(location = 2) in vec4 bone_ids;
-layout(location = 3) in vec4 bone_weights;
-layout(location = 4) in vec3 normal;
+layout(location = 2) in uvec4 bone_ids;     // uint8 (glVertexAttribIPointer)
+layout(location = 3) in vec4 bone_weights;  // normalized uint8
+layout(location = 4) in vec3 normal;        // packed 10-10-10-2
+layout(location = 5) in mat4 instance_model;  // locations 5 to 8, one per column
+layout(location = 9) in mat3 instance_normal_matrix;  // locations 9 to 11
 
 out vec2 frag_tex_coords;
 
 
-const int MAX_VERTEX_BONES=4, MAX_BONES=128;
-uniform mat4 bone_matrix[MAX_BONES];
+// bone matrices of all skinned meshes of the frame, 4 texels (columns) each,
+// ours start at bone_offset (see BonePalette in mesh_skinning.py)
+uniform samplerBuffer bone_palette;
+uniform int bone_offset;
+
+mat4 bone_matrix(uint bone_id) {
+    int first = 4 * (bone_offset + int(bone_id));
+    return mat4(texelFetch(bone_palette, first), texelFetch(bone_palette, first + 1),
+                texelFetch(bone_palette, first + 2), texelFetch(bone_palette, first + 3));
+}
 
 // position and normal for the fragment shader, in WORLD coordinates
 out vec3 w_position, w_normal;
@@ -19,18 +35,23 @@ out vec3 w_position, w_normal;
 void main() {
 
     mat4 skin_matrix;
-    if (bone_weights == vec4(0))
-        skin_matrix = model;  // pas de poids de skinning: calcul de transformation à partir de model
-    else {
+    mat3 nit_matrix;  // moves normals: inverse transpose, computed on the CPU
+    if (bone_weights == vec4(0)) {
+        // pas de poids de skinning: calcul de transformation à partir de model
+        skin_matrix = instanced ? instance_model : model;
+        nit_matrix = instanced ? instance_normal_matrix : normal_matrix;
+    } else {
         skin_matrix= mat4(0);
         // calcul de transformation à partir des matrices bone_matrix :
         for (int j = 0; j < 4; j++) {
-            skin_matrix += bone_weights[j] * bone_matrix[int(bone_ids[j])];
+            skin_matrix += bone_weights[j] * bone_matrix(bone_ids[j]);
         }
+        // bones rotate and scale uniformly: their own matrix moves normals
+        nit_matrix = mat3(skin_matrix);
     }
 
     vec4 w_position4 = skin_matrix * vec4(position, 1.0);
-    gl_Position = projection * view * w_position4;
+    gl_Position = view_projection * w_position4;
 
     frag_tex_coords = texture_coord;
 
@@ -38,7 +59,6 @@ void main() {
     w_position = w_position4.xyz / w_position4.w;  // dehomogenize
 
     // fragment normal in world coordinates
-    mat3 nit_matrix = transpose(inverse(mat3(model)));
     w_normal = normalize(nit_matrix * normal);
 
 }
@@ -5,19 +5,19 @@ Python OpenGL practical application.
 
 import OpenGL.GL as GL              # standard Python OpenGL wrapper
 import numpy as np                  # all matrix manipulations & OpenGL args
-from PIL import Image               # load images for textures
 
-from core import Mesh
+from core import Mesh, gl_state
+from mesh_texture import load_image
 
 
 class SkyTexture:
     def __init__(self, faces):
         self.glid = GL.glGenTextures(1)
         try:
-            GL.glBindTexture(GL.GL_TEXTURE_CUBE_MAP, self.glid)
+            gl_state.bind_texture(GL.GL_TEXTURE_CUBE_MAP, self.glid)
             # imports image as a numpy array in exactly right format
             for i in range(len(faces)):
-                tex = np.asarray(Image.open(faces[i]).convert('RGBA'))
+                tex = load_image(faces[i])
                 GL.glTexImage2D(GL.GL_TEXTURE_CUBE_MAP_POSITIVE_X + i, 0, GL.GL_RGBA, tex.shape[1],
                                 tex.shape[0], 0, GL.GL_RGBA, GL.GL_UNSIGNED_BYTE, tex)
 
@@ -34,6 +34,7 @@ class SkyTexture:
             print("ERROR: unable to load texture files {}".format(faces))
 
     def __del__(self):  # delete GL texture from GPU when object dies
+        gl_state.forget_texture(self.glid)
         GL.glDeleteTextures(self.glid)
 
 
@@ -91,24 +92,30 @@ skyboxVertices = np.array([
 
 class Skybox(Mesh):
     """ Class for drawing a pyramid object """
+    bucket = 1  # drawn after opaque meshes: GL_LEQUAL at far depth, less fill
 
     def __init__(self, shader):
         self.shader = shader
 
         self.cubemapTexture = SkyTexture(faces)
+        self.texture = self.cubemapTexture
 
         # TODO: this is still a triangle, new values needed for Pyramid
         position = skyboxVertices
 
         super().__init__(shader, attributes=[position])
+        self.loc['skybox'] = shader.uniform_location('skybox')
 
     def draw(self, projection, view, model, primitives=GL.GL_TRIANGLES):
         GL.glDepthFunc(GL.GL_LEQUAL)
-        GL.glUseProgram(self.shader.glid)
+        gl_state.use_program(self.shader.glid)
 
-        GL.glActiveTexture(GL.GL_TEXTURE0)
-        GL.glBindTexture(GL.GL_TEXTURE_CUBE_MAP, self.cubemapTexture.glid)
-        GL.glUniform1i(GL.glGetUniformLocation(self.shader.glid, "skybox"), 0)
+        gl_state.bind_texture(GL.GL_TEXTURE_CUBE_MAP, self.cubemapTexture.glid)
+        gl_state.uniform_1i(self.loc['skybox'], 0)
 
         super().draw(projection, view, model)
         GL.glDepthFunc(GL.GL_LESS)
+
+    def sphere(self):
+        """ drawn around the camera whatever its model matrix: never culled """
+        return None
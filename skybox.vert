@@ -3,9 +3,11 @@ layout (location = 0) in vec3 aPos;
 
 out vec3 TexCoords;
 
-uniform mat4 projection;
-uniform mat4 view;
 uniform mat4 model;
+layout(std140) uniform Frame {
+    mat4 view, projection, view_projection;
+    vec4 w_camera_position, light_dir;  // xyz, in world coordinates
+};
 
 void main()
 {
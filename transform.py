@@ -223,3 +223,91 @@ class Trackball:
         old, new = (normalized(self._project3d(pos)) for pos in (old, new))
         phi = 2 * math.acos(np.clip(np.dot(old, new), -1, 1))
         return quaternion_from_axis_angle(np.cross(old, new), radians=phi)
+
+
+# batched versions, for many quaternions stored in a (N, 4) array ------------
+def quaternion_matrix_array(q):
+    """ Create (N,4,4) rotation matrices from (N,4) array of quaternions """
+    norm = np.linalg.norm(q, axis=-1, keepdims=True)
+    q = q / np.where(norm > 0., norm, 1.)  # only unit quaternions are valid
+    w, x, y, z = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+    matrices = np.zeros((len(q), 4, 4), 'f')
+    matrices[:, 0, 0] = 1 - 2*(y*y + z*z)
+    matrices[:, 0, 1] = 2*(x*y - w*z)
+    matrices[:, 0, 2] = 2*(x*z + w*y)
+    matrices[:, 1, 0] = 2*(x*y + w*z)
+    matrices[:, 1, 1] = 1 - 2*(x*x + z*z)
+    matrices[:, 1, 2] = 2*(y*z - w*x)
+    matrices[:, 2, 0] = 2*(x*z - w*y)
+    matrices[:, 2, 1] = 2*(y*z + w*x)
+    matrices[:, 2, 2] = 1 - 2*(x*x + y*y)
+    matrices[:, 3, 3] = 1
+    return matrices
+
+
+def quaternion_slerp_array(q0, q1, fraction):
+    """ Spherical interpolation of (N,4) quaternion arrays by N fractions """
+    def normalized_rows(q):
+        norm = np.linalg.norm(q, axis=-1, keepdims=True)
+        return q / np.where(norm > 0., norm, 1.)
+
+    q0, q1 = normalized_rows(q0), normalized_rows(q1)
+    dot = np.sum(q0 * q1, axis=-1)
+
+    # same shorter path fix as quaternion_slerp, row by row
+    q1 = np.where((dot > 0)[:, None], q1, -q1)
+    dot = np.abs(dot)
+
+    theta = np.arccos(np.clip(dot, -1, 1)) * fraction
+    q2 = normalized_rows(q1 - q0*dot[:, None])
+    return q0*np.cos(theta)[:, None] + q2*np.sin(theta)[:, None]
+
+
+# ------------ bounding spheres (x, y, z, radius) and view frustum -----------
+def bounding_sphere(points):
+    """ Sphere containing all points, centered on their bounding box """
+    points = np.asarray(points, np.float32).reshape(-1, 3)
+    if not len(points):
+        return None
+    center = (points.min(axis=0) + points.max(axis=0)) / 2
+    return vec(*center, np.linalg.norm(points - center, axis=1).max())
+
+
+def transform_spheres(matrix, spheres):
+    """ Spheres (..., 4) moved by matrix (4x4 or broadcastable stack), radii
+        scaled by the largest axis scale so any similar shape still fits """
+    matrix, spheres = np.asarray(matrix), np.asarray(spheres)
+    linear = matrix[..., :3, :3]
+    centers = (linear @ spheres[..., :3, None])[..., 0] + matrix[..., :3, 3]
+    radii = spheres[..., 3] * np.linalg.norm(linear, axis=-2).max(axis=-1)
+    return np.concatenate((centers, radii[..., None]), axis=-1)
+
+
+def enclosing_sphere(spheres):
+    """ Sphere containing all (N,4) spheres, None if there are none or if
+        one of them is unbounded (infinite radius) """
+    spheres = np.asarray(spheres, np.float32).reshape(-1, 4)
+    if not len(spheres) or not np.isfinite(spheres[:, 3]).all():
+        return None
+    low = (spheres[:, :3] - spheres[:, 3:]).min(axis=0)
+    high = (spheres[:, :3] + spheres[:, 3:]).max(axis=0)
+    center = (low + high) / 2
+    distance = np.linalg.norm(spheres[:, :3] - center, axis=1) + spheres[:, 3]
+    return vec(*center, distance.max())
+
+
+def frustum_planes(view_projection):
+    """ (6,4) normalized planes (a, b, c, d) of the clip volume of matrix,
+        a point p is inside when a*x + b*y + c*z + d >= 0 for all planes """
+    rows = np.asarray(view_projection, np.float64)
+    planes = np.array([rows[3] + rows[0], rows[3] - rows[0],
+                       rows[3] + rows[1], rows[3] - rows[1],
+                       rows[3] + rows[2], rows[3] - rows[2]])
+    return planes / np.linalg.norm(planes[:, :3], axis=1, keepdims=True)
+
+
+def spheres_in_frustum(planes, spheres):
+    """ Boolean mask of (N,4) spheres at least partly inside frustum planes """
+    spheres = np.asarray(spheres).reshape(-1, 4)
+    distances = spheres[:, :3] @ planes[:, :3].T + planes[:, 3]
+    return np.all(distances >= -spheres[:, 3:], axis=1)
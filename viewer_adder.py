@@ -1,21 +1,30 @@
 import sys
 import glfw
+import numpy as np
 
-from core import Node, RotationControlNode
+from core import Node, Instances, RotationControlNode, clock
 from transform import scale, translate, rotate, vec, quaternion, quaternion_from_euler
 from mesh_texture_skinning import load_textured_skinned
 from mesh_texture_illumination import load_textured_illuminated
 from mesh_texture_skinning_illumination import load_textured_skinned_illuminated
+from mesh_skinning import AnimatedCharacter
 from animation import KeyFrameControlNode
-from sky import Skybox
+from sky import Skybox, faces
+from assets import deferred, deferred_call
+from batching import StaticBatch
+from crowd import Crowd
 
 NB_TEXTURES_ELF = 12
+ANIMATION_BAKE_RATE = 30  # Hz, animations are looked up in resampled tables
 
 
-class Elf(Node):
-    def __init__(self, shader, actions, num_texture, key_to_reset=None, loop_duration=0.0):
+class Elf(AnimatedCharacter):
+    # children are swapped when changing action, skeleton evaluation follows
+    # the lod policy (distance to camera, visibility), see AnimationLOD
+
+    def __init__(self, shader, actions, num_texture, key_to_reset=None, loop_duration=0.0, lod=None):
         # /!\ actions est une liste de strings !
-        super().__init__()
+        super().__init__(lod=lod)
         num_texture += int(num_texture > NB_TEXTURES_ELF)
         num_texture %= (NB_TEXTURES_ELF + 1)
         possible_actions = ["walking_in_circle", "walking_on_the_spot",
@@ -37,34 +46,32 @@ class Elf(Node):
         else:
             self.key_to_reset = key_to_reset
             self.nb_actions = len(actions) # évite d'avoir à recompter à chaque fois
-            if self.nb_actions > 1:
-                self.actions = actions
-                self.current_action = 0
-                self.shader = shader # Pour pouvoir changer d'action
-                self.num_texture = num_texture # Pour pouvoir changer d'action
+            self.current_action = 0
+            # chaque action est chargée une seule fois, ici : changer d'action
+            # revient juste à changer de squelette (et d'animation) affiché
+            self.skeletons = [deferred(load_textured_skinned, "our_creations/elf/elf_"
+                              + action + ".fbx", shader, "our_creations/elf/UV_elf_"
+                              + str(num_texture) + ".png", loop_duration=loop_duration,
+                              bake_rate=ANIMATION_BAKE_RATE) for action in actions]
             if self.nb_actions >= 1:
-                self.add(*load_textured_skinned("our_creations/elf/elf_"
-                         + actions[0] + ".fbx", shader, "our_creations/elf/UV_elf_"
-                         + str(num_texture) + ".png", loop_duration))
+                self.add(*self.skeletons[0])
             # si pas d'action, l'elfe est ignoré (pas affiché)
 
     def key_handler(self, key): # pour pouvoir reset les animations individuellement
+        now = clock.time()  # same reset time for the whole skeleton
         def recursive_reset_time(cur):
             if hasattr(cur, "children") and len(cur.children) != 0:
                 for child in cur.children:
                     if hasattr(child, "reset_time"):
-                        child.reset_time()
+                        child.reset_time(now)
                     recursive_reset_time(child)
         if key == self.key_to_reset:
             if(self.nb_actions > 1):
                 self.current_action = (self.current_action + 1) % self.nb_actions
-                self.children = []
-                self.add(*load_textured_skinned("our_creations/elf/elf_"
-                         + self.actions[self.current_action] + ".fbx", self.shader,
-                         "our_creations/elf/UV_elf_" + str(self.num_texture)
-                         + ".png")) # éventuellement rajouter la loop_duration si besoin
+                self.children = list(self.skeletons[self.current_action]) # déjà chargé, pas d'import
 
             recursive_reset_time(self) # cela recommence l'animation à 0
+            self._pose_frame = None  # nouvelle pose dès cette frame
 
         super().key_handler(key)
 
@@ -72,31 +79,31 @@ class Elf(Node):
 class Elf_statue(Node):
     def __init__(self, shader):
         super().__init__()
-        self.add(*load_textured_skinned_illuminated("our_creations/elf/elf_statue.obj", shader))
+        self.add(*deferred(load_textured_skinned_illuminated, "our_creations/elf/elf_statue.obj", shader))
 
 
 class Fountain(Node):
     def __init__(self, shader):
         super().__init__()
-        self.add(*load_textured_skinned("resources/fountain.obj", shader, "resources/fountain.png"))
+        self.add(*deferred(load_textured_skinned, "resources/fountain.obj", shader, "resources/fountain.png"))
 
 
 class Cube(Node):
     def __init__(self, shader, texture="wood"):
         super().__init__()
-        self.add(*load_textured_skinned('our_creations/catapult/cube.obj', shader, "resources/" + texture + ".png"))
+        self.add(*deferred(load_textured_skinned, 'our_creations/catapult/cube.obj', shader, "resources/" + texture + ".png"))
 
 
 class Cylinder(Node):
     def __init__(self, shader, texture="wood"):
         super().__init__()
-        self.add(*load_textured_skinned('resources/cylinder.obj', shader, "resources/" + texture + ".png"))
+        self.add(*deferred(load_textured_skinned, 'resources/cylinder.obj', shader, "resources/" + texture + ".png"))
 
 
 class Bucket(Node):
     def __init__(self, shader):
         super().__init__()
-        self.add(*load_textured_skinned('our_creations/catapult/bucket.obj', shader, "resources/metal.png"))
+        self.add(*deferred(load_textured_skinned, 'our_creations/catapult/bucket.obj', shader, "resources/metal.png"))
 
 
 # def add_files_specified_in_the_command(viewer, shader):
@@ -108,8 +115,8 @@ class Bucket(Node):
 #                      for m in load_textured_skinned_illuminated(file, shader)])
 
 
-def add_an_elf(viewer, shader, position=(0, 0, 0), orientation=((0, 0, 0), 0), actions=[], num_texture=1, key_to_reset=None, loop_duration=0.0):
-    elf = Elf(shader, actions, num_texture, key_to_reset, loop_duration)
+def add_an_elf(viewer, shader, position=(0, 0, 0), orientation=((0, 0, 0), 0), actions=[], num_texture=1, key_to_reset=None, loop_duration=0.0, lod=None):
+    elf = Elf(shader, actions, num_texture, key_to_reset, loop_duration, lod)
     elf_shape = Node(transform=translate(0, -0.4, 0) @ scale(0.006))
     elf_shape.add(elf)
     transform_elf = Node(transform = translate(position) @ rotate(orientation[0], orientation[1]))
@@ -137,11 +144,31 @@ def add_the_walking_elf(viewer, shader, position=(0, 0, 0), orientation=((0, 0,
                   41: quaternion_from_euler(0, -157, 0),  41.8: quaternion_from_euler(0, -90, 0),
                   59:quaternion_from_euler(0, -90, 0), 59.8: quaternion()}
     scale_keys = {0: 0.006, 50: 0.006}
-    keynode = KeyFrameControlNode(translate_keys, rotate_keys, scale_keys, loop_duration=63.4)
+    keynode = KeyFrameControlNode(translate_keys, rotate_keys, scale_keys, loop_duration=63.4,
+                                  bake_rate=ANIMATION_BAKE_RATE)
     keynode.add(elf)
     viewer.add(keynode)
 
 
+def add_a_crowd(viewer, shader, count, position=(0, 0, 0), actions=("waiting", "listening", "saying_hi"),
+                num_texture=1, spacing=2.0, workers=None, seed=0):
+    # une foule de count elfes sur une grille, orientations aléatoires : leurs
+    # squelettes sont évalués dans des processus séparés, voir crowd.py
+    actions_handles = []
+    for action in actions:
+        handle = Node()  # toutes les actions doivent avoir le même squelette
+        handle.add(*deferred(load_textured_skinned, "our_creations/elf/elf_" + action + ".fbx",
+                             shader, "our_creations/elf/UV_elf_" + str(num_texture) + ".png",
+                             bake_rate=ANIMATION_BAKE_RATE))
+        actions_handles.append(handle)
+    rng = np.random.default_rng(seed)
+    side = int(np.ceil(np.sqrt(count)))
+    placements = [translate(position) @ translate(spacing * (i % side), 0, spacing * (i // side))
+                  @ rotate((0, 1, 0), rng.uniform(0, 360)) @ translate(0, -0.4, 0) @ scale(0.006)
+                  for i in range(count)]
+    viewer.add(Crowd(actions_handles, placements, workers, seed))
+
+
 def add_an_elf_statue(viewer, shader, position=(0, 0, 0), orientation=((0, 0, 0), 0)):
     elf = Elf_statue(shader)
     elf_shape = Node(transform=translate(0, -0.4, 0) @ scale(4))
@@ -259,16 +286,17 @@ def add_a_catapult(viewer, shader, position=(0, 0, 0), orientation=((0, 0, 0), 0
 
 
 def add_the_island(viewer, shader):
-    island = Node(transform= rotate((0,1,0), 90) @ translate(-50, -9.5, 0) @ scale(3))
-    island.add(*load_textured_skinned_illuminated("our_creations/island/island_block.obj", shader, "our_creations/island/island_block.png"))
+    # île immobile : ses meshes sont fusionnés au chargement, voir batching.py
+    island = StaticBatch(transform= rotate((0,1,0), 90) @ translate(-50, -9.5, 0) @ scale(3))
+    island.add(*deferred(load_textured_skinned_illuminated, "our_creations/island/island_block.obj", shader, "our_creations/island/island_block.png"))
     transform_boat = Node(transform=translate(-15, 1, 0))
-    transform_boat.add(*load_textured_skinned_illuminated("our_creations/island/boat_and_pontoon.obj", shader, "our_creations/island/boat_and_pontoon.png"))
+    transform_boat.add(*deferred(load_textured_skinned_illuminated, "our_creations/island/boat_and_pontoon.obj", shader, "our_creations/island/boat_and_pontoon.png"))
     island.add(transform_boat)
-    island.add(*load_textured_skinned_illuminated("our_creations/island/rocks.obj", shader, "our_creations/island/rocks.png"))
-    island.add(*load_textured_skinned_illuminated("our_creations/island/sea_and_sand.obj", shader, "our_creations/island/sea_and_sand.png"))
-    island.add(*load_textured_skinned_illuminated("our_creations/island/small_island.obj", shader, "our_creations/island/small_island.png"))
-    island.add(*load_textured_skinned_illuminated("our_creations/island/bridge.obj", shader, "our_creations/island/bridge.png"))
-    island.add(*load_textured_skinned_illuminated("our_creations/island/tower.obj", shader, "our_creations/island/tower.png"))
+    island.add(*deferred(load_textured_skinned_illuminated, "our_creations/island/rocks.obj", shader, "our_creations/island/rocks.png"))
+    island.add(*deferred(load_textured_skinned_illuminated, "our_creations/island/sea_and_sand.obj", shader, "our_creations/island/sea_and_sand.png"))
+    island.add(*deferred(load_textured_skinned_illuminated, "our_creations/island/small_island.obj", shader, "our_creations/island/small_island.png"))
+    island.add(*deferred(load_textured_skinned_illuminated, "our_creations/island/bridge.obj", shader, "our_creations/island/bridge.png"))
+    island.add(*deferred(load_textured_skinned_illuminated, "our_creations/island/tower.obj", shader, "our_creations/island/tower.png"))
     viewer.add(island)
 
 
@@ -276,53 +304,37 @@ def add_the_castle(viewer, shader):
     castle = Node(transform=translate(-33, 11.5, 25) @ scale(0.45))
     castle_walls = Node()
 
-    tower = load_textured_illuminated('resources/castle/tower.FBX', shader, tex_file="resources/castle/Texture/tower_01_D.jpg")
-    for i in range(4):
-        if(i == 0):
-            tower_shape = Node(transform=translate(-30,9,0) @ scale(.15,.25,.15))
-        elif(i == 1):
-            tower_shape = Node(transform=translate(56,9,0) @ scale(.15,.25,.15))
-        elif(i == 2):
-            tower_shape = Node(transform=translate(-30,9,-86) @ scale(.15,.25,.15))
-        else:
-            tower_shape = Node(transform=translate(56,9,-86) @ scale(.15,.25,.15))
-        tower_shape.add(*tower)
-        castle_walls.add(tower_shape)
-
+    # tours et murs : un seul appel de dessin (instancié) par mesh, voir Instances
+    # (pleine résolution : les niveaux de détail ne sont pas instanciés)
+    towers = Instances(deferred(load_textured_illuminated, 'resources/castle/tower.FBX', shader, tex_file="resources/castle/Texture/tower_01_D.jpg", lod=False))
+    for x, z in ((-30, 0), (56, 0), (-30, -86), (56, -86)):
+        towers.place(translate(x, 9, z) @ scale(.15,.25,.15))
+    castle_walls.add(towers)
 
-    wall = load_textured_illuminated('resources/castle/castle_wall.FBX', shader)
-    door = load_textured_illuminated('resources/castle/castle_gate.FBX', shader)
-    wall_shape = Node(transform=translate(-20.5, -5, -8)@ scale(.35,.25,.25))
-    wall_shape.add(*wall)
-    castle_walls.add(wall_shape)
+    walls = Instances(deferred(load_textured_illuminated, 'resources/castle/castle_wall.FBX', shader, lod=False))
+    door = deferred(load_textured_illuminated, 'resources/castle/castle_gate.FBX', shader)
+    walls.place(translate(-20.5, -5, -8)@ scale(.35,.25,.25))
 
     wall_shape = Node(transform=translate(28.5, -13)@ scale(.25,.25,.25)@ rotate(angle=-90, axis=(1, 0, 0)))
     wall_shape.add(*door)
     castle_walls.add(wall_shape)
 
-    wall_shape = Node(transform=translate(42.5, -5, -8)@ scale(.35,.25,.25))
-    wall_shape.add(*wall)
-    castle_walls.add(wall_shape)
+    walls.place(translate(42.5, -5, -8)@ scale(.35,.25,.25))
 
     for i in range(5):
-        wall_shape = Node(transform=translate(52, -5,-12 -16*i)@ scale(.25,.25,.25)@ rotate(angle=90, axis=(0, 1, 0)))
-        wall_shape.add(*wall)
-        castle_walls.add(wall_shape)
+        walls.place(translate(52, -5,-12 -16*i)@ scale(.25,.25,.25)@ rotate(angle=90, axis=(0, 1, 0)))
 
     for i in range(5):
-        wall_shape = Node(transform=translate(-15.5 + 16*i, -5, -86)@ scale(.25,.25,.25)@ rotate(angle=180, axis=(0, 1, 0)))
-        wall_shape.add(*wall)
-        castle_walls.add(wall_shape)
+        walls.place(translate(-15.5 + 16*i, -5, -86)@ scale(.25,.25,.25)@ rotate(angle=180, axis=(0, 1, 0)))
 
     for i in range(5):
-        wall_shape = Node(transform=translate(-26, -5,-16 -16*i)@ scale(.25,.25,.25)@ rotate(angle=-90, axis=(0, 1, 0)))
-        wall_shape.add(*wall)
-        castle_walls.add(wall_shape)
+        walls.place(translate(-26, -5,-16 -16*i)@ scale(.25,.25,.25)@ rotate(angle=-90, axis=(0, 1, 0)))
+    castle_walls.add(walls)
 
     castle_walls_shape = Node(transform=scale(2,2,2))
     castle_walls_shape.add(castle_walls)
 
-    castle_inside = load_textured_illuminated("resources/castle/castle.fbx", shader, tex_file="resources/castle/Texture/castle.jpg")
+    castle_inside = deferred(load_textured_illuminated, "resources/castle/castle.fbx", shader, tex_file="resources/castle/Texture/castle.jpg")
     castle_inside_shape = Node(transform=translate(25, 5, -40)@ scale(.5,.5,.5)@ rotate(angle=-90, axis=(1, 0, 0)))
     castle_inside_shape.add(*castle_inside)
 
@@ -331,11 +343,11 @@ def add_the_castle(viewer, shader):
 
     viewer.add(castle)
     floor = Node(transform= translate(-64, -3, 1.5) @ scale(2.15, 1, 2.5))
-    floor.add(*load_textured_illuminated("our_creations/castle_floor/castle_floor.obj", shader, "our_creations/castle_floor/castle_floor.png"))
+    floor.add(*deferred(load_textured_illuminated, "our_creations/castle_floor/castle_floor.obj", shader, "our_creations/castle_floor/castle_floor.png"))
     viewer.add(floor)
 
 
 def add_skybox(viewer, shader, s):
     sky = Node(transform=scale(s,s,s)*translate(100, 100, 100))
-    sky.add(Skybox(shader))
+    sky.add(*deferred_call(Skybox, shader, images=faces))
     viewer.add(sky)